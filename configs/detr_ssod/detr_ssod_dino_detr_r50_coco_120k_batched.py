@@ -0,0 +1,20 @@
+_base_ = "detr_ssod_dino_detr_r50_coco_120k.py"
+
+# opt-in: the one-to-one matching of all decoder layers and images in one
+# fused cost computation, and the losses of all decoder layers in one
+# batched call after the warm-up
+model = dict(
+    bbox_head=dict(
+        stacked_loss=True,
+        layer_loss_weights=None,
+    ),
+    train_cfg=dict(
+        assigner2=dict(
+            type='BatchedHungarianAssigner',
+            # 0 solves the matches in-process; >0 solves them in a thread
+            # pool on every rank, which competes with the dataloader workers
+            # for the CPUs, opt in with e.g.
+            # --cfg-options model.train_cfg.assigner2.num_workers=4
+            num_workers=0),
+    ),
+)
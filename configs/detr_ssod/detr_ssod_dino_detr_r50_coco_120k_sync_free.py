@@ -0,0 +1,10 @@
+_base_ = "detr_ssod_dino_detr_r50_coco_120k_batched.py"
+
+# opt-in: the losses without host syncs, the avg factors are clamped on
+# device and the empty targets masked instead of selected, count the
+# remaining syncs with custom_hooks=[dict(type='SyncCounter')]
+model = dict(
+    bbox_head=dict(
+        sync_free_loss=True,
+    ),
+)
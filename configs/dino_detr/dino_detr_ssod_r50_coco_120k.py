@@ -15,6 +15,8 @@ model = dict(
         norm_cfg=dict(type='BN', requires_grad=False),
         norm_eval=True,
         style='pytorch',
+        # activation checkpointing, a bool or one bool per stage
+        with_cp=False,
         init_cfg=dict(type='Pretrained', checkpoint='torchvision://resnet50')),
     bbox_head=dict(
         type='DINODETRSSODHead',
@@ -24,7 +26,11 @@ model = dict(
         bbox_embed_diff_each_layer=False,
         num_classes=80,
         in_channels=2048,
-        transformer=dict(type='DINOTransformer'),
+        transformer=dict(
+            type='DINOTransformer',
+            # activation checkpointing, a bool or one bool per layer
+            enc_with_cp=False,
+            dec_with_cp=False),
         positional_encoding=dict(
             type='SinePositionalEncodingHW', temperatureH=20,temperatureW=20,num_feats=128, normalize=True),
         loss_cls1=dict(
@@ -44,6 +50,8 @@ model = dict(
     train_cfg=dict(
         assigner1=dict(
             type='O2MAssigner'),
+        # the BatchedHungarianAssigner is an opt-in, see
+        # configs/detr_ssod/detr_ssod_dino_detr_r50_coco_120k_batched.py
         assigner2=dict(
             type='HungarianAssigner',
             cls_cost=dict(type='FocalLossCost', weight=2.0),
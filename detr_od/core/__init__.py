@@ -1 +1,2 @@
-from .bbox import *
\ No newline at end of file
+from .bbox import *
+from .utils import *
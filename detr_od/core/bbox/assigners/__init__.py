@@ -1 +1,4 @@
 from .o2m_assigner import O2MAssigner
+from .batched_hungarian_assigner import (BatchedHungarianAssigner,
+                                         batched_linear_sum_assignment)
+from .assign_pool import AssignmentPool
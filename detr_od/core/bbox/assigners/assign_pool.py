@@ -0,0 +1,81 @@
+from concurrent.futures import Future, ThreadPoolExecutor
+
+import torch
+try:
+    from scipy.optimize import linear_sum_assignment
+except ImportError:
+    linear_sum_assignment = None
+
+
+def _solve(cost, event=None):
+    """Wait for the copy of `cost` to the host, then solve it."""
+    if event is not None:
+        event.synchronize()
+    return linear_sum_assignment(cost.numpy())
+
+
+class AssignmentPool:
+    """Solve linear sum assignments concurrently on CPU threads.
+
+    scipy's `linear_sum_assignment` releases the GIL, so the independent
+    solves of the images and decoder layers run in parallel. The cost
+    matrices are copied to pinned host memory without blocking and each
+    solve waits for its own copy only, so the copies, the solves and the
+    remaining device work overlap.
+
+    Args:
+        num_workers (int): number of solver threads, 0 to solve in the
+            calling thread. Default: 0.
+    """
+
+    def __init__(self, num_workers=0):
+        self.num_workers = num_workers
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                self.num_workers, thread_name_prefix='assign')
+        return self._executor
+
+    def __getstate__(self):
+        # the threads can not be copied or pickled, they are restarted lazily
+        state = self.__dict__.copy()
+        state['_executor'] = None
+        return state
+
+    def to_host(self, cost):
+        """Start copying `cost` to the host.
+
+        Returns:
+            tuple[Tensor, torch.cuda.Event | None]: the host tensor and the
+                event to wait for before reading it.
+        """
+        cost = cost.detach()
+        if not cost.is_cuda:
+            return cost, None
+        host_cost = torch.empty(cost.shape, dtype=cost.dtype, pin_memory=True)
+        host_cost.copy_(cost, non_blocking=True)
+        event = torch.cuda.Event()
+        event.record()
+        return host_cost, event
+
+    def submit(self, cost, event=None):
+        """Solve a [num_query, num_gt] host cost matrix.
+
+        Args:
+            cost (Tensor): the cost on the host, as returned by `to_host`.
+            event (torch.cuda.Event, optional): the event of its copy.
+
+        Returns:
+            Future: resolves to the matched (row_inds, col_inds) arrays.
+        """
+        if linear_sum_assignment is None:
+            raise ImportError('Please run "pip install scipy" '
+                              'to install scipy first.')
+        if self.num_workers > 0:
+            return self.executor.submit(_solve, cost, event)
+        future = Future()
+        future.set_result(_solve(cost, event))
+        return future
@@ -0,0 +1,193 @@
+import numpy as np
+import torch
+
+from mmdet.core.bbox.builder import BBOX_ASSIGNERS
+from mmdet.core.bbox.match_costs import BBoxL1Cost, FocalLossCost, IoUCost
+from mmdet.core.bbox.assigners.assign_result import AssignResult
+from mmdet.core.bbox.assigners.hungarian_assigner import HungarianAssigner
+
+from ..match_costs.fused_cost import fused_match_cost
+from .assign_pool import AssignmentPool
+
+
+def batched_linear_sum_assignment(cost, num_gts, pool=None):
+    """Solve the matching of every (layer, image) pair of a batched cost.
+
+    Args:
+        cost (Tensor): [num_layers, bs, num_query, max(num_gts)], the costs
+            against the gts of each image, padded to the same number.
+        num_gts (list[int]): number of gts of each image.
+        pool (:obj:`AssignmentPool`, optional): the pool to solve the
+            (layer, image) blocks in, they are solved one by one if None.
+
+    Returns:
+        tuple[np.ndarray]: the flat layer, image, query and gt (within the
+            image) indices of all the matched pairs.
+    """
+    if pool is None:
+        pool = AssignmentPool()
+    cost, event = pool.to_host(cost)
+    num_layers = cost.size(0)
+    futures = []
+    for img_id, num_gt in enumerate(num_gts):
+        for layer_id in range(num_layers):
+            if num_gt == 0:
+                break
+            futures.append((layer_id, img_id, pool.submit(
+                cost[layer_id, img_id, :, :num_gt], event)))
+
+    layer_inds, img_inds, query_inds, gt_inds = [], [], [], []
+    for layer_id, img_id, future in futures:
+        rows, cols = future.result()
+        layer_inds.append(np.full_like(rows, layer_id))
+        img_inds.append(np.full_like(rows, img_id))
+        query_inds.append(rows)
+        gt_inds.append(cols)
+    if len(query_inds) == 0:
+        return tuple(np.zeros(0, dtype=np.int64) for _ in range(4))
+    return tuple(
+        np.concatenate(inds)
+        for inds in (layer_inds, img_inds, query_inds, gt_inds))
+
+
+@BBOX_ASSIGNERS.register_module()
+class BatchedHungarianAssigner(HungarianAssigner):
+    """HungarianAssigner that also matches the outputs of all decoder layers
+    and images at once.
+
+    `assign_batched` computes the costs of all the layers and images in one
+    stacked op against the gts of each image padded to the same number,
+    copies them to CPU once and solves every (layer, image) block in one
+    call. The assignments are returned packed in one
+    [num_layers, bs, num_query] tensor. `assign` is kept for the per-image
+    callers, e.g. the encoder outputs.
+
+    Both compute the total cost with `fused_match_cost`, which only supports
+    the `FocalLossCost`, `BBoxL1Cost` (xywh) and `IoUCost` used by DINO.
+
+    Args:
+        num_workers (int): number of threads solving the (layer, image)
+            blocks concurrently, 0 to solve them one by one. Default: 0.
+    """
+
+    def __init__(self, num_workers=0, **kwargs):
+        super(BatchedHungarianAssigner, self).__init__(**kwargs)
+        if not (isinstance(self.cls_cost, FocalLossCost)
+                and isinstance(self.reg_cost, BBoxL1Cost)
+                and self.reg_cost.box_format == 'xywh'
+                and isinstance(self.iou_cost, IoUCost)):
+            raise NotImplementedError(
+                f'{self.__class__.__name__} only supports FocalLossCost, '
+                'BBoxL1Cost(box_format="xywh") and IoUCost.')
+        self.pool = AssignmentPool(num_workers)
+
+    def match_cost(self, bbox_pred, cls_pred, gt_bboxes, gt_labels, factor):
+        """The weighted total cost, see `fused_match_cost` for the args."""
+        return fused_match_cost(
+            bbox_pred, cls_pred, gt_bboxes, gt_labels, factor,
+            cls_weight=self.cls_cost.weight,
+            reg_weight=self.reg_cost.weight,
+            iou_weight=self.iou_cost.weight,
+            alpha=self.cls_cost.alpha,
+            gamma=self.cls_cost.gamma,
+            iou_mode=self.iou_cost.iou_mode,
+            eps=self.cls_cost.eps)
+
+    def assign(self,
+               bbox_pred,
+               cls_pred,
+               gt_bboxes,
+               gt_labels,
+               img_meta,
+               gt_bboxes_ignore=None,
+               eps=1e-7):
+        """Same as `HungarianAssigner.assign`, with the fused cost."""
+        if self.debug:
+            return super(BatchedHungarianAssigner, self).assign(
+                bbox_pred, cls_pred, gt_bboxes, gt_labels, img_meta,
+                gt_bboxes_ignore, eps)
+        assert gt_bboxes_ignore is None, \
+            'Only case when gt_bboxes_ignore is None is supported.'
+        num_gts = gt_bboxes.size(0)
+        assigned_gt_inds = bbox_pred.new_zeros(
+            (bbox_pred.size(0), ), dtype=torch.long)
+        if num_gts > 0 and bbox_pred.size(0) > 0:
+            img_h, img_w, _ = img_meta['img_shape']
+            factor = gt_bboxes.new_tensor([img_w, img_h, img_w, img_h])
+            cost = self.match_cost(bbox_pred, cls_pred, gt_bboxes, gt_labels, factor)
+            cost, event = self.pool.to_host(cost)
+            matched_row_inds, matched_col_inds = self.pool.submit(cost, event).result()
+            matched_row_inds = torch.from_numpy(matched_row_inds).to(bbox_pred.device)
+            matched_col_inds = torch.from_numpy(matched_col_inds).to(bbox_pred.device)
+            assigned_gt_inds[matched_row_inds] = matched_col_inds + 1
+        return self.get_assign_result(assigned_gt_inds, gt_labels)
+
+    def assign_batched(self,
+                       bbox_preds,
+                       cls_preds,
+                       gt_bboxes_list,
+                       gt_labels_list,
+                       img_metas):
+        """Computes one-to-one matching for all layers and images.
+
+        Args:
+            bbox_preds (Tensor): Predicted boxes with normalized coordinates
+                (cx, cy, w, h). Shape [num_layers, bs, num_query, 4].
+            cls_preds (Tensor): Predicted classification logits, shape
+                [num_layers, bs, num_query, num_class].
+            gt_bboxes_list (list[Tensor]): Ground truth boxes of each image
+                with unnormalized coordinates (x1, y1, x2, y2).
+            gt_labels_list (list[Tensor]): Labels of each image.
+            img_metas (list[dict]): Meta information of each image.
+
+        Returns:
+            Tensor: [num_layers, bs, num_query], the assigned gt index
+                (1-based, within its image) of each query, 0 for background.
+        """
+        num_layers, num_imgs, num_query = bbox_preds.shape[:3]
+        num_gts = [gt_bboxes.size(0) for gt_bboxes in gt_bboxes_list]
+        assigned_gt_inds = bbox_preds.new_zeros(
+            (num_layers, num_imgs, num_query), dtype=torch.long)
+        if sum(num_gts) == 0 or num_query == 0:
+            return assigned_gt_inds
+
+        factors = torch.stack([
+            bbox_preds.new_tensor([img_w, img_h, img_w, img_h])
+            for img_h, img_w, _ in (img_meta['img_shape'] for img_meta in img_metas)
+        ])                                                              # [bs, 4]
+        # pad the gts of each image to the same number
+        max_num_gts = max(num_gts)
+        gt_bboxes = bbox_preds.new_zeros((num_imgs, max_num_gts, 4))
+        gt_labels = bbox_preds.new_zeros((num_imgs, max_num_gts), dtype=torch.long)
+        for img_id, num_gt in enumerate(num_gts):
+            gt_bboxes[img_id, :num_gt] = gt_bboxes_list[img_id]
+            gt_labels[img_id, :num_gt] = gt_labels_list[img_id]
+
+        # the costs of all layers and images, [num_layers, bs, num_query, max_num_gts]
+        cost = self.match_cost(bbox_preds, cls_preds, gt_bboxes, gt_labels, factors)
+
+        layer_inds, img_inds, query_inds, gt_inds = \
+            batched_linear_sum_assignment(cost, num_gts, self.pool)
+        matched_inds = torch.from_numpy(
+            np.stack([layer_inds, img_inds, query_inds, gt_inds])).to(
+                bbox_preds.device)
+        assigned_gt_inds[matched_inds[0], matched_inds[1],
+                         matched_inds[2]] = matched_inds[3] + 1
+        return assigned_gt_inds
+
+    @staticmethod
+    def get_assign_result(assigned_gt_inds, gt_labels):
+        """Unpack the assignment of one layer and image from `assign_batched`.
+
+        Args:
+            assigned_gt_inds (Tensor): [num_query], the assigned gt indices.
+            gt_labels (Tensor): Label of the gts of the image.
+
+        Returns:
+            :obj:`AssignResult`: The assigned result.
+        """
+        assigned_labels = torch.full_like(assigned_gt_inds, -1)
+        pos_inds = assigned_gt_inds > 0
+        assigned_labels[pos_inds] = gt_labels[assigned_gt_inds[pos_inds] - 1].long()
+        return AssignResult(
+            gt_labels.size(0), assigned_gt_inds, None, labels=assigned_labels)
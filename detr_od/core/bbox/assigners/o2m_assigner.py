@@ -11,6 +11,7 @@ from mmdet.core.bbox.assigners.assign_result import AssignResult
 from mmdet.core.bbox.assigners.base_assigner import BaseAssigner
 
 from detr_ssod.utils import log_every_n, log_image_with_boxes
+from ..match_costs.fused_cost import fused_match_cost
 from .o2m_assign_result import O2MAssignResult
 
 
@@ -106,10 +107,11 @@ class O2MAssigner(BaseAssigner):
                                        img_h]).unsqueeze(0)
 
         # 计算predict box与gt box之间的alignment metric
-        pred_bboxes = bbox_cxcywh_to_xyxy(bbox_pred) * factor       # [num_bbox,]
-        scores = cls_pred                                           # [num_bbox, 80]
-        overlaps = bbox_overlaps(pred_bboxes, gt_bboxes).detach()   # [num_bbox, num_gt]
-        bbox_scores = scores[:, gt_labels].detach()
+        # the iou and the gt class scores from the fused cost pass, no cost needed
+        _, overlaps, bbox_scores = fused_match_cost(                # [num_bbox, num_gt]
+            bbox_pred, cls_pred, gt_bboxes, gt_labels, factor.squeeze(0),
+            cls_weight=0, reg_weight=0, iou_weight=0, iou_mode='iou',
+            use_sigmoid=False, return_overlaps=True)
         alignment_metrics = bbox_scores ** alpha * overlaps ** beta # [num_bbox, num_gt]
 
         # the top-k aligned predicted candidate boxes as the potential positive samples
@@ -124,19 +126,17 @@ class O2MAssigner(BaseAssigner):
 
         if teacher_assign and multiple_pos:
             # option-2: dynamic estimate the positive samples for contrastive
-            is_pos = torch.zeros_like(candidate_metrics)
             topk_ious, _ = torch.topk(overlaps, self.candidate_topk, dim=0) # [top-k, num_gt]
             dynamic_ks = torch.clamp(topk_ious.sum(0).int(), min=1)
-            for gt_idx in range(num_gts):
-                _, pos_idx = torch.topk(candidate_metrics[:, gt_idx], k=dynamic_ks[gt_idx].item(), largest=True)
-                is_pos[:, gt_idx][pos_idx] = 1 
-            is_pos = is_pos.bool()
+            # the candidates are sorted by the metric, keep the first k of each gt
+            candidate_ranks = torch.arange(candidate_metrics.size(0), device=candidate_metrics.device)
+            is_pos = candidate_ranks[:, None] < dynamic_ks[None, :]
         else:
             is_pos = candidate_metrics > 0
 
         # modify the index
-        for gt_idx in range(num_gts):
-            candidate_idxs[:, gt_idx] += gt_idx * num_bboxes
+        candidate_idxs = candidate_idxs + torch.arange(
+            num_gts, device=candidate_idxs.device)[None, :] * num_bboxes
         candidate_idxs = candidate_idxs.view(-1)
 
         # deal with a single candidate assigned to multiple gt_bboxes
@@ -169,5 +169,38 @@ class O2MAssigner(BaseAssigner):
         return O2MAssignResult(
             num_gts, assigned_gt_inds, max_overlaps, assign_metrics, labels=assigned_labels)
 
+    @staticmethod
+    def normalize_alignment_metrics(assign_metrics, assign_ious, pos_inds,
+                                    pos_assigned_gt_inds, num_gts):
+        """Normalize the alignment metrics of the positive samples per gt,
+        so that the largest one of each gt equals the largest IoU of its
+        samples.
+
+        Args:
+            assign_metrics (Tensor): [num_bbox], the alignment metrics.
+            assign_ious (Tensor): [num_bbox], the IoU with the assigned gt,
+                0 for the negative samples.
+            pos_inds (Tensor): [num_pos], the positive samples.
+            pos_assigned_gt_inds (Tensor): [num_pos], their gt indices.
+            num_gts (int): number of gts.
+
+        Returns:
+            Tensor: [num_bbox], the normalized metrics, 0 for the negatives.
+        """
+        norm_alignment_metrics = assign_metrics.new_zeros(assign_metrics.shape)
+        if pos_inds.numel() == 0:
+            return norm_alignment_metrics
+        pos_alignment_metrics = assign_metrics[pos_inds]
+        pos_ious = assign_ious[pos_inds]
+        # segment max per gt, the metrics and ious are non-negative so the
+        # zeros of the [num_pos, num_gt] scatter do not change the max
+        gt_max = pos_alignment_metrics.new_zeros((2, pos_inds.numel(), num_gts))
+        gt_max[0].scatter_(1, pos_assigned_gt_inds[:, None], pos_alignment_metrics[:, None])
+        gt_max[1].scatter_(1, pos_assigned_gt_inds[:, None], pos_ious[:, None])
+        max_metrics, max_ious = gt_max.max(dim=1)[0]
+        norm_alignment_metrics[pos_inds] = pos_alignment_metrics / (
+            max_metrics[pos_assigned_gt_inds] + 10e-8) * max_ious[pos_assigned_gt_inds]
+        return norm_alignment_metrics
+
     
     
\ No newline at end of file
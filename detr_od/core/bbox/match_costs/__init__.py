@@ -1,4 +1,5 @@
 from .match_cost import SoftmaxFocalLossCost, SoftFocalLossCost
+from .fused_cost import fused_match_cost
 __all__ = [
-    'SoftmaxFocalLossCost', 'SoftFocalLossCost'
-]
\ No newline at end of file
+    'SoftmaxFocalLossCost', 'SoftFocalLossCost', 'fused_match_cost'
+]
@@ -0,0 +1,104 @@
+import torch
+
+from mmdet.core.bbox.transforms import bbox_cxcywh_to_xyxy, bbox_xyxy_to_cxcywh
+
+
+@torch.no_grad()
+def fused_match_cost(bbox_pred,
+                     cls_pred,
+                     gt_bboxes,
+                     gt_labels,
+                     factor,
+                     cls_weight=1.,
+                     reg_weight=1.,
+                     iou_weight=1.,
+                     alpha=0.25,
+                     gamma=2.,
+                     iou_mode='giou',
+                     use_sigmoid=True,
+                     eps=1e-12,
+                     return_overlaps=False):
+    """Weighted sum of the focal, L1 and IoU matching costs in one pass.
+
+    Gives the same total as `FocalLossCost` + `BBoxL1Cost(box_format='xywh')`
+    + `IoUCost`. Each box is converted once, the pairwise terms are computed
+    coordinate-wise from [*, num_query, 1] and [*, 1, num_gt] views and
+    accumulated in place into one [*, num_query, num_gt] cost, the focal cost
+    is only computed for the gt classes. A zero weight skips its term. The
+    leading dims are broadcast, e.g. the outputs of all the decoder layers
+    against the gts of their images padded to the same number.
+
+    Args:
+        bbox_pred (Tensor): Predicted boxes with normalized coordinates
+            (cx, cy, w, h). Shape [*, num_query, 4].
+        cls_pred (Tensor): Predicted classification logits, or scores if
+            `use_sigmoid` is False. Shape [*, num_query, num_class].
+        gt_bboxes (Tensor): Ground truth boxes with unnormalized coordinates
+            (x1, y1, x2, y2). Shape [*, num_gt, 4].
+        gt_labels (Tensor): Label of `gt_bboxes`, shape [*, num_gt].
+        factor (Tensor): (w, h, w, h) of the images, shape [*, 4].
+        cls_weight (float): weight of the focal cost. Default: 1.
+        reg_weight (float): weight of the L1 cost. Default: 1.
+        iou_weight (float): weight of the IoU cost. Default: 1.
+        alpha (float): focal cost alpha. Default: 0.25.
+        gamma (float): focal cost gamma. Default: 2.
+        iou_mode (str): 'iou' or 'giou'. Default: 'giou'.
+        use_sigmoid (bool): whether `cls_pred` are logits. Default: True.
+        eps (float): focal cost eps. Default: 1e-12.
+        return_overlaps (bool): also return the IoU and the class scores of
+            the gts. Default: False.
+
+    Returns:
+        Tensor | tuple[Tensor]: the cost [*, num_query, num_gt], and if
+            `return_overlaps` the IoU and the scores of the same shape.
+    """
+    assert iou_mode in ('iou', 'giou')
+    num_query, num_gt = bbox_pred.size(-2), gt_bboxes.size(-2)
+    batch_shape = torch.broadcast_shapes(
+        bbox_pred.shape[:-2], cls_pred.shape[:-2], gt_bboxes.shape[:-2])
+    factor = factor.unsqueeze(-2)
+
+    # the box conversions, once per box
+    pred_cxcywh = bbox_pred.unsqueeze(-2).unbind(-1)                    # [*, num_query, 1] x 4
+    pred_xyxy = (bbox_cxcywh_to_xyxy(bbox_pred) * factor).unsqueeze(-2).unbind(-1)
+    gt_cxcywh = bbox_xyxy_to_cxcywh(gt_bboxes / factor).unsqueeze(-3).unbind(-1)
+    gt_xyxy = gt_bboxes.unsqueeze(-3).unbind(-1)                        # [*, 1, num_gt] x 4
+
+    # the class scores of the gts only
+    labels = gt_labels.long().unsqueeze(-2).expand(*batch_shape, num_query, num_gt)
+    scores = cls_pred.expand(*batch_shape, *cls_pred.shape[-2:]).gather(-1, labels)
+    if use_sigmoid:
+        scores = scores.sigmoid()
+
+    if cls_weight:
+        cost = (scores + eps).log_().mul_(-alpha).mul_((1 - scores).pow_(gamma))
+        cost.sub_((1 - scores + eps).log_().mul_(-(1 - alpha)).mul_(scores.pow(gamma)))
+        cost.mul_(cls_weight)
+    else:
+        cost = scores.new_zeros((*batch_shape, num_query, num_gt))
+
+    if reg_weight:
+        for pred_coord, gt_coord in zip(pred_cxcywh, gt_cxcywh):
+            cost.add_((pred_coord - gt_coord).abs_().mul_(reg_weight))
+
+    if iou_weight or return_overlaps:
+        pred_x1, pred_y1, pred_x2, pred_y2 = pred_xyxy
+        gt_x1, gt_y1, gt_x2, gt_y2 = gt_xyxy
+        overlap = (torch.min(pred_x2, gt_x2) - torch.max(pred_x1, gt_x1)).clamp_(min=0)
+        overlap.mul_((torch.min(pred_y2, gt_y2) - torch.max(pred_y1, gt_y1)).clamp_(min=0))
+        union = ((pred_x2 - pred_x1) * (pred_y2 - pred_y1)
+                 + (gt_x2 - gt_x1) * (gt_y2 - gt_y1)).sub_(overlap).clamp_(min=1e-6)
+        ious = overlap.div_(union)
+        if iou_weight and iou_mode == 'giou':
+            enclose_area = (torch.max(pred_x2, gt_x2) - torch.min(pred_x1, gt_x1)).clamp_(min=0)
+            enclose_area.mul_((torch.max(pred_y2, gt_y2) - torch.min(pred_y1, gt_y1)).clamp_(min=0))
+            enclose_area.clamp_(min=1e-6)
+            # cost -= giou * weight, giou = iou - (enclose - union) / enclose
+            cost.sub_(ious, alpha=iou_weight)
+            cost.add_(enclose_area.sub(union).div_(enclose_area), alpha=iou_weight)
+        elif iou_weight:
+            cost.sub_(ious, alpha=iou_weight)
+
+    if return_overlaps:
+        return cost, ious, scores
+    return cost
@@ -0,0 +1,3 @@
+from .dist_utils import reduce_mean_bucketed
+
+__all__ = ['reduce_mean_bucketed']
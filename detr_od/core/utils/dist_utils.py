@@ -0,0 +1,27 @@
+import torch
+import torch.distributed as dist
+
+
+def reduce_mean_bucketed(tensors):
+    """`reduce_mean` of several tensors with a single all_reduce.
+
+    The tensors are flattened into one buffer, which is averaged across
+    gpus at once and split back, so each result is exactly the one
+    `reduce_mean` gives for it alone.
+
+    Args:
+        tensors (Sequence[Tensor]): tensors of the same dtype and device,
+            of any shape.
+
+    Returns:
+        list[Tensor]: the averaged tensors, in the input order and shapes.
+    """
+    tensors = list(tensors)
+    if not tensors or not (dist.is_available() and dist.is_initialized()):
+        return tensors
+    bucket = torch.cat([tensor.reshape(-1) for tensor in tensors])
+    dist.all_reduce(bucket.div_(dist.get_world_size()), op=dist.ReduceOp.SUM)
+    return [
+        chunk.view_as(tensor) for chunk, tensor in zip(
+            bucket.split([tensor.numel() for tensor in tensors]), tensors)
+    ]
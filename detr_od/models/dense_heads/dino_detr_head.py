@@ -19,6 +19,7 @@ from mmdet.models.utils.transformer import inverse_sigmoid
 from  mmdet.models.dense_heads.anchor_free_head import AnchorFreeHead
 
 
+from ..utils.static_shape import get_img_masks
 from .dn_components import *
 
 class MLP(nn.Module):
@@ -316,15 +317,18 @@ class DINODETRHead(AnchorFreeHead):
                       input_query_label=None, 
                       input_query_bbox=None, 
                       attn_mask=None, 
-                      dn_meta=None):
+                      dn_meta=None, 
+                      early_exit=None, 
+                      num_queries=None,
+                      img_masks=None,
+                      return_aux_losses=False):
+        """img_masks: [bs, h, w] padding masks, built from `img_metas` if
+        not given (the static-shape mode passes them in).
+        return_aux_losses: also return the dict of the saliency and
+        objectness losses of this forward, for `forward_train`."""
         # breakpoint()
-        batch_size = mlvl_feats[0].size(0)
-        input_img_h, input_img_w = img_metas[0]['batch_input_shape']
-        img_masks = mlvl_feats[0].new_ones(
-            (batch_size, input_img_h, input_img_w))
-        for img_id in range(batch_size):
-            img_h, img_w, _ = img_metas[img_id]['img_shape']
-            img_masks[img_id, :img_h, :img_w] = 0
+        if img_masks is None:
+            img_masks = get_img_masks(img_metas, mlvl_feats[0])
         
         srcs = []
         mlvl_masks = []
@@ -351,14 +355,15 @@ class DINODETRHead(AnchorFreeHead):
         # reference: list with each has the shape of [bs, pad_size + num_query, 4], 
         # hs_enc: list with each has the shape of [bs, num_query, embed_dim], length 1
         # ref_enc: list with each has the shape of [bs, num_query, 4], length 1
-        hs, reference, hs_enc, ref_enc, init_box_proposal = self.transformer(srcs, \
+        hs, reference, hs_enc, ref_enc, init_box_proposal, aux_losses = self.transformer(srcs, \
                                                                              mlvl_masks, \
                                                                              input_query_bbox, \
                                                                              mlvl_positional_encodings, \
                                                                              input_query_label,\
                                                                              attn_mask,\
                                                                              fc_reg=self.fc_reg, fc_cls=self.fc_cls,\
-                                                                             fc_enc_reg=self.fc_enc_reg, fc_enc_cls=self.fc_enc_cls)
+                                                                             fc_enc_reg=self.fc_enc_reg, fc_enc_cls=self.fc_enc_cls,\
+                                                                             early_exit=early_exit, num_queries=num_queries)
         # In case num object=0
         # hs: [num_dec_layer, bs, num_query + dn_size, embed_dim]
         # label_enc: [num_class + 1, embed_dim]
@@ -404,7 +409,10 @@ class DINODETRHead(AnchorFreeHead):
         else:
             dn_outputs_class, dn_outputs_coord = None, None
 
-        return outputs_class, outputs_coord, interm_outputs_class, interm_outputs_coord, dn_outputs_class, dn_outputs_coord
+        outs = (outputs_class, outputs_coord, interm_outputs_class, interm_outputs_coord, dn_outputs_class, dn_outputs_coord)
+        if return_aux_losses:
+            return outs, aux_losses
+        return outs
 
     def forward_dummy(self, mlvl_feats, 
                       img_metas,  
@@ -447,7 +455,7 @@ class DINODETRHead(AnchorFreeHead):
         # reference: list with each has the shape of [bs, pad_size + num_query, 4], 
         # hs_enc: list with each has the shape of [bs, num_query, embed_dim], length 1
         # ref_enc: list with each has the shape of [bs, num_query, 4], length 1
-        hs, reference, hs_enc, ref_enc, init_box_proposal = self.transformer(srcs, \
+        hs, reference, hs_enc, ref_enc, init_box_proposal, aux_losses = self.transformer(srcs, \
                                                                              mlvl_masks, \
                                                                              input_query_bbox, \
                                                                              mlvl_positional_encodings, \
@@ -553,11 +561,11 @@ class DINODETRHead(AnchorFreeHead):
         if dn_cls_scores is None or dn_bbox_preds is None:
             # in case there is no dn_part
             # import ipdb; ipdb.set_trace()
-            dn_losses_cls = [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
-            dn_losses_bbox =  [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
-            dn_losses_iou =  [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
-            dn_losses_bbox_xy =  [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
-            dn_losses_bbox_hw = [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
+            dn_losses_cls = [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+            dn_losses_bbox =  [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+            dn_losses_iou =  [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+            dn_losses_bbox_xy =  [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+            dn_losses_bbox_hw = [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
         else:
             # import ipdb; ipdb.set_trace()
             dn_losses_cls, dn_losses_bbox, dn_losses_iou, dn_losses_bbox_xy, dn_losses_bbox_hw = multi_apply(
@@ -771,16 +779,16 @@ class DINODETRHead(AnchorFreeHead):
 
         if len(gt_labels) > 0:
             # gt_labels: cls labels for a single image [num_gt,]
-            t = torch.arange(0, len(gt_labels)).long().cuda()    # 注意: torch.range(a, b)会包含b
+            t = torch.arange(0, len(gt_labels), device=bbox_pred.device)    # 注意: torch.range(a, b)会包含b
             t = t.unsqueeze(0).repeat(scalar, 1)
             tgt_idx = t.flatten()       # tgt_idx: [num_gt x dn_groups] from the padding_size = single_pad x dn_groups
             # output_idx相当于是正样本的索引即: pos_inds, 在一张图片里面的索引，因为一张图片padding后的query数量
             # 是padding size，这个相当于在padding size中的索引
             # tgt_idx相当于是正样本对应的gt的索引即: assigned_gt_inds，还不是对应的gt_labels
-            output_idx = (torch.tensor(range(scalar)) * single_pad).long().cuda().unsqueeze(1) + t
+            output_idx = (torch.arange(scalar, device=bbox_pred.device) * single_pad).unsqueeze(1) + t
             output_idx = output_idx.flatten()
         else:
-            output_idx = tgt_idx = torch.tensor([]).long().cuda()
+            output_idx = tgt_idx = torch.tensor([], dtype=torch.long, device=bbox_pred.device)
 
         
         # 每个gt_labels的一个dn_groups中，前single_pad // 2 是正样本，后single_pad // 2是负样本
@@ -1037,12 +1045,16 @@ class DINODETRHead(AnchorFreeHead):
 
         assert proposal_cfg is None, '"proposal_cfg" must be None'
         # change the forward method's parameter
-        outs = self(x, img_metas, input_query_label, input_query_bbox, attn_mask, dn_meta)
+        outs, aux_losses = self(x, img_metas, input_query_label, input_query_bbox, attn_mask, dn_meta,
+                                img_masks=kwargs.get('img_masks'), return_aux_losses=True)
         # breakpoint()
         # TODO: when calculate the loss, need consider the dn part loss seperately
       
         loss_inputs = outs + (gt_bboxes, gt_labels)
         losses = self.loss(*loss_inputs, img_metas=img_metas, dn_metas=dn_meta, gt_bboxes_ignore=gt_bboxes_ignore)
+        # saliency loss of the sparse encoder and objectness loss of the
+        # two-stage prefilter, if enabled
+        losses.update(aux_losses)
         return losses
 
     @force_fp32(apply_to=('all_cls_scores_list', 'all_bbox_preds_list'))
@@ -1130,13 +1142,13 @@ class DINODETRHead(AnchorFreeHead):
         # exclude background
         if self.loss_cls.use_sigmoid:
             cls_score = cls_score.sigmoid()
-            scores, indexes = cls_score.view(-1).topk(max_per_img)
+            scores, indexes = cls_score.view(-1).topk(min(max_per_img, cls_score.numel()))
             det_labels = indexes % self.num_classes
             bbox_index = indexes // self.num_classes
             bbox_pred = bbox_pred[bbox_index]
         else:
             scores, det_labels = F.softmax(cls_score, dim=-1)[..., :-1].max(-1)
-            scores, bbox_index = scores.topk(max_per_img)
+            scores, bbox_index = scores.topk(min(max_per_img, scores.numel()))
             bbox_pred = bbox_pred[bbox_index]
             det_labels = det_labels[bbox_index]
 
@@ -1151,7 +1163,7 @@ class DINODETRHead(AnchorFreeHead):
 
         return det_bboxes, det_labels
 
-    def simple_test_bboxes(self, feats, img_metas, rescale=False):
+    def simple_test_bboxes(self, feats, img_metas, rescale=False, num_queries=None):
         """Test det bboxes without test-time augmentation.
 
         Args:
@@ -1160,6 +1172,9 @@ class DINODETRHead(AnchorFreeHead):
             img_metas (list[dict]): List of image information.
             rescale (bool, optional): Whether to rescale the results.
                 Defaults to False.
+            num_queries (int, optional): Query budget of this call, narrows
+                the two-stage top-k selection and the decoder workload.
+                Defaults to None, i.e. the num_query of the model.
 
         Returns:
             list[tuple[Tensor, Tensor]]: Each item in result_list is 2-tuple.
@@ -1169,7 +1184,8 @@ class DINODETRHead(AnchorFreeHead):
                 with shape (n,)
         """
         # forward of this head requires img_metas
-        outs = self.forward(feats, img_metas)
+        outs = self.forward(feats, img_metas, early_exit=self.test_cfg.get('early_exit', None),
+                            num_queries=num_queries)
         results_list = self.get_bboxes(*outs, img_metas, rescale=rescale)
         return results_list
 
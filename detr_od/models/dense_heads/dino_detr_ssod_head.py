@@ -12,7 +12,7 @@ from mmcv.runner import force_fp32
 
 from mmdet.core import (bbox_cxcywh_to_xyxy, bbox_xyxy_to_cxcywh,
                         build_assigner, build_sampler, multi_apply,
-                        reduce_mean, multiclass_nms)
+                        multiclass_nms)
 from mmdet.models.utils import build_transformer
 from mmdet.models.builder import HEADS, build_loss
 from mmdet.models.utils.transformer import inverse_sigmoid
@@ -21,6 +21,8 @@ from  mmdet.models.dense_heads.anchor_free_head import AnchorFreeHead
 
 
 # from .dn_components import prepare_for_cdn_plus, dn_post_process_plus
+from ...core.utils import reduce_mean_bucketed
+from ..utils.static_shape import get_img_masks
 from .dn_components import *
 
 
@@ -89,6 +91,10 @@ class DINODETRSSODHead(AnchorFreeHead):
                  dn_box_noise_scale = 0.4,
                  dn_label_noise_ratio = 0.5,
                  dn_labelbook_size = 81,
+                 dn_pad_sizes=None,
+                 stacked_loss=False,
+                 layer_loss_weights=None,
+                 sync_free_loss=False,
                  query_dim=2,
                  dec_pred_class_embed_share=True,
                  dec_pred_bbox_embed_share=True,
@@ -214,6 +220,16 @@ class DINODETRSSODHead(AnchorFreeHead):
         self.dn_box_noise_scale = dn_box_noise_scale
         self.dn_label_noise_ratio = dn_label_noise_ratio
         self.dn_labelbook_size = dn_labelbook_size
+        # static-shape mode: round the dn pad up to fixed sizes
+        self.dn_pad_sizes = dn_pad_sizes
+
+        # compute the losses of all decoder layers in one batched call after
+        # the warm-up, the weights scale the losses of each decoder layer
+        self.stacked_loss = stacked_loss
+        self.layer_loss_weights = layer_loss_weights
+        # keep the avg factors on device and mask the empty targets instead
+        # of checking them on the host, the assignment still syncs
+        self.sync_free_loss = sync_free_loss
 
         if self.loss_cls2.use_sigmoid:
             self.cls_out_channels = num_classes
@@ -345,16 +361,19 @@ class DINODETRSSODHead(AnchorFreeHead):
                       input_query_label=None, 
                       input_query_bbox=None, 
                       attn_mask=None, 
-                      dn_meta=None):
+                      dn_meta=None, 
+                      early_exit=None, 
+                      num_queries=None,
+                      img_masks=None,
+                      return_aux_losses=False):
+        """img_masks: [bs, h, w] padding masks, built from `img_metas` if
+        not given (the static-shape mode passes them in).
+        return_aux_losses: also return the dict of the saliency and
+        objectness losses of this forward, for `forward_train`."""
         # import ipdb;ipdb.set_trace()
         
-        batch_size = mlvl_feats[0].size(0)
-        input_img_h, input_img_w = img_metas[0]['batch_input_shape']
-        img_masks = mlvl_feats[0].new_ones(
-            (batch_size, input_img_h, input_img_w))
-        for img_id in range(batch_size):
-            img_h, img_w, _ = img_metas[img_id]['img_shape']
-            img_masks[img_id, :img_h, :img_w] = 0
+        if img_masks is None:
+            img_masks = get_img_masks(img_metas, mlvl_feats[0])
         
         srcs = []
         mlvl_masks = []
@@ -377,14 +396,15 @@ class DINODETRSSODHead(AnchorFreeHead):
                 mlvl_positional_encodings.append(self.positional_encoding(mlvl_masks[-1]))
         
      
-        hs, reference, hs_enc, ref_enc, init_box_proposal = self.transformer(srcs, \
+        hs, reference, hs_enc, ref_enc, init_box_proposal, aux_losses = self.transformer(srcs, \
                                                                              mlvl_masks, \
                                                                              input_query_bbox, \
                                                                              mlvl_positional_encodings, \
                                                                              input_query_label,\
                                                                              attn_mask,\
                                                                              fc_reg=self.fc_reg, fc_cls=self.fc_cls,\
-                                                                             fc_enc_reg=self.fc_enc_reg, fc_enc_cls=self.fc_enc_cls)
+                                                                             fc_enc_reg=self.fc_enc_reg, fc_enc_cls=self.fc_enc_cls,\
+                                                                             early_exit=early_exit, num_queries=num_queries)
      
         hs[0] += self.label_enc.weight[0, 0] * 0.0
 
@@ -415,23 +435,20 @@ class DINODETRSSODHead(AnchorFreeHead):
             # When test, there is no dn_part
             dn_outputs_class, dn_outputs_coord = None, None
 
-        return outputs_class, outputs_coord, interm_outputs_class, interm_outputs_coord, dn_outputs_class, dn_outputs_coord
+        outs = (outputs_class, outputs_coord, interm_outputs_class, interm_outputs_coord, dn_outputs_class, dn_outputs_coord)
+        if return_aux_losses:
+            return outs, aux_losses
+        return outs
 
     def forward_dummy(self, mlvl_feats,
                       img_metas,
                       input_query_label=None,
                       input_query_bbox=None,
                       attn_mask=None,
-                      dn_meta=None):
-        # breakpoint()
-        # import ipdb;ipdb.set_trace()
-        batch_size = mlvl_feats[0].size(0)
-        input_img_h, input_img_w = img_metas[0]['batch_input_shape']
-        img_masks = mlvl_feats[0].new_ones(
-            (batch_size, input_img_h, input_img_w))
-        for img_id in range(batch_size):
-            img_h, img_w, _ = img_metas[img_id]['img_shape']
-            img_masks[img_id, :img_h, :img_w] = 0
+                      dn_meta=None,
+                      img_masks=None):
+        if img_masks is None:
+            img_masks = get_img_masks(img_metas, mlvl_feats[0])
         
         srcs = []
         mlvl_masks = []
@@ -454,7 +471,7 @@ class DINODETRSSODHead(AnchorFreeHead):
                 mlvl_positional_encodings.append(self.positional_encoding(mlvl_masks[-1]))
         
     
-        hs, reference, hs_enc, ref_enc, init_box_proposal = self.transformer(srcs, \
+        hs, reference, hs_enc, ref_enc, init_box_proposal, aux_losses = self.transformer(srcs, \
                                                                              mlvl_masks, \
                                                                              input_query_bbox, \
                                                                              mlvl_positional_encodings, \
@@ -537,41 +554,105 @@ class DINODETRSSODHead(AnchorFreeHead):
       
         num_imgs = len(gt_bboxes_list)
         dn_metas_valid = [dn_metas for i in range(num_imgs)]
-        dn_metas_list = [dn_metas_valid for _ in range(num_dec_layers)]
+
+        # one-to-one matching of all decoder layers and images at once,
+        # [num_dec_layer, bs, num_query]
+        all_assigned_gt_inds = [None for _ in range(num_dec_layers)]
+        if not self.in_warm_up and hasattr(self.assigner2, 'assign_batched'):
+            all_assigned_gt_inds = self.assigner2.assign_batched(
+                all_bbox_preds, all_cls_scores, gt_bboxes_list, gt_labels_list, img_metas)
 
         # regression and classification loss of head
         # use the gt_scores_list to make sure whether it's pseudo label or not
-        losses_cls, losses_bbox, losses_iou, losses_bbox_xy, losses_bbox_hw  = multi_apply(
-            self.loss_single, all_cls_scores, all_bbox_preds,
-            all_gt_bboxes_list, all_gt_labels_list, all_gt_scores_list,
-            img_metas_list, all_gt_bboxes_ignore_list)
+        use_stacked_loss = self.stacked_loss and torch.is_tensor(all_assigned_gt_inds)
+        if use_stacked_loss:
+            # the targets of the decoder, dn and encoder losses first, so that
+            # all their avg factors are reduced across gpus at once
+            stacked_targets = dict(
+                dec=self.get_targets_stacked(all_assigned_gt_inds, gt_bboxes_list, gt_labels_list, img_metas),
+                dn=self.get_targets_dn_stacked(dn_cls_scores[0], dn_bbox_preds[0], gt_bboxes_list,
+                                               gt_labels_list, img_metas, dn_metas_valid,
+                                               is_pseudo_label=is_pseudo_label))
+            if enc_cls_scores is not None:
+                binary_labels_list = [torch.zeros_like(gt_labels) for gt_labels in gt_labels_list]
+                enc_assigned_gt_inds = self.assigner2.assign_batched(
+                    enc_bbox_preds[None], enc_cls_scores[None], gt_bboxes_list, binary_labels_list, img_metas)
+                stacked_targets['enc'] = self.get_targets_stacked(
+                    enc_assigned_gt_inds, gt_bboxes_list, binary_labels_list, img_metas)
+            avg_factors = self.reduce_avg_factors([targets[4:] for targets in stacked_targets.values()])
+            stacked_targets = {
+                name: targets[:4] + avg_factor
+                for (name, targets), avg_factor in zip(stacked_targets.items(), avg_factors)}
+
+            losses_cls, losses_bbox, losses_iou, losses_bbox_xy, losses_bbox_hw = self.loss_stacked(
+                all_cls_scores, all_bbox_preds, img_metas, *stacked_targets['dec'])
+        else:
+            # the same for the targets of each layer, one by one, in the
+            # warm-up or without a batched assignment
+            layer_targets, layer_avg_factors = multi_apply(
+                self.get_targets_single, all_cls_scores, all_bbox_preds,
+                all_gt_bboxes_list, all_gt_labels_list, all_gt_scores_list,
+                img_metas_list, all_gt_bboxes_ignore_list, all_assigned_gt_inds)
+            single_targets = dict()
+            if not (self.in_warm_up and is_pseudo_label):
+                # the dn targets are the same for all decoder layers
+                single_targets['dn'] = self.get_targets_single_dn(
+                    dn_cls_scores[0], dn_bbox_preds[0], gt_bboxes_list, gt_labels_list,
+                    img_metas, dn_metas_valid, is_pseudo_label=is_pseudo_label)
+            if enc_cls_scores is not None:
+                binary_labels_list = [torch.zeros_like(gt_labels) for gt_labels in gt_labels_list]
+                single_targets['enc'] = self.get_targets_single(
+                    enc_cls_scores, enc_bbox_preds, gt_bboxes_list, binary_labels_list,
+                    gt_scores_list, img_metas, gt_bboxes_ignore)
+            avg_factors = self.reduce_avg_factors(
+                layer_avg_factors + [avg_factor for _, avg_factor in single_targets.values()])
+            single_targets = {
+                name: (targets, avg_factor)
+                for (name, (targets, _)), avg_factor in zip(
+                    single_targets.items(), avg_factors[num_dec_layers:])}
+
+            losses_cls, losses_bbox, losses_iou, losses_bbox_xy, losses_bbox_hw  = multi_apply(
+                self.loss_single_targets, all_cls_scores, all_bbox_preds, img_metas_list,
+                layer_targets, avg_factors[:num_dec_layers])
 
         # import ipdb; ipdb.set_trace()
         if self.in_warm_up and is_pseudo_label:
-            dn_losses_cls = [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
-            dn_losses_bbox =  [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
-            dn_losses_iou =  [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
-            dn_losses_bbox_xy =  [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
-            dn_losses_bbox_hw = [torch.as_tensor(0.).to('cuda') for i in range(num_dec_layers)]
+            dn_losses_cls = [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+            dn_losses_bbox =  [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+            dn_losses_iou =  [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+            dn_losses_bbox_xy =  [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+            dn_losses_bbox_hw = [all_cls_scores.new_zeros(()) for i in range(num_dec_layers)]
+        elif use_stacked_loss:
+            # the dn targets are the same for all decoder layers
+            dn_losses_cls, dn_losses_bbox, dn_losses_iou, dn_losses_bbox_xy, dn_losses_bbox_hw = self.loss_stacked(
+                dn_cls_scores, dn_bbox_preds, img_metas, *stacked_targets['dn'])
         else:
+            dn_targets, dn_avg_factors = single_targets['dn']
             dn_losses_cls, dn_losses_bbox, dn_losses_iou, dn_losses_bbox_xy, dn_losses_bbox_hw = multi_apply(
-                self.loss_single_dn, dn_cls_scores, dn_bbox_preds,
-                all_gt_bboxes_list, all_gt_labels_list, all_gt_scores_list,
-                img_metas_list, dn_metas_list, all_gt_bboxes_ignore_list, is_pseudo_label=is_pseudo_label)
+                self.loss_one_to_one, dn_cls_scores, dn_bbox_preds, img_metas_list,
+                targets=dn_targets, avg_factors=dn_avg_factors)
+
+        if self.layer_loss_weights is not None:
+            assert len(self.layer_loss_weights) == num_dec_layers
+            (losses_cls, losses_bbox, losses_iou, losses_bbox_xy, losses_bbox_hw,
+             dn_losses_cls, dn_losses_bbox, dn_losses_iou, dn_losses_bbox_xy, dn_losses_bbox_hw) = [
+                [layer_loss * weight for layer_loss, weight in zip(layer_losses, self.layer_loss_weights)]
+                for layer_losses in (losses_cls, losses_bbox, losses_iou, losses_bbox_xy, losses_bbox_hw,
+                                     dn_losses_cls, dn_losses_bbox, dn_losses_iou, dn_losses_bbox_xy,
+                                     dn_losses_bbox_hw)]
      
 
         loss_dict = dict()
         
         # loss of proposal generated from encode feature map.
-        if enc_cls_scores is not None:
-            binary_labels_list = [
-                torch.zeros_like(gt_labels_list[i])
-                for i in range(len(img_metas))
-            ]
+        if enc_cls_scores is not None and use_stacked_loss:
+            enc_loss_cls, enc_loss_bbox, enc_loss_iou, enc_loss_bbox_xy, enc_loss_bbox_hw = [
+                enc_losses[0] for enc_losses in self.loss_stacked(
+                    enc_cls_scores[None], enc_bbox_preds[None], img_metas, *stacked_targets['enc'])]
+        elif enc_cls_scores is not None:
             enc_loss_cls, enc_loss_bbox, enc_loss_iou, enc_loss_bbox_xy, enc_loss_bbox_hw = \
-                self.loss_single(enc_cls_scores, enc_bbox_preds,
-                                 gt_bboxes_list, binary_labels_list, gt_scores_list,
-                                 img_metas, gt_bboxes_ignore)
+                self.loss_single_targets(enc_cls_scores, enc_bbox_preds, img_metas, *single_targets['enc'])
+        if enc_cls_scores is not None:
             loss_dict['enc_loss_cls'] = enc_loss_cls
             loss_dict['enc_loss_bbox'] = enc_loss_bbox
             loss_dict['enc_loss_iou'] = enc_loss_iou
@@ -623,6 +704,191 @@ class DINODETRSSODHead(AnchorFreeHead):
             num_dec_layer += 1
         return loss_dict
 
+    def get_targets_stacked(self, all_assigned_gt_inds, gt_bboxes_list, gt_labels_list, img_metas):
+        """Targets of all decoder layers from the packed one-to-one assignment.
+
+        Args:
+            all_assigned_gt_inds (Tensor): [num_dec_layer, bs, num_query], the
+                assignment of `assign_batched`.
+            gt_bboxes_list (list[Tensor]): Ground truth bboxes for each image.
+            gt_labels_list (list[Tensor]): Ground truth labels for each image.
+            img_metas (list[dict]): List of image meta information.
+
+        Returns:
+            tuple: labels, label_weights [num_dec_layer, bs, num_query],
+                bbox_targets, bbox_weights [num_dec_layer, bs, num_query, 4],
+                the cls avg factor and the number of positives of this gpu
+                [num_dec_layer], to be reduced by `reduce_avg_factors`.
+        """
+        num_imgs, num_query = all_assigned_gt_inds.shape[1:]
+        max_num_gts = max(max(gt_bboxes.size(0) for gt_bboxes in gt_bboxes_list), 1)
+        # the gts of each image padded to the same number, normalized cxcywh
+        gt_targets = all_assigned_gt_inds.new_zeros((num_imgs, max_num_gts, 4), dtype=torch.float)
+        gt_labels = all_assigned_gt_inds.new_full((num_imgs, max_num_gts), self.num_classes)
+        for img_id, (gt_bboxes, img_meta) in enumerate(zip(gt_bboxes_list, img_metas)):
+            img_h, img_w, _ = img_meta['img_shape']
+            factor = gt_bboxes.new_tensor([img_w, img_h, img_w, img_h]).unsqueeze(0)
+            gt_targets[img_id, :gt_bboxes.size(0)] = bbox_xyxy_to_cxcywh(gt_bboxes / factor)
+            gt_labels[img_id, :gt_bboxes.size(0)] = gt_labels_list[img_id]
+
+        pos_mask = all_assigned_gt_inds > 0
+        img_inds = torch.arange(num_imgs, device=pos_mask.device)[None, :, None]
+        gt_inds = (all_assigned_gt_inds - 1).clamp(min=0)
+        labels = gt_labels[img_inds, gt_inds].masked_fill(~pos_mask, self.num_classes)
+        label_weights = pos_mask.new_ones(pos_mask.shape, dtype=torch.float)
+        bbox_weights = pos_mask[..., None].expand(*pos_mask.shape, 4).float()
+        bbox_targets = gt_targets[img_inds, gt_inds] * bbox_weights
+
+        # the local avg factors of all layers, see `reduce_avg_factors`
+        num_total_pos = pos_mask.flatten(1).sum(1).float()
+        num_total_neg = num_imgs * num_query - num_total_pos
+        cls_avg_factor = num_total_pos * 1.0 + num_total_neg * self.bg_cls_weight
+        return labels, label_weights, bbox_targets, bbox_weights, cls_avg_factor, num_total_pos
+
+    def get_targets_dn_stacked(self,
+                               cls_scores,
+                               bbox_preds,
+                               gt_bboxes_list,
+                               gt_labels_list,
+                               img_metas,
+                               dn_metas,
+                               is_pseudo_label=False):
+        """The dn targets of `get_targets_dn` in the layout of
+        `get_targets_stacked`, computed once for all decoder layers, with
+        local avg factors of shape [1]."""
+        num_imgs = cls_scores.size(0)
+        (labels_list, label_weights_list, bbox_targets_list, bbox_weights_list,
+         num_total_pos, num_total_neg) = self.get_targets_dn(
+            [cls_scores[i] for i in range(num_imgs)], [bbox_preds[i] for i in range(num_imgs)],
+            gt_bboxes_list, gt_labels_list, img_metas, dn_metas, is_pseudo_label=is_pseudo_label)
+        labels = torch.stack(labels_list)[None]
+        label_weights = torch.stack(label_weights_list)[None]
+        bbox_targets = torch.stack(bbox_targets_list)[None]
+        bbox_weights = torch.stack(bbox_weights_list)[None]
+
+        cls_avg_factor = cls_scores.new_tensor(
+            [num_total_pos * 1.0 + num_total_neg * self.bg_cls_weight], dtype=torch.float)
+        num_total_pos = cls_scores.new_tensor([num_total_pos], dtype=torch.float)
+        return labels, label_weights, bbox_targets, bbox_weights, cls_avg_factor, num_total_pos
+
+    def reduce_avg_factors(self, avg_factors):
+        """Reduce the avg factors of several losses across gpus with a single
+        all_reduce.
+
+        Args:
+            avg_factors (list[tuple[Tensor]]): the local avg factors of each
+                loss, as `get_targets_stacked` and `get_targets_single` give
+                them: the cls avg factor, the reg avg factor and, for the task
+                aligned loss of the warm-up, the sum of the alignment metrics.
+                The cls avg factor is only reduced with `sync_cls_avg_factor`.
+
+        Returns:
+            list[tuple[Tensor]]: the avg factors of each loss in the same
+                layout, clamped to at least 1.
+        """
+        avg_factors = [list(factors) for factors in avg_factors]
+        slots = [(i, j) for i, factors in enumerate(avg_factors)
+                 for j in range(len(factors)) if j > 0 or self.sync_cls_avg_factor]
+        reduced = reduce_mean_bucketed([avg_factors[i][j] for i, j in slots])
+        for (i, j), factor in zip(slots, reduced):
+            avg_factors[i][j] = factor
+        return [tuple(factor.clamp(min=1) for factor in factors) for factors in avg_factors]
+
+    def loss_stacked(self,
+                     all_cls_scores,
+                     all_bbox_preds,
+                     img_metas,
+                     labels,
+                     label_weights,
+                     bbox_targets,
+                     bbox_weights,
+                     cls_avg_factor,
+                     reg_avg_factor):
+        """The DETR-style losses of all decoder layers in one batched call.
+
+        Args:
+            all_cls_scores (Tensor): [num_dec_layer, bs, num_query, cls_out_channels].
+            all_bbox_preds (Tensor): [num_dec_layer, bs, num_query, 4].
+            img_metas (list[dict]): List of image meta information.
+            labels, label_weights (Tensor): [num_dec_layer or 1, bs, num_query].
+            bbox_targets, bbox_weights (Tensor): [num_dec_layer or 1, bs, num_query, 4].
+            cls_avg_factor, reg_avg_factor (Tensor | float): the avg factors,
+                per layer or shared.
+
+        Returns:
+            tuple[list[Tensor]]: the cls, L1, IoU, xy L1 and hw L1 losses of
+                each layer, the same as `loss_single` gives.
+        """
+        num_dec_layers = all_cls_scores.size(0)
+        shape = all_bbox_preds.shape[:3]
+        labels = labels.expand(shape).reshape(-1)
+        label_weights = label_weights.expand(shape).reshape(-1)
+        bbox_targets = bbox_targets.expand(*shape, 4)
+        bbox_weights = bbox_weights.expand(*shape, 4).reshape(-1, 4)
+
+        # classification loss, summed per layer
+        loss_cls = self.loss_cls2(
+            all_cls_scores.reshape(-1, self.cls_out_channels), labels, label_weights,
+            reduction_override='none')
+        loss_cls = loss_cls.view(num_dec_layers, -1).sum(1) / cls_avg_factor
+
+        # construct factors used for rescale bboxes, [1, bs, 1, 4]
+        factors = torch.stack([
+            all_bbox_preds.new_tensor([img_w, img_h, img_w, img_h])
+            for img_h, img_w, _ in (img_meta['img_shape'] for img_meta in img_metas)])[None, :, None]
+        bboxes = (bbox_cxcywh_to_xyxy(all_bbox_preds) * factors).reshape(-1, 4)
+        bboxes_gt = (bbox_cxcywh_to_xyxy(bbox_targets) * factors).reshape(-1, 4)
+
+        # regression IoU loss, defaultly GIoU loss
+        if self.sync_free_loss:
+            loss_iou = self._unchecked_iou_loss(bboxes, bboxes_gt, bbox_weights)
+        else:
+            loss_iou = self.loss_iou(bboxes, bboxes_gt, bbox_weights, reduction_override='none')
+        if loss_iou.dim() == 0:
+            # no positive sample in any layer, the loss returns a zero
+            loss_iou = loss_iou.expand(num_dec_layers)
+        else:
+            loss_iou = loss_iou.view(num_dec_layers, -1).sum(1)
+        loss_iou = loss_iou / reg_avg_factor
+
+        # regression L1 loss, the xy and hw parts from the same elements
+        loss_bbox = self.loss_bbox(
+            all_bbox_preds.reshape(-1, 4), bbox_targets.reshape(-1, 4), bbox_weights,
+            reduction_override='none').view(num_dec_layers, -1, 4)
+        loss_bbox_xy = loss_bbox[..., :2].sum((1, 2)) / reg_avg_factor
+        loss_bbox_hw = loss_bbox[..., 2:].sum((1, 2)) / reg_avg_factor
+        loss_bbox = loss_bbox.sum((1, 2)) / reg_avg_factor
+
+        return tuple(
+            list(layer_losses.unbind(0))
+            for layer_losses in (loss_cls, loss_bbox, loss_iou, loss_bbox_xy, loss_bbox_hw))
+
+    def _clamp_avg_factor(self, avg_factor, to_host=False):
+        """Clamp an avg factor to at least 1. A tensor is clamped on device
+        and only moved to the host with `to_host` outside of the sync-free
+        mode."""
+        if not torch.is_tensor(avg_factor):
+            return max(avg_factor, 1)
+        avg_factor = avg_factor.clamp(min=1)
+        return avg_factor.item() if to_host and not self.sync_free_loss else avg_factor
+
+    def _unchecked_iou_loss(self, bboxes, bboxes_gt, bbox_weights):
+        """The elementwise IoU loss weighted by the mean of `bbox_weights`,
+        as `loss_iou` weights it, without its host check for all-zero
+        weights."""
+        return self.loss_iou(bboxes, bboxes_gt, reduction_override='none') * bbox_weights.mean(-1)
+
+    def _masked_reg_losses(self, bbox_preds, bbox_targets, bboxes, bboxes_gt, bbox_weights, avg_factor):
+        """The L1, IoU, xy L1 and hw L1 losses over all queries, the zero
+        weights of the negatives masking them out, so that the positives are
+        never selected on the host."""
+        loss_iou = self._unchecked_iou_loss(bboxes, bboxes_gt, bbox_weights).sum() / avg_factor
+        loss_bbox = self.loss_bbox(bbox_preds, bbox_targets, bbox_weights, reduction_override='none')
+        loss_bbox_xy = loss_bbox[..., :2].sum() / avg_factor
+        loss_bbox_hw = loss_bbox[..., 2:].sum() / avg_factor
+        loss_bbox = loss_bbox.sum() / avg_factor
+        return loss_bbox, loss_iou, loss_bbox_xy, loss_bbox_hw
+
     def loss_single(self,
                     cls_scores,
                     bbox_preds,
@@ -630,7 +896,8 @@ class DINODETRSSODHead(AnchorFreeHead):
                     gt_labels_list,
                     gt_scores_list=None,
                     img_metas=None,
-                    gt_bboxes_ignore_list=None):
+                    gt_bboxes_ignore_list=None,
+                    assigned_gt_inds=None):
         """"Loss function for outputs from a single decoder layer of a single
         feature level.
 
@@ -647,209 +914,166 @@ class DINODETRSSODHead(AnchorFreeHead):
             img_metas (list[dict]): List of image meta information.
             gt_bboxes_ignore_list (list[Tensor], optional): Bounding
                 boxes which can be ignored for each image. Default None.
+            assigned_gt_inds (Tensor, optional): [bs, num_query], the
+                one-to-one assignment of this layer precomputed by
+                `assign_batched`. Default None.
 
         Returns:
             dict[str, Tensor]: A dictionary of loss components for outputs from
                 a single decoder layer.
         """
-        # breakpoint()
-        # import ipdb;ipdb.set_trace()
+        targets, avg_factors = self.get_targets_single(
+            cls_scores, bbox_preds, gt_bboxes_list, gt_labels_list, gt_scores_list,
+            img_metas, gt_bboxes_ignore_list, assigned_gt_inds)
+        avg_factors, = self.reduce_avg_factors([avg_factors])
+        return self.loss_single_targets(cls_scores, bbox_preds, img_metas, targets, avg_factors)
+
+    def get_targets_single(self,
+                           cls_scores,
+                           bbox_preds,
+                           gt_bboxes_list,
+                           gt_labels_list,
+                           gt_scores_list=None,
+                           img_metas=None,
+                           gt_bboxes_ignore_list=None,
+                           assigned_gt_inds=None):
+        """The targets of `loss_single` for a single decoder layer,
+        concatenated over the images, and their local avg factors.
+
+        Args are the same as `loss_single`.
+
+        Returns:
+            tuple: the targets, labels, label_weights, bbox_targets,
+                bbox_weights and, in the warm-up, the normalized alignment
+                metrics; and the local cls avg factor, reg avg factor and, in
+                the warm-up, sum of the alignment metrics, to be reduced by
+                `reduce_avg_factors`.
+        """
         num_imgs = cls_scores.size(0)
         cls_scores_list = [cls_scores[i] for i in range(num_imgs)]
         bbox_preds_list = [bbox_preds[i] for i in range(num_imgs)]
 
         cls_reg_targets = self.get_targets(cls_scores_list, bbox_preds_list,
                                         gt_bboxes_list, gt_labels_list, gt_scores_list,
-                                        img_metas, gt_bboxes_ignore_list)
-    
+                                        img_metas, gt_bboxes_ignore_list, assigned_gt_inds)
+        num_total_pos, num_total_neg = cls_reg_targets[-2:]
+        targets = tuple(torch.cat(target_list, 0) for target_list in cls_reg_targets[:-2])
+        bbox_weights = targets[3]
+
+        # construct weighted avg_factor to match with the official DETR repo
+        cls_avg_factor = cls_scores.new_tensor(num_total_pos * 1.0 + num_total_neg * self.bg_cls_weight)
         if self.in_warm_up:
             # Note: in warm_up stage, one-to-many matching is for pseudo bbox and gt bbox
-            # and the loss_weight for regression is slightly different
-            (labels_list, label_weights_list, bbox_targets_list, bbox_weights_list,
-            norm_alignment_metrics_list, num_total_pos, num_total_neg) = cls_reg_targets
-            
-            labels = torch.cat(labels_list, 0)
-            label_weights = torch.cat(label_weights_list, 0)
-            bbox_targets = torch.cat(bbox_targets_list, 0)
-            bbox_weights = torch.cat(bbox_weights_list, 0)
-            norm_alignment_metrics = torch.cat(norm_alignment_metrics_list, 0)  # [num_query * num_img,]
-
-            # classification loss
-            cls_scores = cls_scores.reshape(-1, self.cls_out_channels)
-            # construct weighted avg_factor to match with the official DETR repo
-            cls_avg_factor = num_total_pos * 1.0 + \
-                num_total_neg * self.bg_cls_weight
-            if self.sync_cls_avg_factor:
-                cls_avg_factor = reduce_mean(
-                    cls_scores.new_tensor([cls_avg_factor]))
-            cls_avg_factor = max(cls_avg_factor, 1)
-
-            # Compute the average sum of alignment metrics accross all gpus, for
-            # normalization purposes
-            sum_alignment_metrics = norm_alignment_metrics.new_tensor([norm_alignment_metrics.sum()])
-            sum_alignment_metrics = torch.clamp(reduce_mean(sum_alignment_metrics), min=1.).item()
-
-            # task align focal loss take the normalized alignment metric as the classification target
-            loss_cls = self.loss_cls1(
-                cls_scores.sigmoid(), labels, norm_alignment_metrics, avg_factor=sum_alignment_metrics)
-
-            # Compute the average number of gt boxes across all gpus, for
-            # normalization purposes
-            num_total_pos = loss_cls.new_tensor([num_total_pos])
-            num_total_pos = torch.clamp(reduce_mean(num_total_pos), min=1).item()
-
-            # construct factors used for rescale bboxes
-            factors = []
-            for img_meta, bbox_pred in zip(img_metas, bbox_preds):
-                img_h, img_w, _ = img_meta['img_shape']
-                factor = bbox_pred.new_tensor([img_w, img_h, img_w,
-                                            img_h]).unsqueeze(0).repeat(
-                                                bbox_pred.size(0), 1)
-                factors.append(factor)
-            factors = torch.cat(factors, 0)
+            # and the loss_weight for regression is slightly different: the
+            # regression is normalized by the bbox weights of the positives,
+            # the negatives have zero bbox weights, and the classification
+            # by the sum of the alignment metrics
+            reg_avg_factor = bbox_weights[:, 0].sum().float()
+            sum_alignment_metrics = targets[4].sum().float()
+            return targets, (cls_avg_factor, reg_avg_factor, sum_alignment_metrics)
+
+        # after warm_up, the regression is normalized by the number of positives
+        reg_avg_factor = (bbox_weights.sum(-1) > 0).sum().float()
+        return targets, (cls_avg_factor, reg_avg_factor)
+
+    def loss_single_targets(self, cls_scores, bbox_preds, img_metas, targets, avg_factors):
+        """The losses of a single decoder layer from the targets of
+        `get_targets_single` and the avg factors of `reduce_avg_factors`.
 
-            bg_class_ind = self.num_classes
-            pos_inds = ((labels >= 0) & (labels < bg_class_ind)).nonzero().squeeze(1)
+        Args:
+            cls_scores (Tensor): [bs, num_query, cls_out_channels].
+            bbox_preds (Tensor): [bs, num_query, 4].
+            img_metas (list[dict]): List of image meta information.
+            targets (tuple[Tensor]): the targets of `get_targets_single`.
+            avg_factors (tuple[Tensor]): the reduced avg factors.
 
-            bbox_preds = bbox_preds.reshape(-1, 4)
-            bboxes = bbox_cxcywh_to_xyxy(bbox_preds) * factors
-            bboxes_gt = bbox_cxcywh_to_xyxy(bbox_targets) * factors
+        Returns:
+            tuple[Tensor]: the cls, L1, IoU, xy L1 and hw L1 losses.
+        """
+        if not self.in_warm_up:
+            # after warm_up, just switch back to the original DETR like assign and loss
+            return self.loss_one_to_one(cls_scores, bbox_preds, img_metas, targets, avg_factors)
 
-            if len(pos_inds) > 0:
-                pos_bboxes = bboxes[pos_inds]
-                pos_bboxes_gt = bboxes_gt[pos_inds]
-               
-                pos_bbox_weights = bbox_weights[pos_inds]       
+        labels, label_weights, bbox_targets, bbox_weights, norm_alignment_metrics = targets
+        reg_avg_factor = self._clamp_avg_factor(avg_factors[1], to_host=True)
+        sum_alignment_metrics = self._clamp_avg_factor(avg_factors[2], to_host=True)
 
-                reg_avg_factor = norm_alignment_metrics.new_tensor([pos_bbox_weights[:, 0].sum()])
-                reg_avg_factor = torch.clamp(reduce_mean(reg_avg_factor), min=1.).item()
+        # task align focal loss take the normalized alignment metric as the classification target
+        cls_scores = cls_scores.reshape(-1, self.cls_out_channels)
+        loss_cls = self.loss_cls1(
+            cls_scores.sigmoid(), labels, norm_alignment_metrics, avg_factor=sum_alignment_metrics)
 
-             
-                loss_iou = self.loss_iou(
-                    pos_bboxes, pos_bboxes_gt, pos_bbox_weights, avg_factor=reg_avg_factor)
+        # construct factors used for rescale bboxes
+        factors = []
+        for img_meta, bbox_pred in zip(img_metas, bbox_preds):
+            img_h, img_w, _ = img_meta['img_shape']
+            factor = bbox_pred.new_tensor([img_w, img_h, img_w,
+                                        img_h]).unsqueeze(0).repeat(
+                                            bbox_pred.size(0), 1)
+            factors.append(factor)
+        factors = torch.cat(factors, 0)
 
-                # regression L1 loss
-                pos_bbox_preds = bbox_preds[pos_inds]
-                pos_bbox_targets = bbox_targets[pos_inds]
-                
-                loss_bbox = self.loss_bbox(
-                    pos_bbox_preds, pos_bbox_targets, pos_bbox_weights, avg_factor=reg_avg_factor)
-                loss_bbox_xy = self.loss_bbox(
-                    pos_bbox_preds[..., :2], pos_bbox_targets[..., :2], pos_bbox_weights[..., :2], avg_factor=reg_avg_factor)
-                loss_bbox_hw = self.loss_bbox(
-                    pos_bbox_preds[..., 2:], pos_bbox_targets[..., 2:], pos_bbox_weights[..., 2:], avg_factor=reg_avg_factor)
-            else:
-                sum_pos_alignment_metrics = norm_alignment_metrics.new_tensor([0])
-                sum_pos_alignment_metrics = torch.clamp(reduce_mean(sum_pos_alignment_metrics), min=1.).item()
-                loss_bbox = bbox_pred.sum() * 0
-                loss_iou = bbox_pred.sum() * 0
-                loss_bbox_xy = bbox_pred.sum() * 0
-                loss_bbox_hw = bbox_pred.sum() * 0
+        bbox_preds = bbox_preds.reshape(-1, 4)
+        bboxes = bbox_cxcywh_to_xyxy(bbox_preds) * factors
+        bboxes_gt = bbox_cxcywh_to_xyxy(bbox_targets) * factors
 
-            return loss_cls, loss_bbox, loss_iou , loss_bbox_xy, loss_bbox_hw
+        if self.sync_free_loss:
+            loss_bbox, loss_iou, loss_bbox_xy, loss_bbox_hw = self._masked_reg_losses(
+                bbox_preds, bbox_targets, bboxes, bboxes_gt, bbox_weights, reg_avg_factor)
+            return loss_cls, loss_bbox, loss_iou, loss_bbox_xy, loss_bbox_hw
 
-        else:
-            # after warm_up, just switch back to the original DETR like assign and loss
-            (labels_list, label_weights_list, bbox_targets_list, bbox_weights_list,
-            num_total_pos, num_total_neg) = cls_reg_targets
-            labels = torch.cat(labels_list, 0)
-            label_weights = torch.cat(label_weights_list, 0)
-            bbox_targets = torch.cat(bbox_targets_list, 0)
-            bbox_weights = torch.cat(bbox_weights_list, 0)
-
-            # classification loss
-            cls_scores = cls_scores.reshape(-1, self.cls_out_channels)
-            # construct weighted avg_factor to match with the official DETR repo
-            cls_avg_factor = num_total_pos * 1.0 + \
-                num_total_neg * self.bg_cls_weight
-            if self.sync_cls_avg_factor:
-                cls_avg_factor = reduce_mean(
-                    cls_scores.new_tensor([cls_avg_factor]))
-            cls_avg_factor = max(cls_avg_factor, 1)
-
-            loss_cls = self.loss_cls2(
-                cls_scores, labels, label_weights, avg_factor=cls_avg_factor)
-
-            reg_avg_factor = bbox_weights.new_tensor([len(torch.nonzero(bbox_weights.sum(-1) > 0, as_tuple=False).squeeze().unique())])
-            reg_avg_factor = torch.clamp(reduce_mean(reg_avg_factor), min=1.).item()
-
-
-            # construct factors used for rescale bboxes
-            factors = []
-            for img_meta, bbox_pred in zip(img_metas, bbox_preds):
-                img_h, img_w, _ = img_meta['img_shape']
-                factor = bbox_pred.new_tensor([img_w, img_h, img_w,
-                                            img_h]).unsqueeze(0).repeat(
-                                                bbox_pred.size(0), 1)
-                factors.append(factor)
-            factors = torch.cat(factors, 0)
+        bg_class_ind = self.num_classes
+        pos_inds = ((labels >= 0) & (labels < bg_class_ind)).nonzero().squeeze(1)
 
-        
-            bbox_preds = bbox_preds.reshape(-1, 4)
-            bboxes = bbox_cxcywh_to_xyxy(bbox_preds) * factors
-            bboxes_gt = bbox_cxcywh_to_xyxy(bbox_targets) * factors
+        if len(pos_inds) > 0:
+            pos_bboxes = bboxes[pos_inds]
+            pos_bboxes_gt = bboxes_gt[pos_inds]
+            pos_bbox_weights = bbox_weights[pos_inds]
 
-            # regression IoU loss, defaultly GIoU loss
             loss_iou = self.loss_iou(
-                bboxes, bboxes_gt, bbox_weights, avg_factor=reg_avg_factor)
+                pos_bboxes, pos_bboxes_gt, pos_bbox_weights, avg_factor=reg_avg_factor)
 
             # regression L1 loss
+            pos_bbox_preds = bbox_preds[pos_inds]
+            pos_bbox_targets = bbox_targets[pos_inds]
+
             loss_bbox = self.loss_bbox(
-                bbox_preds, bbox_targets, bbox_weights, avg_factor=reg_avg_factor)
+                pos_bbox_preds, pos_bbox_targets, pos_bbox_weights, avg_factor=reg_avg_factor)
             loss_bbox_xy = self.loss_bbox(
-                bbox_preds[..., :2], bbox_targets[..., :2], bbox_weights[..., :2], avg_factor=reg_avg_factor)
+                pos_bbox_preds[..., :2], pos_bbox_targets[..., :2], pos_bbox_weights[..., :2], avg_factor=reg_avg_factor)
             loss_bbox_hw = self.loss_bbox(
-                bbox_preds[..., 2:], bbox_targets[..., 2:], bbox_weights[..., 2:], avg_factor=reg_avg_factor)
-
-            return loss_cls, loss_bbox, loss_iou , loss_bbox_xy, loss_bbox_hw
+                pos_bbox_preds[..., 2:], pos_bbox_targets[..., 2:], pos_bbox_weights[..., 2:], avg_factor=reg_avg_factor)
+        else:
+            loss_bbox = bbox_preds.sum() * 0
+            loss_iou = bbox_preds.sum() * 0
+            loss_bbox_xy = bbox_preds.sum() * 0
+            loss_bbox_hw = bbox_preds.sum() * 0
 
+        return loss_cls, loss_bbox, loss_iou , loss_bbox_xy, loss_bbox_hw
 
-    def loss_single_dn(self,
-                       cls_scores,
-                       bbox_preds,
-                       gt_bboxes_list,
-                       gt_labels_list,
-                       gt_scores_list=None,
-                       img_metas=None,
-                       dn_metas=None,
-                       gt_bboxes_ignore_list=None,
-                       is_pseudo_label=False):
-    
-        num_imgs = cls_scores.size(0)
-        cls_scores_list = [cls_scores[i] for i in range(num_imgs)]
-        bbox_preds_list = [bbox_preds[i] for i in range(num_imgs)]
+    def loss_one_to_one(self, cls_scores, bbox_preds, img_metas, targets, avg_factors):
+        """The DETR-style losses of the one-to-one matched queries of a single
+        decoder layer, or of its dn queries, from concatenated targets.
 
-        # Note: do the pre-process with pseudo labels
-       
-        cls_reg_targets = self.get_targets_dn(cls_scores_list, bbox_preds_list,
-                                    gt_bboxes_list, gt_labels_list,
-                                    img_metas, dn_metas, gt_bboxes_ignore_list, is_pseudo_label=is_pseudo_label)
-       
+        Args:
+            cls_scores (Tensor): [bs, num_query, cls_out_channels].
+            bbox_preds (Tensor): [bs, num_query, 4].
+            img_metas (list[dict]): List of image meta information.
+            targets (tuple[Tensor]): labels, label_weights [bs * num_query],
+                bbox_targets, bbox_weights [bs * num_query, 4].
+            avg_factors (tuple[Tensor]): the reduced cls and reg avg factors.
 
-        (labels_list, label_weights_list, bbox_targets_list, bbox_weights_list,
-         num_total_pos, num_total_neg) = cls_reg_targets
-        labels = torch.cat(labels_list, 0)
-        label_weights = torch.cat(label_weights_list, 0)
-        bbox_targets = torch.cat(bbox_targets_list, 0)
-        bbox_weights = torch.cat(bbox_weights_list, 0)
+        Returns:
+            tuple[Tensor]: the cls, L1, IoU, xy L1 and hw L1 losses.
+        """
+        labels, label_weights, bbox_targets, bbox_weights = targets
+        cls_avg_factor = self._clamp_avg_factor(avg_factors[0])
+        reg_avg_factor = self._clamp_avg_factor(avg_factors[1], to_host=True)
 
         # classification loss
         cls_scores = cls_scores.reshape(-1, self.cls_out_channels)
-        # construct weighted avg_factor to match with the official DETR repo
-        cls_avg_factor = num_total_pos * 1.0 + \
-            num_total_neg * self.bg_cls_weight
-        if self.sync_cls_avg_factor:
-            cls_avg_factor = reduce_mean(
-                cls_scores.new_tensor([cls_avg_factor]))
-        cls_avg_factor = max(cls_avg_factor, 1)
-
-        loss_cls = self.loss_cls2(cls_scores, labels, label_weights, avg_factor=cls_avg_factor)
-
-
-        # Compute the average number of gt boxes across all gpus, for
-        # normalization purposes
-        num_total_pos = loss_cls.new_tensor([num_total_pos])
-        num_total_pos = torch.clamp(reduce_mean(num_total_pos), min=1).item()
+        loss_cls = self.loss_cls2(
+            cls_scores, labels, label_weights, avg_factor=cls_avg_factor)
 
         # construct factors used for rescale bboxes
         factors = []
@@ -868,20 +1092,70 @@ class DINODETRSSODHead(AnchorFreeHead):
         bboxes = bbox_cxcywh_to_xyxy(bbox_preds) * factors
         bboxes_gt = bbox_cxcywh_to_xyxy(bbox_targets) * factors
 
+        if self.sync_free_loss:
+            loss_bbox, loss_iou, loss_bbox_xy, loss_bbox_hw = self._masked_reg_losses(
+                bbox_preds, bbox_targets, bboxes, bboxes_gt, bbox_weights, reg_avg_factor)
+            return loss_cls, loss_bbox, loss_iou, loss_bbox_xy, loss_bbox_hw
+
         # regression IoU loss, defaultly GIoU loss
         loss_iou = self.loss_iou(
-            bboxes, bboxes_gt, bbox_weights, avg_factor=num_total_pos)
+            bboxes, bboxes_gt, bbox_weights, avg_factor=reg_avg_factor)
 
         # regression L1 loss
         loss_bbox = self.loss_bbox(
-            bbox_preds, bbox_targets, bbox_weights, avg_factor=num_total_pos)
+            bbox_preds, bbox_targets, bbox_weights, avg_factor=reg_avg_factor)
         loss_bbox_xy = self.loss_bbox(
-            bbox_preds[..., :2], bbox_targets[..., :2], bbox_weights[..., :2], avg_factor=num_total_pos)
+            bbox_preds[..., :2], bbox_targets[..., :2], bbox_weights[..., :2], avg_factor=reg_avg_factor)
         loss_bbox_hw = self.loss_bbox(
-            bbox_preds[..., 2:], bbox_targets[..., 2:], bbox_weights[..., 2:], avg_factor=num_total_pos)
+            bbox_preds[..., 2:], bbox_targets[..., 2:], bbox_weights[..., 2:], avg_factor=reg_avg_factor)
 
         return loss_cls, loss_bbox, loss_iou , loss_bbox_xy, loss_bbox_hw
 
+    def loss_single_dn(self,
+                       cls_scores,
+                       bbox_preds,
+                       gt_bboxes_list,
+                       gt_labels_list,
+                       gt_scores_list=None,
+                       img_metas=None,
+                       dn_metas=None,
+                       gt_bboxes_ignore_list=None,
+                       is_pseudo_label=False):
+        targets, avg_factors = self.get_targets_single_dn(
+            cls_scores, bbox_preds, gt_bboxes_list, gt_labels_list, img_metas, dn_metas,
+            gt_bboxes_ignore_list, is_pseudo_label=is_pseudo_label)
+        avg_factors, = self.reduce_avg_factors([avg_factors])
+        return self.loss_one_to_one(cls_scores, bbox_preds, img_metas, targets, avg_factors)
+
+    def get_targets_single_dn(self,
+                              cls_scores,
+                              bbox_preds,
+                              gt_bboxes_list,
+                              gt_labels_list,
+                              img_metas,
+                              dn_metas,
+                              gt_bboxes_ignore_list=None,
+                              is_pseudo_label=False):
+        """The dn targets of `get_targets_dn` concatenated over the images,
+        the same for all decoder layers, and their local cls and reg avg
+        factors, to be reduced by `reduce_avg_factors`."""
+        num_imgs = cls_scores.size(0)
+        cls_scores_list = [cls_scores[i] for i in range(num_imgs)]
+        bbox_preds_list = [bbox_preds[i] for i in range(num_imgs)]
+
+        # Note: do the pre-process with pseudo labels
+        cls_reg_targets = self.get_targets_dn(cls_scores_list, bbox_preds_list,
+                                    gt_bboxes_list, gt_labels_list,
+                                    img_metas, dn_metas, gt_bboxes_ignore_list, is_pseudo_label=is_pseudo_label)
+        num_total_pos, num_total_neg = cls_reg_targets[-2:]
+        targets = tuple(torch.cat(target_list, 0) for target_list in cls_reg_targets[:-2])
+
+        # construct weighted avg_factor to match with the official DETR repo,
+        # the regression is normalized by the number of positives
+        cls_avg_factor = cls_scores.new_tensor(num_total_pos * 1.0 + num_total_neg * self.bg_cls_weight)
+        num_total_pos = cls_scores.new_tensor(num_total_pos * 1.0)
+        return targets, (cls_avg_factor, num_total_pos)
+
     def _get_target_single_dn(self,
                               cls_score,
                               bbox_pred,
@@ -910,14 +1184,14 @@ class DINODETRSSODHead(AnchorFreeHead):
 
         if len(gt_labels) > 0:
             # gt_labels: cls labels for a single image [num_gt,]
-            t = torch.arange(0, len(gt_labels)).long().cuda()    
+            t = torch.arange(0, len(gt_labels), device=bbox_pred.device)    
             t = t.unsqueeze(0).repeat(scalar, 1)
             tgt_idx = t.flatten()       # tgt_idx: [num_gt x dn_groups] from the padding_size = single_pad x dn_groups
          
-            output_idx = (torch.tensor(range(scalar)) * single_pad).long().cuda().unsqueeze(1) + t
+            output_idx = (torch.arange(scalar, device=bbox_pred.device) * single_pad).unsqueeze(1) + t
             output_idx = output_idx.flatten()
         else:
-            output_idx = tgt_idx = torch.tensor([]).long().cuda()
+            output_idx = tgt_idx = torch.tensor([], dtype=torch.long, device=bbox_pred.device)
 
         
         pos_inds = output_idx
@@ -991,7 +1265,8 @@ class DINODETRSSODHead(AnchorFreeHead):
                     gt_labels_list,
                     gt_scores_list=None,
                     img_metas=None,
-                    gt_bboxes_ignore_list=None):
+                    gt_bboxes_ignore_list=None,
+                    assigned_gt_inds=None):
         """"Compute regression and classification targets for a batch image.
 
         Outputs from a single decoder layer of a single feature level are used.
@@ -1010,6 +1285,8 @@ class DINODETRSSODHead(AnchorFreeHead):
             img_metas (list[dict]): List of image meta information.
             gt_bboxes_ignore_list (list[Tensor], optional): Bounding
                 boxes which can be ignored for each image. Default None.
+            assigned_gt_inds (Tensor, optional): [bs, num_query], the
+                precomputed one-to-one assignment. Default None.
 
         Returns:
             tuple: a tuple containing the following targets.
@@ -1055,10 +1332,13 @@ class DINODETRSSODHead(AnchorFreeHead):
 
         else:
             # Note: after warm_up, we apply the original DETR stype assigner to do one-to-one assign
+            if assigned_gt_inds is None:
+                assigned_gt_inds = [None for _ in range(num_imgs)]
             (labels_list, label_weights_list, bbox_targets_list,
             bbox_weights_list, pos_inds_list, neg_inds_list) = multi_apply(
                 self._get_target_single, cls_scores_list, bbox_preds_list,
-                gt_bboxes_list, gt_labels_list, gt_scores_list, img_metas, gt_bboxes_ignore_list)
+                gt_bboxes_list, gt_labels_list, gt_scores_list, img_metas, gt_bboxes_ignore_list,
+                assigned_gt_inds)
 
             num_total_pos = sum((inds.numel() for inds in pos_inds_list))
             num_total_neg = sum((inds.numel() for inds in neg_inds_list))
@@ -1073,7 +1353,8 @@ class DINODETRSSODHead(AnchorFreeHead):
                            gt_labels,
                            gt_scores=None,
                            img_meta=None,
-                           gt_bboxes_ignore=None):
+                           gt_bboxes_ignore=None,
+                           assigned_gt_inds=None):
         """"Compute regression and classification targets for one image.
 
         Outputs from a single decoder layer of a single feature level are used.
@@ -1091,6 +1372,9 @@ class DINODETRSSODHead(AnchorFreeHead):
             img_meta (dict): Meta information for one image.
             gt_bboxes_ignore (Tensor, optional): Bounding boxes
                 which can be ignored. Default None.
+            assigned_gt_inds (Tensor, optional): [num_query], the
+                precomputed one-to-one assignment, used instead of running
+                `assigner2`. Default None.
 
         Returns:
             tuple[Tensor]: a tuple containing the following for one image.
@@ -1147,14 +1431,9 @@ class DINODETRSSODHead(AnchorFreeHead):
             
             # take the instance normalization for each gt, make the largest alignment metric
             # score of the assigned proposal equals to the largest IoU
-            norm_alignment_metrics = assign_metrics.new_zeros(labels.shape[0])
-            pos_assigned_gt_inds = sampling_result.pos_assigned_gt_inds
-            for gt_inds in torch.unique(pos_assigned_gt_inds):
-                gt_class_inds = pos_inds[pos_assigned_gt_inds == gt_inds]
-                pos_alignment_metrics = assign_metrics[gt_class_inds]
-                pos_ious = assign_ious[gt_class_inds]
-                pos_norm_alignment_metrics = pos_alignment_metrics / (pos_alignment_metrics.max() + 10e-8) * pos_ious.max()
-                norm_alignment_metrics[gt_class_inds] = pos_norm_alignment_metrics
+            norm_alignment_metrics = self.assigner1.normalize_alignment_metrics(
+                assign_metrics, assign_ious, pos_inds, sampling_result.pos_assigned_gt_inds,
+                gt_bboxes.size(0))
 
          
             # make the bbox_weights to the alignment metrics 
@@ -1167,9 +1446,12 @@ class DINODETRSSODHead(AnchorFreeHead):
         else:
             # after warm_up, we take the original DETR stype assignment 
             # assigner and sampler
-            assign_result = self.assigner2.assign(bbox_pred, cls_score, gt_bboxes,
-                                                gt_labels, img_meta,
-                                                gt_bboxes_ignore)
+            if assigned_gt_inds is not None:
+                assign_result = self.assigner2.get_assign_result(assigned_gt_inds, gt_labels)
+            else:
+                assign_result = self.assigner2.assign(bbox_pred, cls_score, gt_bboxes,
+                                                    gt_labels, img_meta,
+                                                    gt_bboxes_ignore)
             sampling_result = self.sampler.sample(assign_result, bbox_pred,
                                                 gt_bboxes)
             pos_inds = sampling_result.pos_inds
@@ -1262,20 +1544,24 @@ class DINODETRSSODHead(AnchorFreeHead):
 
             input_query_label, input_query_bbox, attn_mask, dn_meta = prepare_for_cdn_plus(dn_args=(targets, self.dn_number, self.dn_label_noise_ratio, self.dn_box_noise_scale),
                                 training=True, num_queries=self.num_query, num_classes=self.num_classes,
-                                hidden_dim=self.embed_dims, label_enc=self.label_enc)
+                                hidden_dim=self.embed_dims, label_enc=self.label_enc, pad_sizes=self.dn_pad_sizes)
         else:
             input_query_bbox = input_query_label = attn_mask = dn_meta = None
 
         assert proposal_cfg is None, '"proposal_cfg" must be None'
         # change the forward method's parameter
         # import ipdb;ipdb.set_trace()
-        outs = self(x, img_metas, input_query_label, input_query_bbox, attn_mask, dn_meta)
+        outs, aux_losses = self(x, img_metas, input_query_label, input_query_bbox, attn_mask, dn_meta,
+                                img_masks=kwargs.get('img_masks'), return_aux_losses=True)
         # Note: gt_scores is consider when we use pseudo bbox 
         if gt_scores is None:
             loss_inputs = outs + (gt_bboxes, gt_labels)
         else:
             loss_inputs = outs + (gt_bboxes, gt_labels, gt_scores)
         losses = self.loss(*loss_inputs, img_metas=img_metas, dn_metas=dn_meta, gt_bboxes_ignore=gt_bboxes_ignore, is_pseudo_label=is_pseudo_label)
+        # saliency loss of the sparse encoder and objectness loss of the
+        # two-stage prefilter, if enabled
+        losses.update(aux_losses)
         return losses
 
     @force_fp32(apply_to=('all_cls_scores_list', 'all_bbox_preds_list'))
@@ -1394,7 +1680,7 @@ class DINODETRSSODHead(AnchorFreeHead):
                     max_per_img)
                 return det_bboxes, det_labels
             else:
-                scores, indexes = cls_score.view(-1).topk(max_per_img)
+                scores, indexes = cls_score.view(-1).topk(min(max_per_img, cls_score.numel()))
                 det_labels = indexes % self.num_classes
                 bbox_index = indexes // self.num_classes
                 bbox_pred = bbox_pred[bbox_index]
@@ -1412,7 +1698,7 @@ class DINODETRSSODHead(AnchorFreeHead):
 
         return det_bboxes, det_labels
 
-    def simple_test_bboxes(self, feats, img_metas, rescale=False, curr_step=None, for_pseudo_label=False):
+    def simple_test_bboxes(self, feats, img_metas, rescale=False, curr_step=None, for_pseudo_label=False, num_queries=None):
         """Test det bboxes without test-time augmentation.
 
         Args:
@@ -1421,6 +1707,9 @@ class DINODETRSSODHead(AnchorFreeHead):
             img_metas (list[dict]): List of image information.
             rescale (bool, optional): Whether to rescale the results.
                 Defaults to False.
+            num_queries (int, optional): Query budget of this call, narrows
+                the two-stage top-k selection and the decoder workload.
+                Defaults to None, i.e. the num_query of the model.
 
         Returns:
             list[tuple[Tensor, Tensor]]: Each item in result_list is 2-tuple.
@@ -1437,7 +1726,9 @@ class DINODETRSSODHead(AnchorFreeHead):
                 self.in_warm_up = False
 
         # forward of this head requires img_metas
-        outs = self.forward(feats, img_metas)
+        # early-exit decoding is an evaluation-time policy, keep the pseudo labels exact
+        early_exit = None if for_pseudo_label else self.test_cfg.get('early_exit', None)
+        outs = self.forward(feats, img_metas, early_exit=early_exit, num_queries=num_queries)
         results_list = self.get_bboxes(*outs, img_metas, rescale=rescale, for_pseudo_label=for_pseudo_label)
         return results_list
 
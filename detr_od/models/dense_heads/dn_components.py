@@ -2,6 +2,8 @@ import torch
 import torch.nn.functional as F
 from mmdet.models.utils.transformer import inverse_sigmoid
 
+from ..utils.static_shape import round_up_to_bucket
+
 
 def prepare_for_cdn(dn_args, training, num_queries, num_classes, hidden_dim, label_enc):
     """
@@ -17,9 +19,11 @@ def prepare_for_cdn(dn_args, training, num_queries, num_classes, hidden_dim, lab
         """
     if training:
         targets, dn_number, label_noise_ratio, box_noise_scale = dn_args
+        # everything is built on the device of the label embedding
+        device = label_enc.weight.device
         # positive and negative dn queries
         dn_number = dn_number * 2
-        known = [(torch.ones_like(t)).cuda() for t in targets['labels']]
+        known = [torch.ones_like(t, device=device) for t in targets['labels']]
         batch_size = len(known)
         known_num = [sum(k) for k in known]
         if int(max(known_num)) == 0:
@@ -56,8 +60,8 @@ def prepare_for_cdn(dn_args, training, num_queries, num_classes, hidden_dim, lab
         single_pad = int(max(known_num))
 
         pad_size = int(single_pad * 2 * dn_number)  #
-        positive_idx = torch.tensor(range(len(boxes))).long().cuda().unsqueeze(0).repeat(dn_number, 1)
-        positive_idx += (torch.tensor(range(dn_number)) * len(boxes) * 2).long().cuda().unsqueeze(1)
+        positive_idx = torch.arange(len(boxes), device=device).unsqueeze(0).repeat(dn_number, 1)
+        positive_idx += (torch.arange(dn_number, device=device) * len(boxes) * 2).unsqueeze(1)
         positive_idx = positive_idx.flatten()
         negative_idx = positive_idx + len(boxes)
         if box_noise_scale > 0:
@@ -74,22 +78,22 @@ def prepare_for_cdn(dn_args, training, num_queries, num_classes, hidden_dim, lab
             rand_part[negative_idx] += 1.0
             rand_part *= rand_sign
             known_bbox_ = known_bbox_ + torch.mul(rand_part,
-                                                  diff).cuda() * box_noise_scale
+                                                  diff) * box_noise_scale
             known_bbox_ = known_bbox_.clamp(min=0.0, max=1.0)
             known_bbox_expand[:, :2] = (known_bbox_[:, :2] + known_bbox_[:, 2:]) / 2
             known_bbox_expand[:, 2:] = known_bbox_[:, 2:] - known_bbox_[:, :2]
 
-        m = known_labels_expaned.long().to('cuda')
+        m = known_labels_expaned.long().to(device)
         input_label_embed = label_enc(m)
         input_bbox_embed = inverse_sigmoid(known_bbox_expand)
 
-        padding_label = torch.zeros(pad_size, hidden_dim).cuda()
-        padding_bbox = torch.zeros(pad_size, 4).cuda()
+        padding_label = torch.zeros(pad_size, hidden_dim, device=device)
+        padding_bbox = torch.zeros(pad_size, 4, device=device)
 
         input_query_label = padding_label.repeat(batch_size, 1, 1)
         input_query_bbox = padding_bbox.repeat(batch_size, 1, 1)
 
-        map_known_indice = torch.tensor([]).to('cuda')
+        map_known_indice = torch.tensor([], device=device)
         if len(known_num):
             map_known_indice = torch.cat([torch.tensor(range(num)) for num in known_num])  # [1,2, 1,2,3]
             map_known_indice = torch.cat([map_known_indice + single_pad * i for i in range(2 * dn_number)]).long()
@@ -98,7 +102,7 @@ def prepare_for_cdn(dn_args, training, num_queries, num_classes, hidden_dim, lab
             input_query_bbox[(known_bid.long(), map_known_indice)] = input_bbox_embed
 
         tgt_size = pad_size + num_queries
-        attn_mask = torch.ones(tgt_size, tgt_size).to('cuda') < 0
+        attn_mask = torch.ones(tgt_size, tgt_size, device=device) < 0
         # match query cannot see the reconstruct
         attn_mask[pad_size:, :pad_size] = True
         # reconstruct cannot see each other
@@ -125,12 +129,70 @@ def prepare_for_cdn(dn_args, training, num_queries, num_classes, hidden_dim, lab
     return input_query_label, input_query_bbox, attn_mask, dn_meta
 
 
-def prepare_for_cdn_plus(dn_args, training, num_queries, num_classes, hidden_dim, label_enc):
+def build_padded_dn_queries(gt_labels, gt_bboxes, single_pad, dn_number, label_noise_ratio, box_noise_scale,
+                            num_classes, label_enc):
+    """The noised dn queries of `prepare_for_cdn_plus` for a static pad, built with masks and `arange`
+    against the pad rather than by indexing the gts, so that no op depends on the data.
+
+    The layout is the same: `2 * dn_number` groups of `single_pad` slots, the positive queries in the
+    even groups and the negative ones in the odd groups, the slots past the gts of an image are zero.
+
+    :param gt_labels: the labels of each image
+    :param gt_bboxes: the normalized cx, cy, w, h boxes of each image
+    :param single_pad: the slots of each group, at least the max number of gts
+    :return: the label [bs, pad_size, hidden_dim] and bbox [bs, pad_size, 4] queries
+    """
+    device = label_enc.weight.device
+    batch_size = len(gt_labels)
+    num_groups = 2 * dn_number
+    pad_size = single_pad * num_groups
+
+    # the gts of each image padded to single_pad, the sizes come from the shapes
+    labels = torch.zeros(batch_size, single_pad, dtype=torch.long, device=device)
+    boxes = torch.zeros(batch_size, single_pad, 4, device=device)
+    valid = torch.zeros(batch_size, single_pad, dtype=torch.bool, device=device)
+    for i, (img_labels, img_boxes) in enumerate(zip(gt_labels, gt_bboxes)):
+        labels[i, :img_labels.size(0)] = img_labels
+        boxes[i, :img_boxes.size(0)] = img_boxes
+        valid[i, :img_labels.size(0)] = True
+    labels = labels.repeat(1, num_groups)
+    boxes = boxes.repeat(1, num_groups, 1)
+    valid = valid.repeat(1, num_groups)[..., None]
+    negative = (torch.arange(pad_size, device=device) // single_pad % 2 == 1)[None, :, None]
+
+    if label_noise_ratio > 0:
+        # half of bbox prob, randomly put a new one there
+        noised = torch.rand(labels.shape, device=device) < (label_noise_ratio * 0.5)
+        labels = torch.where(noised, torch.randint_like(labels, 0, num_classes), labels)
+
+    if box_noise_scale > 0:
+        known_bbox_ = torch.cat([boxes[..., :2] - boxes[..., 2:] / 2, boxes[..., :2] + boxes[..., 2:] / 2], -1)
+        diff = boxes[..., 2:].repeat(1, 1, 2) / 2
+
+        rand_sign = torch.randint_like(boxes, low=0, high=2) * 2.0 - 1.0
+        rand_part = (torch.rand_like(boxes) + negative.float()) * rand_sign
+        known_bbox_ = known_bbox_ + torch.mul(rand_part, diff) * box_noise_scale
+        known_bbox_ = known_bbox_.clamp(min=0.0, max=1.0)
+        boxes = torch.cat([(known_bbox_[..., :2] + known_bbox_[..., 2:]) / 2,
+                           known_bbox_[..., 2:] - known_bbox_[..., :2]], -1)
+
+    input_query_label = torch.where(valid, label_enc(labels), label_enc.weight.new_zeros(()))
+    input_query_bbox = torch.where(valid, inverse_sigmoid(boxes), boxes.new_zeros(()))
+    return input_query_label, input_query_bbox
+
+
+def prepare_for_cdn_plus(dn_args, training, num_queries, num_classes, hidden_dim, label_enc, pad_sizes=None):
     """ A extend version of the original prepare_for_cnd function which can deal with the situation of 
     there is no situation within a image.
+
+    :param pad_sizes: if not None, the per-image pad (max number of gts) is rounded up to these sizes
+        (an int granularity or a sorted list), so that the dn part only takes a few different shapes.
+        The extra slots are background queries, the same as those of the images with fewer gts.
     """
     if training:
         targets, dn_number, label_noise_ratio, box_noise_scale = dn_args
+        # everything is built on the device of the label embedding
+        device = label_enc.weight.device
 
         # preprocess
         # check there is gt bbox for each image
@@ -145,8 +207,8 @@ def prepare_for_cdn_plus(dn_args, training, num_queries, num_classes, hidden_dim
                 # if there is no gt bbox in this image, we randomly generate a 
                 # gt bbox and gt label for this image
                 # bbox is the normalized cx, cy, w, h format
-                tmp_bboxes = torch.tensor([[0.5, 0.5, 0.5, 0.5]]).cuda()
-                tmp_labels = torch.randint(0, 80, (1,)).long().cuda()
+                tmp_bboxes = torch.tensor([[0.5, 0.5, 0.5, 0.5]], device=device)
+                tmp_labels = torch.randint(0, 80, (1,)).long().to(device)
 
                 gt_bboxes.append(tmp_bboxes)
                 gt_labels.append(tmp_labels)
@@ -157,93 +219,102 @@ def prepare_for_cdn_plus(dn_args, training, num_queries, num_classes, hidden_dim
                 gt_labels.append(targets['labels'][i])
 
                 pad_mask.append(0)
-        pad_mask = torch.tensor(pad_mask).cuda()
+        pad_mask = torch.tensor(pad_mask, device=device)
 
         # prepare dn query
         # positive and negative dn queries
         dn_number = dn_number * 2
-        known = [(torch.ones_like(t)).cuda() for t in gt_labels]
-        batch_size = len(known)
-        known_num = [sum(k) for k in known]     # total gt bbox num
+        batch_size = len(gt_labels)
+        # total gt bbox num, from the shapes to avoid a sync
+        single_pad = max(t.size(0) for t in gt_labels)
 
-        assert int(max(known_num)) != 0, "It's impossible for the gt box num is 0 in a batched images!"
+        assert single_pad != 0, "It's impossible for the gt box num is 0 in a batched images!"
+        if pad_sizes is not None:
+            single_pad = round_up_to_bucket(single_pad, pad_sizes)
        
         if dn_number >= 100:
-            dn_number = dn_number // (int(max(known_num) * 2))
+            dn_number = dn_number // (single_pad * 2)
         elif dn_number < 1:
             dn_number = 1
         if dn_number == 0:
             dn_number = 1
-
-        # concate all the gt bounding box together
-        unmask_bbox = unmask_label = torch.cat(known)
-        labels = torch.cat([t for t in gt_labels])          # put all the gt_labels of all images together
-        boxes = torch.cat([t for t in gt_bboxes])           # put all the gt_bboxes of all images together
-        batch_idx = torch.cat([torch.full_like(t.long(), i) for i, t in enumerate(gt_labels)])
-
-        known_indice = torch.nonzero(unmask_label + unmask_bbox)
-        known_indice = known_indice.view(-1)
-
-        known_indice = known_indice.repeat(2 * dn_number, 1).view(-1)
-        known_labels = labels.repeat(2 * dn_number, 1).view(-1)
-        known_bid = batch_idx.repeat(2 * dn_number, 1).view(-1)
-        known_bboxs = boxes.repeat(2 * dn_number, 1)
-        known_labels_expaned = known_labels.clone()
-        known_bbox_expand = known_bboxs.clone()
-
-        if label_noise_ratio > 0:
-            p = torch.rand_like(known_labels_expaned.float())
-            chosen_indice = torch.nonzero(p < (label_noise_ratio * 0.5)).view(-1)   # half of bbox prob
-            new_label = torch.randint_like(chosen_indice, 0, num_classes)           # randomly put a new one here
-            known_labels_expaned.scatter_(0, chosen_indice, new_label)
-        single_pad = int(max(known_num))
-
         pad_size = int(single_pad * 2 * dn_number)  #
-        positive_idx = torch.tensor(range(len(boxes))).long().cuda().unsqueeze(0).repeat(dn_number, 1)
-        positive_idx += (torch.tensor(range(dn_number)) * len(boxes) * 2).long().cuda().unsqueeze(1)
-        positive_idx = positive_idx.flatten()
-        negative_idx = positive_idx + len(boxes)
-        if box_noise_scale > 0:
-            known_bbox_ = torch.zeros_like(known_bboxs)
-            known_bbox_[:, :2] = known_bboxs[:, :2] - known_bboxs[:, 2:] / 2
-            known_bbox_[:, 2:] = known_bboxs[:, :2] + known_bboxs[:, 2:] / 2
 
-            diff = torch.zeros_like(known_bboxs)
-            diff[:, :2] = known_bboxs[:, 2:] / 2
-            diff[:, 2:] = known_bboxs[:, 2:] / 2
+        if pad_sizes is not None:
+            # static shapes: the queries are laid out against the pad with masks
+            input_query_label, input_query_bbox = build_padded_dn_queries(
+                gt_labels, gt_bboxes, single_pad, dn_number, label_noise_ratio, box_noise_scale,
+                num_classes, label_enc)
+        else:
+            # concate all the gt bounding box together
+            known = [torch.ones_like(t, device=device) for t in gt_labels]
+            known_num = [k.numel() for k in known]
+            unmask_bbox = unmask_label = torch.cat(known)
+            labels = torch.cat([t for t in gt_labels])          # put all the gt_labels of all images together
+            boxes = torch.cat([t for t in gt_bboxes])           # put all the gt_bboxes of all images together
+            batch_idx = torch.cat([torch.full_like(t.long(), i) for i, t in enumerate(gt_labels)])
+
+            known_indice = torch.nonzero(unmask_label + unmask_bbox)
+            known_indice = known_indice.view(-1)
+
+            known_indice = known_indice.repeat(2 * dn_number, 1).view(-1)
+            known_labels = labels.repeat(2 * dn_number, 1).view(-1)
+            known_bid = batch_idx.repeat(2 * dn_number, 1).view(-1)
+            known_bboxs = boxes.repeat(2 * dn_number, 1)
+            known_labels_expaned = known_labels.clone()
+            known_bbox_expand = known_bboxs.clone()
+
+            if label_noise_ratio > 0:
+                p = torch.rand_like(known_labels_expaned.float())
+                chosen_indice = torch.nonzero(p < (label_noise_ratio * 0.5)).view(-1)   # half of bbox prob
+                new_label = torch.randint_like(chosen_indice, 0, num_classes)           # randomly put a new one here
+                known_labels_expaned.scatter_(0, chosen_indice, new_label)
+
+            positive_idx = torch.arange(len(boxes), device=device).unsqueeze(0).repeat(dn_number, 1)
+            positive_idx += (torch.arange(dn_number, device=device) * len(boxes) * 2).unsqueeze(1)
+            positive_idx = positive_idx.flatten()
+            negative_idx = positive_idx + len(boxes)
+            if box_noise_scale > 0:
+                known_bbox_ = torch.zeros_like(known_bboxs)
+                known_bbox_[:, :2] = known_bboxs[:, :2] - known_bboxs[:, 2:] / 2
+                known_bbox_[:, 2:] = known_bboxs[:, :2] + known_bboxs[:, 2:] / 2
 
-            rand_sign = torch.randint_like(known_bboxs, low=0, high=2, dtype=torch.float32) * 2.0 - 1.0
-            rand_part = torch.rand_like(known_bboxs)
-            rand_part[negative_idx] += 1.0
-            rand_part *= rand_sign
-            known_bbox_ = known_bbox_ + torch.mul(rand_part,
-                                                  diff).cuda() * box_noise_scale
-            known_bbox_ = known_bbox_.clamp(min=0.0, max=1.0)
-            known_bbox_expand[:, :2] = (known_bbox_[:, :2] + known_bbox_[:, 2:]) / 2
-            known_bbox_expand[:, 2:] = known_bbox_[:, 2:] - known_bbox_[:, :2]
+                diff = torch.zeros_like(known_bboxs)
+                diff[:, :2] = known_bboxs[:, 2:] / 2
+                diff[:, 2:] = known_bboxs[:, 2:] / 2
 
-        m = known_labels_expaned.long().to('cuda')
-        input_label_embed = label_enc(m)
-        input_bbox_embed = inverse_sigmoid(known_bbox_expand)
+                rand_sign = torch.randint_like(known_bboxs, low=0, high=2, dtype=torch.float32) * 2.0 - 1.0
+                rand_part = torch.rand_like(known_bboxs)
+                rand_part[negative_idx] += 1.0
+                rand_part *= rand_sign
+                known_bbox_ = known_bbox_ + torch.mul(rand_part,
+                                                      diff) * box_noise_scale
+                known_bbox_ = known_bbox_.clamp(min=0.0, max=1.0)
+                known_bbox_expand[:, :2] = (known_bbox_[:, :2] + known_bbox_[:, 2:]) / 2
+                known_bbox_expand[:, 2:] = known_bbox_[:, 2:] - known_bbox_[:, :2]
 
-        padding_label = torch.zeros(pad_size, hidden_dim).cuda()
-        padding_bbox = torch.zeros(pad_size, 4).cuda()
+            m = known_labels_expaned.long().to(device)
+            input_label_embed = label_enc(m)
+            input_bbox_embed = inverse_sigmoid(known_bbox_expand)
 
-        input_query_label = padding_label.repeat(batch_size, 1, 1)
-        input_query_bbox = padding_bbox.repeat(batch_size, 1, 1)
+            padding_label = torch.zeros(pad_size, hidden_dim, device=device)
+            padding_bbox = torch.zeros(pad_size, 4, device=device)
 
-        map_known_indice = torch.tensor([]).to('cuda')
-        if len(known_num):
-            map_known_indice = torch.cat([torch.tensor(range(num)) for num in known_num])  # [1,2, 1,2,3]
-            map_known_indice = torch.cat([map_known_indice + single_pad * i for i in range(2 * dn_number)]).long()
-        if len(known_bid):
-            input_query_label[(known_bid.long(), map_known_indice)] = input_label_embed
-            input_query_bbox[(known_bid.long(), map_known_indice)] = input_bbox_embed
+            input_query_label = padding_label.repeat(batch_size, 1, 1)
+            input_query_bbox = padding_bbox.repeat(batch_size, 1, 1)
+
+            map_known_indice = torch.tensor([], device=device)
+            if len(known_num):
+                map_known_indice = torch.cat([torch.tensor(range(num)) for num in known_num])  # [1,2, 1,2,3]
+                map_known_indice = torch.cat([map_known_indice + single_pad * i for i in range(2 * dn_number)]).long()
+            if len(known_bid):
+                input_query_label[(known_bid.long(), map_known_indice)] = input_label_embed
+                input_query_bbox[(known_bid.long(), map_known_indice)] = input_bbox_embed
 
         # import ipdb;ipdb.set_trace()
 
         tgt_size = pad_size + num_queries
-        attn_mask = torch.ones(tgt_size, tgt_size).to('cuda') < 0
+        attn_mask = torch.ones(tgt_size, tgt_size, device=device) < 0
         # match query cannot see the reconstruct
         attn_mask[pad_size:, :pad_size] = True
         # reconstruct cannot see each other
@@ -279,6 +350,8 @@ def prepare_for_cdn_ssod(dn_args, training, num_queries, num_classes, hidden_dim
     """
     if training:
         targets, dn_number, label_noise_ratio, box_noise_scale = dn_args
+        # everything is built on the device of the label embedding
+        device = label_enc.weight.device
 
         # preprocess
         # check there is gt bbox for each image
@@ -293,8 +366,8 @@ def prepare_for_cdn_ssod(dn_args, training, num_queries, num_classes, hidden_dim
                 # if there is no gt bbox in this image, we randomly generate a 
                 # gt bbox and gt label for this image
                 # bbox is the normalized cx, cy, w, h format
-                tmp_bboxes = torch.tensor([[0.5, 0.5, 0.5, 0.5]]).cuda()
-                tmp_labels = torch.randint(0, 80, (1,)).long().cuda()
+                tmp_bboxes = torch.tensor([[0.5, 0.5, 0.5, 0.5]], device=device)
+                tmp_labels = torch.randint(0, 80, (1,)).long().to(device)
 
                 gt_bboxes.append(tmp_bboxes)
                 gt_labels.append(tmp_labels)
@@ -305,12 +378,12 @@ def prepare_for_cdn_ssod(dn_args, training, num_queries, num_classes, hidden_dim
                 gt_labels.append(targets['labels'][i])
 
                 pad_mask.append(0)
-        pad_mask = torch.tensor(pad_mask).cuda()
+        pad_mask = torch.tensor(pad_mask, device=device)
 
         # prepare dn query
         # positive and negative dn queries
         dn_number = dn_number * 2
-        known = [(torch.ones_like(t)).cuda() for t in gt_labels]
+        known = [torch.ones_like(t, device=device) for t in gt_labels]
         batch_size = len(known)
         known_num = [sum(k) for k in known]     # total gt bbox num
 
@@ -361,8 +434,8 @@ def prepare_for_cdn_ssod(dn_args, training, num_queries, num_classes, hidden_dim
         single_pad = int(max(known_num))
 
         pad_size = int(single_pad * 2 * dn_number)  #
-        positive_idx = torch.tensor(range(len(boxes))).long().cuda().unsqueeze(0).repeat(dn_number, 1)
-        positive_idx += (torch.tensor(range(dn_number)) * len(boxes) * 2).long().cuda().unsqueeze(1)
+        positive_idx = torch.arange(len(boxes), device=device).unsqueeze(0).repeat(dn_number, 1)
+        positive_idx += (torch.arange(dn_number, device=device) * len(boxes) * 2).unsqueeze(1)
         positive_idx = positive_idx.flatten()
         negative_idx = positive_idx + len(boxes)
         if box_noise_scale > 0:
@@ -382,7 +455,7 @@ def prepare_for_cdn_ssod(dn_args, training, num_queries, num_classes, hidden_dim
                 rand_part[negative_idx] += 1.0
                 rand_part *= rand_sign
                 known_bbox_ = known_bbox_ + torch.mul(rand_part,
-                                                    diff).cuda() * box_noise_scale
+                                                    diff) * box_noise_scale
                 known_bbox_ = known_bbox_.clamp(min=0.0, max=1.0)
                 known_bbox_expand[:, :2] = (known_bbox_[:, :2] + known_bbox_[:, 2:]) / 2
                 known_bbox_expand[:, 2:] = known_bbox_[:, 2:] - known_bbox_[:, :2]
@@ -410,17 +483,17 @@ def prepare_for_cdn_ssod(dn_args, training, num_queries, num_classes, hidden_dim
                 known_bbox_expand[:, :2] = (known_bbox_[:, :2] + known_bbox_[:, 2:]) / 2
                 known_bbox_expand[:, 2:] = known_bbox_[:, 2:] - known_bbox_[:, :2]
 
-        m = known_labels_expaned.long().to('cuda')
+        m = known_labels_expaned.long().to(device)
         input_label_embed = label_enc(m)
         input_bbox_embed = inverse_sigmoid(known_bbox_expand)
 
-        padding_label = torch.zeros(pad_size, hidden_dim).cuda()
-        padding_bbox = torch.zeros(pad_size, 4).cuda()
+        padding_label = torch.zeros(pad_size, hidden_dim, device=device)
+        padding_bbox = torch.zeros(pad_size, 4, device=device)
 
         input_query_label = padding_label.repeat(batch_size, 1, 1)
         input_query_bbox = padding_bbox.repeat(batch_size, 1, 1)
 
-        map_known_indice = torch.tensor([]).to('cuda')
+        map_known_indice = torch.tensor([], device=device)
         if len(known_num):
             map_known_indice = torch.cat([torch.tensor(range(num)) for num in known_num])  # [1,2, 1,2,3]
             map_known_indice = torch.cat([map_known_indice + single_pad * i for i in range(2 * dn_number)]).long()
@@ -429,7 +502,7 @@ def prepare_for_cdn_ssod(dn_args, training, num_queries, num_classes, hidden_dim
             input_query_bbox[(known_bid.long(), map_known_indice)] = input_bbox_embed
 
         tgt_size = pad_size + num_queries
-        attn_mask = torch.ones(tgt_size, tgt_size).to('cuda') < 0
+        attn_mask = torch.ones(tgt_size, tgt_size, device=device) < 0
         # match query cannot see the reconstruct
         attn_mask[pad_size:, :pad_size] = True
         # reconstruct cannot see each other
@@ -6,12 +6,23 @@ import torch
 from mmdet.models.builder import DETECTORS
 from mmdet.models.detectors.single_stage import SingleStageDetector
 
+from .utils.static_shape import get_img_masks, pad_to_bucket
+
 
 
 @DETECTORS.register_module()
 class DINODETR(SingleStageDetector):
     r"""Implementation of `DETR: End-to-End Object Detection with
-    Transformers <https://arxiv.org/pdf/2005.12872>`_"""
+    Transformers <https://arxiv.org/pdf/2005.12872>`_
+
+    Besides a bool, the `with_cp` of a ResNet backbone can be given per stage,
+    e.g. ``with_cp=(False, True, True, True)`` to checkpoint the activations
+    of the last three stages only.
+
+    With `static_shape`, e.g. ``dict(size_buckets=[(800, 1088), (1088, 1344)])``,
+    the training batches are padded to a fixed set of shapes (see
+    :func:`pad_to_bucket`) so that the forward can be captured as a graph.
+    """
 
     def __init__(self,
                  backbone,
@@ -19,9 +30,43 @@ class DINODETR(SingleStageDetector):
                  train_cfg=None,
                  test_cfg=None,
                  pretrained=None,
-                 init_cfg=None):
+                 init_cfg=None,
+                 static_shape=None):
+        stage_with_cp = backbone.get('with_cp', False)
+        if isinstance(stage_with_cp, (list, tuple)):
+            backbone = dict(backbone, with_cp=False)
         super(DINODETR, self).__init__(backbone, None, bbox_head, train_cfg,
                                    test_cfg, pretrained, init_cfg)
+        if isinstance(stage_with_cp, (list, tuple)):
+            self.set_stage_with_cp(stage_with_cp)
+        self.static_shape = static_shape
+
+    def forward_train(self,
+                      img,
+                      img_metas,
+                      gt_bboxes,
+                      gt_labels,
+                      gt_bboxes_ignore=None,
+                      **kwargs):
+        if self.static_shape is not None:
+            img, img_metas = pad_to_bucket(img, img_metas, **self.static_shape)
+            # built outside of the head forward, which then does not depend
+            # on the image shapes in img_metas
+            kwargs['img_masks'] = get_img_masks(img_metas, img)
+        return super(DINODETR, self).forward_train(img, img_metas, gt_bboxes, gt_labels,
+                                                   gt_bboxes_ignore, **kwargs)
+
+    def set_stage_with_cp(self, stage_with_cp):
+        """Enable activation checkpointing per ResNet stage."""
+        res_layers = getattr(self.backbone, 'res_layers', None)
+        assert res_layers is not None, \
+            'per-stage with_cp is only supported by ResNet-like backbones'
+        assert len(stage_with_cp) == len(res_layers), \
+            f'with_cp has {len(stage_with_cp)} entries for {len(res_layers)} stages'
+        for layer_name, with_cp in zip(res_layers, stage_with_cp):
+            for block in getattr(self.backbone, layer_name):
+                block.with_cp = with_cp
+        self.backbone.with_cp = any(stage_with_cp)
     
 
     # over-write `forward_dummy` because:
@@ -1,4 +1,6 @@
 from .softmax_focal_loss import SoftmaxFocalLoss
 from .task_aligned_focal_loss import TaskAlignedFocalLoss
 from .binary_kl_div_loss import BinaryKLDivLoss
-from .soft_label_focal_loss import FocalKLLoss
\ No newline at end of file
+from .soft_label_focal_loss import FocalKLLoss
+from .sparse_focal_loss import SparseFocalLoss, SparseTaskAlignedFocalLoss, sparse_focal_loss
+from .fused_focal_loss import FusedFocalLoss, FusedFocalLossFunction, fused_focal_loss
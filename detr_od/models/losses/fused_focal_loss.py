@@ -0,0 +1,172 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.autograd import Function
+from torch.autograd.function import once_differentiable
+
+from mmdet.models.builder import LOSSES
+from mmdet.models.losses.utils import weight_reduce_loss
+
+from .sparse_focal_loss import _focal_term, _quality_term
+
+
+def _soft_target(pred, labels, scores=None):
+    """The [N, C] target of dense labels, C for the background, scaled by
+    the soft scores if given."""
+    classes = torch.arange(pred.size(1), device=pred.device)
+    target = (labels[:, None] == classes).type_as(pred)
+    if scores is not None:
+        target = target * scores.type_as(pred)[:, None]
+    return target
+
+
+class FusedFocalLossFunction(Function):
+    """Elementwise sigmoid focal or quality focal loss that only keeps its
+    inputs for backward.
+
+    The forward computes the loss without recording the intermediate
+    sigmoid, pt, modulating factor and BCE tensors, and the backward
+    recomputes them to apply the analytic gradient, which follows the
+    backward formulas of the autograd ops of the dense losses.
+    """
+
+    @staticmethod
+    def forward(ctx, pred, labels, scores, weight, gamma, alpha, quality):
+        ctx.save_for_backward(pred, labels, scores, weight)
+        ctx.gamma = gamma
+        ctx.alpha = alpha
+        ctx.quality = quality
+        target = _soft_target(pred, labels, scores)
+        if quality:
+            loss = _quality_term(pred, target, gamma)
+        else:
+            loss = _focal_term(pred, target, gamma, alpha)
+        if weight is not None:
+            loss.mul_(weight.type_as(pred)[:, None])
+        return loss
+
+    @staticmethod
+    @once_differentiable
+    def backward(ctx, grad_output):
+        pred, labels, scores, weight = ctx.saved_tensors
+        gamma, alpha = ctx.gamma, ctx.alpha
+        target = _soft_target(pred, labels, scores)
+        if ctx.quality:
+            # d/dp |t - p|^gamma * bce(p, t)
+            diff = pred - target
+            bce = F.binary_cross_entropy(pred, target, reduction='none')
+            grad = diff.abs().pow(gamma - 1).mul_(diff.sign()).mul_(gamma).mul_(bce)
+            del bce
+            grad.add_(diff.abs().pow_(gamma).mul_(diff).div_(
+                ((1 - pred) * pred).clamp_(min=1e-12)))
+        else:
+            # d/dx a_t * pt^gamma * bce_with_logits(x, t)
+            pred_sigmoid = pred.sigmoid()
+            pt = (1 - pred_sigmoid) * target + pred_sigmoid * (1 - target)
+            alpha_t = alpha * target + (1 - alpha) * (1 - target)
+            bce = F.binary_cross_entropy_with_logits(pred, target, reduction='none')
+            grad = pt.pow(gamma - 1).mul_(gamma).mul_(bce).mul_(
+                pred_sigmoid * (1 - pred_sigmoid)).mul_(1 - 2 * target)
+            del bce
+            grad.add_((pred_sigmoid - target).mul_(pt.pow_(gamma)))
+            grad.mul_(alpha_t)
+        grad.mul_(grad_output)
+        if weight is not None:
+            grad.mul_(weight.type_as(pred)[:, None])
+        return grad, None, None, None, None, None, None
+
+
+def fused_focal_loss(pred,
+                     labels,
+                     scores=None,
+                     weight=None,
+                     gamma=2.0,
+                     alpha=0.25,
+                     quality=False,
+                     reduction='mean',
+                     avg_factor=None):
+    """Focal loss of `FocalLoss`, or quality focal loss of
+    `TaskAlignedFocalLoss` if `quality`, with `FusedFocalLossFunction`.
+
+    Args:
+        pred (Tensor): [N, C], the logits, or the probabilities if `quality`.
+        labels (Tensor): [N], the labels, C for the background.
+        scores (Tensor, optional): [N], the soft label of each query, used
+            by the quality focal loss.
+        weight (Tensor, optional): [N], the weight of each query.
+        gamma (float): the modulating factor. Default: 2.0.
+        alpha (float): the balance of the focal loss. Default: 0.25.
+        quality (bool): compute the quality focal loss. Default: False.
+        reduction (str): 'none', 'mean' or 'sum'. Default: 'mean'.
+        avg_factor (float, optional): the average factor of 'mean'.
+    """
+    if weight is not None:
+        assert weight.dim() == 1 and weight.size(0) == pred.size(0)
+    loss = FusedFocalLossFunction.apply(
+        pred, labels, scores, weight, float(gamma), float(alpha), quality)
+    return weight_reduce_loss(loss, None, reduction, avg_factor)
+
+
+@LOSSES.register_module()
+class FusedFocalLoss(nn.Module):
+    """`FocalLoss` with `FusedFocalLossFunction`, on CPU and on device.
+
+    Args:
+        use_sigmoid (bool, optional): Only sigmoid focal loss is supported.
+        gamma (float, optional): The gamma for calculating the modulating
+            factor. Defaults to 2.0.
+        alpha (float, optional): A balanced form for Focal Loss.
+            Defaults to 0.25.
+        reduction (str, optional): The method used to reduce the loss into
+            a scalar. Defaults to 'mean'. Options are "none", "mean" and
+            "sum".
+        loss_weight (float, optional): Weight of loss. Defaults to 1.0.
+    """
+
+    def __init__(self,
+                 use_sigmoid=True,
+                 gamma=2.0,
+                 alpha=0.25,
+                 reduction='mean',
+                 loss_weight=1.0):
+        super(FusedFocalLoss, self).__init__()
+        assert use_sigmoid is True, 'Only sigmoid focal loss supported now.'
+        self.use_sigmoid = use_sigmoid
+        self.gamma = gamma
+        self.alpha = alpha
+        self.reduction = reduction
+        self.loss_weight = loss_weight
+
+    def forward(self,
+                pred,
+                target,
+                weight=None,
+                avg_factor=None,
+                reduction_override=None):
+        """Forward function.
+
+        Args:
+            pred (torch.Tensor): The logits, [N, C].
+            target (torch.Tensor): The labels [N], C for the background.
+            weight (torch.Tensor, optional): The weight of loss for each
+                prediction. Defaults to None.
+            avg_factor (int, optional): Average factor that is used to average
+                the loss. Defaults to None.
+            reduction_override (str, optional): The reduction method used to
+                override the original reduction method of the loss.
+                Options are "none", "mean" and "sum".
+
+        Returns:
+            torch.Tensor: The calculated loss
+        """
+        assert reduction_override in (None, 'none', 'mean', 'sum')
+        reduction = (
+            reduction_override if reduction_override else self.reduction)
+        return self.loss_weight * fused_focal_loss(
+            pred,
+            target,
+            weight=weight,
+            gamma=self.gamma,
+            alpha=self.alpha,
+            reduction=reduction,
+            avg_factor=avg_factor)
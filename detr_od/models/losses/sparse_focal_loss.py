@@ -0,0 +1,245 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from mmdet.models.builder import LOSSES
+
+
+def _focal_term(pred, target, gamma, alpha):
+    """Elementwise sigmoid focal loss of logits, as `py_sigmoid_focal_loss`."""
+    pred_sigmoid = pred.sigmoid()
+    pt = (1 - pred_sigmoid) * target + pred_sigmoid * (1 - target)
+    focal_weight = (alpha * target + (1 - alpha) * (1 - target)) * pt.pow(gamma)
+    return F.binary_cross_entropy_with_logits(pred, target, reduction='none') * focal_weight
+
+
+def _focal_neg_term(pred, gamma, alpha):
+    """`_focal_term` with a zero target, without building the target."""
+    zeros = pred.new_zeros(()).expand_as(pred)
+    return F.binary_cross_entropy_with_logits(
+        pred, zeros, reduction='none') * ((1 - alpha) * pred.sigmoid().pow(gamma))
+
+
+def _quality_term(prob, target, gamma):
+    """Elementwise quality focal loss of probabilities, as
+    `task_aigned_focal_loss`."""
+    return torch.pow(torch.abs(target - prob), gamma) * F.binary_cross_entropy(
+        prob, target, reduction='none')
+
+
+def _quality_neg_term(prob, gamma):
+    """`_quality_term` with a zero target, without building the target."""
+    zeros = prob.new_zeros(()).expand_as(prob)
+    return torch.pow(prob, gamma) * F.binary_cross_entropy(prob, zeros, reduction='none')
+
+
+def sparse_focal_loss(pred,
+                      pos_inds,
+                      pos_labels,
+                      pos_scores,
+                      weight=None,
+                      gamma=2.0,
+                      alpha=0.25,
+                      quality=False,
+                      reduction='mean',
+                      avg_factor=None):
+    """Sigmoid focal loss with sparse targets.
+
+    Every element is first counted as a negative, which only depends on the
+    predictions, then the terms of the positive (query, class, score)
+    triples are swapped in. Gives the values and gradients of the dense
+    losses without building the one-hot [N, C] targets. Triples with a zero
+    score add nothing, so a fixed number of them, e.g. one per query, can be
+    used without selecting the positives on the host.
+
+    Args:
+        pred (Tensor): [N, C], the logits, or the probabilities if `quality`.
+        pos_inds (Tensor): [P], the query of each positive triple.
+        pos_labels (Tensor): [P], its class.
+        pos_scores (Tensor): [P], its target score, 1 for the focal loss and
+            the soft label of the quality focal loss.
+        weight (Tensor, optional): [N], the weight of each query.
+        gamma (float): the modulating factor. Default: 2.0.
+        alpha (float): the balance of the focal loss, unused by the quality
+            focal loss. Default: 0.25.
+        quality (bool): compute the quality focal loss of
+            `TaskAlignedFocalLoss` instead of the focal loss of `FocalLoss`.
+            Default: False.
+        reduction (str): 'none', 'mean' or 'sum'. Default: 'mean'.
+        avg_factor (float, optional): the average factor of 'mean'.
+
+    Returns:
+        Tensor: the loss, [N, C] if `reduction` is 'none'.
+    """
+    pos_scores = pos_scores.type_as(pred)
+    pos_pred = pred[pos_inds, pos_labels]
+    if quality:
+        loss = _quality_neg_term(pred, gamma)
+        pos_loss = _quality_term(pos_pred, pos_scores, gamma) - _quality_neg_term(pos_pred, gamma)
+    else:
+        loss = _focal_neg_term(pred, gamma, alpha)
+        pos_loss = _focal_term(pos_pred, pos_scores, gamma, alpha) - _focal_neg_term(pos_pred, gamma, alpha)
+    if weight is not None:
+        assert weight.dim() == 1 and weight.size(0) == pred.size(0)
+        weight = weight.type_as(pred)
+        loss = loss * weight[:, None]
+        pos_loss = pos_loss * weight[pos_inds]
+
+    if reduction == 'none':
+        return loss.index_put((pos_inds, pos_labels), pos_loss, accumulate=True)
+    loss = loss.sum() + pos_loss.sum()
+    if reduction == 'mean':
+        loss = loss / (avg_factor if avg_factor is not None else pred.numel())
+    elif avg_factor is not None:
+        raise ValueError('avg_factor can not be used with reduction="sum"')
+    return loss
+
+
+def _dense_to_triples(pred, target, scores=None):
+    """One triple per query from dense labels, background labels (>= C)
+    get a zero score."""
+    num_classes = pred.size(1)
+    pos_mask = (target >= 0) & (target < num_classes)
+    pos_scores = pos_mask.type_as(pred)
+    if scores is not None:
+        pos_scores = pos_scores * scores
+    pos_inds = torch.arange(pred.size(0), device=pred.device)
+    return pos_inds, target.clamp(0, num_classes - 1), pos_scores
+
+
+@LOSSES.register_module()
+class SparseFocalLoss(nn.Module):
+    """`FocalLoss` computed from sparse targets, see `sparse_focal_loss`.
+
+    Args:
+        use_sigmoid (bool, optional): Only sigmoid focal loss is supported.
+        gamma (float, optional): The gamma for calculating the modulating
+            factor. Defaults to 2.0.
+        alpha (float, optional): A balanced form for Focal Loss.
+            Defaults to 0.25.
+        reduction (str, optional): The method used to reduce the loss into
+            a scalar. Defaults to 'mean'. Options are "none", "mean" and
+            "sum".
+        loss_weight (float, optional): Weight of loss. Defaults to 1.0.
+    """
+
+    def __init__(self,
+                 use_sigmoid=True,
+                 gamma=2.0,
+                 alpha=0.25,
+                 reduction='mean',
+                 loss_weight=1.0):
+        super(SparseFocalLoss, self).__init__()
+        assert use_sigmoid is True, 'Only sigmoid focal loss supported now.'
+        self.use_sigmoid = use_sigmoid
+        self.gamma = gamma
+        self.alpha = alpha
+        self.reduction = reduction
+        self.loss_weight = loss_weight
+
+    def forward(self,
+                pred,
+                target,
+                weight=None,
+                avg_factor=None,
+                reduction_override=None):
+        """Forward function.
+
+        Args:
+            pred (torch.Tensor): The logits, [N, C].
+            target (torch.Tensor | tuple[torch.Tensor]): The labels [N], C
+                for the background, or the positive (query, class, score)
+                triples.
+            weight (torch.Tensor, optional): The weight of loss for each
+                prediction. Defaults to None.
+            avg_factor (int, optional): Average factor that is used to average
+                the loss. Defaults to None.
+            reduction_override (str, optional): The reduction method used to
+                override the original reduction method of the loss.
+                Options are "none", "mean" and "sum".
+
+        Returns:
+            torch.Tensor: The calculated loss
+        """
+        assert reduction_override in (None, 'none', 'mean', 'sum')
+        reduction = (
+            reduction_override if reduction_override else self.reduction)
+        if not isinstance(target, (tuple, list)):
+            target = _dense_to_triples(pred, target)
+        return self.loss_weight * sparse_focal_loss(
+            pred,
+            *target,
+            weight=weight,
+            gamma=self.gamma,
+            alpha=self.alpha,
+            reduction=reduction,
+            avg_factor=avg_factor)
+
+
+@LOSSES.register_module()
+class SparseTaskAlignedFocalLoss(nn.Module):
+    """`TaskAlignedFocalLoss` computed from sparse targets, see
+    `sparse_focal_loss`.
+
+    Args:
+        use_sigmoid (bool, optional): Only sigmoid focal loss is supported.
+        gamma (float, optional): The gamma for calculating the modulating
+            factor. Defaults to 2.0.
+        reduction (str, optional): The method used to reduce the loss into
+            a scalar. Defaults to 'mean'. Options are "none", "mean" and
+            "sum".
+        loss_weight (float, optional): Weight of loss. Defaults to 1.0.
+    """
+
+    def __init__(self,
+                 use_sigmoid=True,
+                 gamma=2.0,
+                 reduction='mean',
+                 loss_weight=1.0):
+        super(SparseTaskAlignedFocalLoss, self).__init__()
+        assert use_sigmoid is True, 'Only sigmoid focal loss supported now.'
+        self.use_sigmoid = use_sigmoid
+        self.gamma = gamma
+        self.reduction = reduction
+        self.loss_weight = loss_weight
+
+    def forward(self,
+                prob,
+                target,
+                alignment_metric=None,
+                weight=None,
+                avg_factor=None,
+                reduction_override=None):
+        """Forward function.
+
+        Args:
+            prob (torch.Tensor): The probabilities, [N, C].
+            target (torch.Tensor | tuple[torch.Tensor]): The labels [N], C
+                for the background, or the positive (query, class, score)
+                triples.
+            alignment_metric (torch.Tensor, optional): The soft label of each
+                query with dense labels.
+            weight (torch.Tensor, optional): The weight of loss for each
+                prediction. Defaults to None.
+            avg_factor (int, optional): Average factor that is used to average
+                the loss. Defaults to None.
+            reduction_override (str, optional): The reduction method used to
+                override the original reduction method of the loss.
+                Options are "none", "mean" and "sum".
+
+        Returns:
+            torch.Tensor: The calculated loss
+        """
+        assert reduction_override in (None, 'none', 'mean', 'sum')
+        reduction = (
+            reduction_override if reduction_override else self.reduction)
+        if not isinstance(target, (tuple, list)):
+            target = _dense_to_triples(prob, target, alignment_metric)
+        return self.loss_weight * sparse_focal_loss(
+            prob,
+            *target,
+            weight=weight,
+            gamma=self.gamma,
+            quality=True,
+            reduction=reduction,
+            avg_factor=avg_factor)
@@ -5,6 +5,8 @@ from mmcv.runner import get_dist_info
 from mmdet.models.builder import LOSSES
 from mmdet.models.losses.utils import weight_reduce_loss
 
+from .fused_focal_loss import fused_focal_loss
+
 # python version no_sigmoid
 def focal_loss_with_prob(prob,
                        target,
@@ -143,7 +145,8 @@ class TaskAlignedFocalLoss(nn.Module):
                  use_sigmoid=True,
                  gamma=2.0,
                  reduction='mean',
-                 loss_weight=1.0,):
+                 loss_weight=1.0,
+                 fused=False):
         """`Focal Loss <https://arxiv.org/abs/1708.02002>`_
 
         Args:
@@ -157,6 +160,8 @@ class TaskAlignedFocalLoss(nn.Module):
                 a scalar. Defaults to 'mean'. Options are "none", "mean" and
                 "sum".
             loss_weight (float, optional): Weight of loss. Defaults to 1.0.
+            fused (bool, optional): Use `FusedFocalLossFunction`, which only
+                keeps the inputs for backward. Defaults to False.
         """
         super(TaskAlignedFocalLoss, self).__init__()
         # assert use_sigmoid is True, 'Only sigmoid focal loss supported now.'
@@ -164,6 +169,7 @@ class TaskAlignedFocalLoss(nn.Module):
         self.gamma = gamma
         self.reduction = reduction
         self.loss_weight = loss_weight
+        self.fused = fused
     
     def forward(self,
                 prob,
@@ -191,7 +197,17 @@ class TaskAlignedFocalLoss(nn.Module):
         assert reduction_override in (None, 'none', 'mean', 'sum')
         reduction = (
             reduction_override if reduction_override else self.reduction)
-        if self.use_sigmoid:
+        if self.use_sigmoid and self.fused:
+            loss_cls = self.loss_weight * fused_focal_loss(
+                prob,
+                target,
+                alignment_metric,
+                weight,
+                gamma=self.gamma,
+                quality=True,
+                reduction=reduction,
+                avg_factor=avg_factor)
+        elif self.use_sigmoid:
             loss_cls = self.loss_weight * task_aigned_focal_loss(
                 prob,
                 target,
@@ -1,2 +1,3 @@
 from .transformer import DINOTransformer
-from .positional_encoding import SinePositionalEncodingHW
\ No newline at end of file
+from .positional_encoding import SinePositionalEncodingHW
+from .static_shape import get_img_masks, pad_to_bucket
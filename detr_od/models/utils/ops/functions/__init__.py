@@ -6,5 +6,5 @@
 # Modified from https://github.com/chengdazhi/Deformable-Convolution-V2-PyTorch/tree/pytorch_1.0.0
 # ------------------------------------------------------------------------------------------------
 
-from .ms_deform_attn_func import MSDeformAttnFunction
+from .ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_core_pytorch
 
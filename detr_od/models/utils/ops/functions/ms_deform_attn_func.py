@@ -40,7 +40,7 @@ class MSDeformAttnFunction(Function):
 
 def ms_deform_attn_core_pytorch(value, value_spatial_shapes, sampling_locations, attention_weights):
     # for debug and test only,
-    # need to use cuda version instead
+    # need to use the compiled (cuda or cpu) version instead
     N_, S_, M_, D_ = value.shape
     _, Lq_, M_, L_, P_, _ = sampling_locations.shape
     value_list = value.split([H_ * W_ for H_, W_ in value_spatial_shapes], dim=1)
@@ -30,7 +30,8 @@ def get_extensions():
 
     sources = main_file + source_cpu
     extension = CppExtension
-    extra_compile_args = {"cxx": []}
+    extra_compile_args = {"cxx": ["-fopenmp"]}
+    extra_link_args = ["-fopenmp"]
     define_macros = []
 
     # import ipdb; ipdb.set_trace()
@@ -45,7 +46,7 @@ def get_extensions():
             "-D__CUDA_NO_HALF_CONVERSIONS__",
             "-D__CUDA_NO_HALF2_OPERATORS__",
         ]
-    else:
+    elif os.environ.get("FORCE_CUDA", "0") == "1":
         raise NotImplementedError('Cuda is not availabel')
 
     sources = [os.path.join(extensions_dir, s) for s in sources]
@@ -57,6 +58,7 @@ def get_extensions():
             include_dirs=include_dirs,
             define_macros=define_macros,
             extra_compile_args=extra_compile_args,
+            extra_link_args=extra_link_args,
         )
     ]
     return ext_modules
@@ -66,7 +68,7 @@ setup(
     version="1.0",
     author="Weijie Su",
     url="https://github.com/fundamentalvision/Deformable-DETR",
-    description="PyTorch Wrapper for CUDA Functions of Multi-Scale Deformable Attention",
+    description="PyTorch Wrapper for CUDA/CPU Functions of Multi-Scale Deformable Attention",
     packages=find_packages(exclude=("configs", "tests",)),
     ext_modules=get_extensions(),
     cmdclass={"build_ext": torch.utils.cpp_extension.BuildExtension},
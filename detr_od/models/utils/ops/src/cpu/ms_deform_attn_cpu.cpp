@@ -8,27 +8,304 @@
 **************************************************************************************************
 */
 
+#include <cmath>
 #include <vector>
 
 #include <ATen/ATen.h>
-#include <ATen/cuda/CUDAContext.h>
+#include <ATen/Parallel.h>
+
+
+// Sampling follows the CUDA kernels (and F.grid_sample with align_corners=False):
+// a normalized location (loc_w, loc_h) in [0, 1] maps to (loc_w * W - 0.5, loc_h * H - 0.5)
+// and out-of-range neighbours contribute zero.
+
+template <typename scalar_t>
+static void ms_deform_attn_cpu_bilinear_forward(const scalar_t *value_ptr,
+                                                const int height, const int width, const int qid_stride,
+                                                const int channels, const scalar_t h, const scalar_t w,
+                                                const scalar_t attn_weight, scalar_t *out_ptr)
+{
+  const int h_low = std::floor(h);
+  const int w_low = std::floor(w);
+  const int h_high = h_low + 1;
+  const int w_high = w_low + 1;
+
+  const scalar_t lh = h - h_low;
+  const scalar_t lw = w - w_low;
+  const scalar_t hh = 1 - lh, hw = 1 - lw;
+  const scalar_t w1 = hh * hw * attn_weight, w2 = hh * lw * attn_weight;
+  const scalar_t w3 = lh * hw * attn_weight, w4 = lh * lw * attn_weight;
+
+  const bool has_h_low = h_low >= 0, has_w_low = w_low >= 0;
+  const bool has_h_high = h_high <= height - 1, has_w_high = w_high <= width - 1;
+
+  const int ptr1 = (h_low * width + w_low) * qid_stride;
+  const int ptr2 = (h_low * width + w_high) * qid_stride;
+  const int ptr3 = (h_high * width + w_low) * qid_stride;
+  const int ptr4 = (h_high * width + w_high) * qid_stride;
+
+  for (int c = 0; c < channels; ++c)
+  {
+    scalar_t val = 0;
+    if (has_h_low && has_w_low) val += w1 * value_ptr[ptr1 + c];
+    if (has_h_low && has_w_high) val += w2 * value_ptr[ptr2 + c];
+    if (has_h_high && has_w_low) val += w3 * value_ptr[ptr3 + c];
+    if (has_h_high && has_w_high) val += w4 * value_ptr[ptr4 + c];
+    out_ptr[c] += val;
+  }
+}
+
+
+template <typename scalar_t>
+static void ms_deform_attn_cpu_bilinear_backward(const scalar_t *value_ptr,
+                                                 const int height, const int width, const int qid_stride,
+                                                 const int channels, const scalar_t h, const scalar_t w,
+                                                 const scalar_t attn_weight, const scalar_t *top_grad,
+                                                 scalar_t *grad_value_ptr,
+                                                 scalar_t *grad_sampling_loc,
+                                                 scalar_t *grad_attn_weight)
+{
+  const int h_low = std::floor(h);
+  const int w_low = std::floor(w);
+  const int h_high = h_low + 1;
+  const int w_high = w_low + 1;
+
+  const scalar_t lh = h - h_low;
+  const scalar_t lw = w - w_low;
+  const scalar_t hh = 1 - lh, hw = 1 - lw;
+  const scalar_t w1 = hh * hw, w2 = hh * lw, w3 = lh * hw, w4 = lh * lw;
+
+  const bool has_h_low = h_low >= 0, has_w_low = w_low >= 0;
+  const bool has_h_high = h_high <= height - 1, has_w_high = w_high <= width - 1;
+
+  const int ptr1 = (h_low * width + w_low) * qid_stride;
+  const int ptr2 = (h_low * width + w_high) * qid_stride;
+  const int ptr3 = (h_high * width + w_low) * qid_stride;
+  const int ptr4 = (h_high * width + w_high) * qid_stride;
+
+  scalar_t grad_h = 0, grad_w = 0, grad_weight = 0;
+  for (int c = 0; c < channels; ++c)
+  {
+    const scalar_t top_grad_value = top_grad[c] * attn_weight;
+    scalar_t grad_h_weight = 0, grad_w_weight = 0, val = 0;
+    if (has_h_low && has_w_low)
+    {
+      const scalar_t v1 = value_ptr[ptr1 + c];
+      grad_h_weight -= hw * v1;
+      grad_w_weight -= hh * v1;
+      val += w1 * v1;
+      grad_value_ptr[ptr1 + c] += w1 * top_grad_value;
+    }
+    if (has_h_low && has_w_high)
+    {
+      const scalar_t v2 = value_ptr[ptr2 + c];
+      grad_h_weight -= lw * v2;
+      grad_w_weight += hh * v2;
+      val += w2 * v2;
+      grad_value_ptr[ptr2 + c] += w2 * top_grad_value;
+    }
+    if (has_h_high && has_w_low)
+    {
+      const scalar_t v3 = value_ptr[ptr3 + c];
+      grad_h_weight += hw * v3;
+      grad_w_weight -= lh * v3;
+      val += w3 * v3;
+      grad_value_ptr[ptr3 + c] += w3 * top_grad_value;
+    }
+    if (has_h_high && has_w_high)
+    {
+      const scalar_t v4 = value_ptr[ptr4 + c];
+      grad_h_weight += lw * v4;
+      grad_w_weight += lh * v4;
+      val += w4 * v4;
+      grad_value_ptr[ptr4 + c] += w4 * top_grad_value;
+    }
+    grad_weight += top_grad[c] * val;
+    grad_w += width * grad_w_weight * top_grad_value;
+    grad_h += height * grad_h_weight * top_grad_value;
+  }
+  *grad_attn_weight += grad_weight;
+  grad_sampling_loc[0] += grad_w;
+  grad_sampling_loc[1] += grad_h;
+}
+
+
+template <typename scalar_t>
+static void ms_deformable_im2col_cpu(const scalar_t *data_value,
+                                     const int64_t *data_spatial_shapes,
+                                     const int64_t *data_level_start_index,
+                                     const scalar_t *data_sampling_loc,
+                                     const scalar_t *data_attn_weight,
+                                     const int batch_size,
+                                     const int spatial_size,
+                                     const int num_heads,
+                                     const int channels,
+                                     const int num_levels,
+                                     const int num_query,
+                                     const int num_point,
+                                     scalar_t *data_col)
+{
+  const int qid_stride = num_heads * channels;
+  // every (batch, query, head) owns a disjoint slice of the output
+  at::parallel_for(0, batch_size * num_query * num_heads, 0, [&](int64_t begin, int64_t end) {
+    for (int64_t index = begin; index < end; ++index)
+    {
+      const int m_col = index % num_heads;
+      const int b_col = index / (num_query * num_heads);
+
+      scalar_t *data_col_ptr = data_col + index * channels;
+      const scalar_t *data_loc_ptr = data_sampling_loc + index * num_levels * num_point * 2;
+      const scalar_t *data_weight_ptr = data_attn_weight + index * num_levels * num_point;
+      const scalar_t *data_value_batch = data_value + b_col * spatial_size * qid_stride + m_col * channels;
+
+      for (int l_col = 0; l_col < num_levels; ++l_col)
+      {
+        const int spatial_h = data_spatial_shapes[l_col * 2];
+        const int spatial_w = data_spatial_shapes[l_col * 2 + 1];
+        const scalar_t *data_value_ptr = data_value_batch + data_level_start_index[l_col] * qid_stride;
+        for (int p_col = 0; p_col < num_point; ++p_col)
+        {
+          const scalar_t loc_w = data_loc_ptr[0];
+          const scalar_t loc_h = data_loc_ptr[1];
+          const scalar_t weight = *data_weight_ptr;
+
+          const scalar_t h_im = loc_h * spatial_h - 0.5;
+          const scalar_t w_im = loc_w * spatial_w - 0.5;
+
+          if (h_im > -1 && w_im > -1 && h_im < spatial_h && w_im < spatial_w)
+          {
+            ms_deform_attn_cpu_bilinear_forward(data_value_ptr, spatial_h, spatial_w, qid_stride,
+                                                channels, h_im, w_im, weight, data_col_ptr);
+          }
+          data_weight_ptr += 1;
+          data_loc_ptr += 2;
+        }
+      }
+    }
+  });
+}
+
+
+template <typename scalar_t>
+static void ms_deformable_col2im_cpu(const scalar_t *grad_col,
+                                     const scalar_t *data_value,
+                                     const int64_t *data_spatial_shapes,
+                                     const int64_t *data_level_start_index,
+                                     const scalar_t *data_sampling_loc,
+                                     const scalar_t *data_attn_weight,
+                                     const int batch_size,
+                                     const int spatial_size,
+                                     const int num_heads,
+                                     const int channels,
+                                     const int num_levels,
+                                     const int num_query,
+                                     const int num_point,
+                                     scalar_t *grad_value,
+                                     scalar_t *grad_sampling_loc,
+                                     scalar_t *grad_attn_weight)
+{
+  const int qid_stride = num_heads * channels;
+  // queries of the same (batch, head) scatter into the same value slice, so the work is split
+  // across (batch, head) pairs to keep the grad_value accumulation race-free without atomics
+  at::parallel_for(0, batch_size * num_heads, 0, [&](int64_t begin, int64_t end) {
+    for (int64_t bm = begin; bm < end; ++bm)
+    {
+      const int b_col = bm / num_heads;
+      const int m_col = bm % num_heads;
+      const int value_offset = b_col * spatial_size * qid_stride + m_col * channels;
+
+      for (int q_col = 0; q_col < num_query; ++q_col)
+      {
+        const int64_t sampling_index = (b_col * num_query + q_col) * num_heads + m_col;
+        const scalar_t *top_grad = grad_col + sampling_index * channels;
+        const int weight_offset = sampling_index * num_levels * num_point;
+
+        for (int l_col = 0; l_col < num_levels; ++l_col)
+        {
+          const int spatial_h = data_spatial_shapes[l_col * 2];
+          const int spatial_w = data_spatial_shapes[l_col * 2 + 1];
+          const int level_offset = value_offset + data_level_start_index[l_col] * qid_stride;
+          for (int p_col = 0; p_col < num_point; ++p_col)
+          {
+            const int weight_ptr = weight_offset + l_col * num_point + p_col;
+            const int loc_ptr = weight_ptr << 1;
+            const scalar_t loc_w = data_sampling_loc[loc_ptr];
+            const scalar_t loc_h = data_sampling_loc[loc_ptr + 1];
+            const scalar_t weight = data_attn_weight[weight_ptr];
+
+            const scalar_t h_im = loc_h * spatial_h - 0.5;
+            const scalar_t w_im = loc_w * spatial_w - 0.5;
+
+            if (h_im > -1 && w_im > -1 && h_im < spatial_h && w_im < spatial_w)
+            {
+              ms_deform_attn_cpu_bilinear_backward(data_value + level_offset, spatial_h, spatial_w,
+                                                   qid_stride, channels, h_im, w_im, weight, top_grad,
+                                                   grad_value + level_offset,
+                                                   grad_sampling_loc + loc_ptr,
+                                                   grad_attn_weight + weight_ptr);
+            }
+          }
+        }
+      }
+    }
+  });
+}
 
 
 at::Tensor
 ms_deform_attn_cpu_forward(
-    const at::Tensor &value, 
+    const at::Tensor &value,
     const at::Tensor &spatial_shapes,
     const at::Tensor &level_start_index,
     const at::Tensor &sampling_loc,
     const at::Tensor &attn_weight,
     const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
+    AT_ASSERTM(value.is_contiguous(), "value tensor has to be contiguous");
+    AT_ASSERTM(spatial_shapes.is_contiguous(), "spatial_shapes tensor has to be contiguous");
+    AT_ASSERTM(level_start_index.is_contiguous(), "level_start_index tensor has to be contiguous");
+    AT_ASSERTM(sampling_loc.is_contiguous(), "sampling_loc tensor has to be contiguous");
+    AT_ASSERTM(attn_weight.is_contiguous(), "attn_weight tensor has to be contiguous");
+
+    AT_ASSERTM(!value.is_cuda(), "value must be a CPU tensor");
+    AT_ASSERTM(!spatial_shapes.is_cuda(), "spatial_shapes must be a CPU tensor");
+    AT_ASSERTM(!level_start_index.is_cuda(), "level_start_index must be a CPU tensor");
+    AT_ASSERTM(!sampling_loc.is_cuda(), "sampling_loc must be a CPU tensor");
+    AT_ASSERTM(!attn_weight.is_cuda(), "attn_weight must be a CPU tensor");
+
+    const int batch = value.size(0);
+    const int spatial_size = value.size(1);
+    const int num_heads = value.size(2);
+    const int channels = value.size(3);
+
+    const int num_levels = spatial_shapes.size(0);
+
+    const int num_query = sampling_loc.size(1);
+    const int num_point = sampling_loc.size(4);
+
+    // im2col_step only bounds the CUDA column buffer; the CPU kernel works on the whole batch
+    auto output = at::zeros({batch, num_query, num_heads, channels}, value.options());
+
+    AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_forward_cpu", ([&] {
+        ms_deformable_im2col_cpu(
+            value.data_ptr<scalar_t>(),
+            spatial_shapes.data_ptr<int64_t>(),
+            level_start_index.data_ptr<int64_t>(),
+            sampling_loc.data_ptr<scalar_t>(),
+            attn_weight.data_ptr<scalar_t>(),
+            batch, spatial_size, num_heads, channels, num_levels, num_query, num_point,
+            output.data_ptr<scalar_t>());
+    }));
+
+    output = output.view({batch, num_query, num_heads*channels});
+
+    return output;
 }
 
+
 std::vector<at::Tensor>
 ms_deform_attn_cpu_backward(
-    const at::Tensor &value, 
+    const at::Tensor &value,
     const at::Tensor &spatial_shapes,
     const at::Tensor &level_start_index,
     const at::Tensor &sampling_loc,
@@ -36,6 +313,49 @@ ms_deform_attn_cpu_backward(
     const at::Tensor &grad_output,
     const int im2col_step)
 {
-    AT_ERROR("Not implement on cpu");
-}
+    AT_ASSERTM(value.is_contiguous(), "value tensor has to be contiguous");
+    AT_ASSERTM(spatial_shapes.is_contiguous(), "spatial_shapes tensor has to be contiguous");
+    AT_ASSERTM(level_start_index.is_contiguous(), "level_start_index tensor has to be contiguous");
+    AT_ASSERTM(sampling_loc.is_contiguous(), "sampling_loc tensor has to be contiguous");
+    AT_ASSERTM(attn_weight.is_contiguous(), "attn_weight tensor has to be contiguous");
+
+    AT_ASSERTM(!value.is_cuda(), "value must be a CPU tensor");
+    AT_ASSERTM(!spatial_shapes.is_cuda(), "spatial_shapes must be a CPU tensor");
+    AT_ASSERTM(!level_start_index.is_cuda(), "level_start_index must be a CPU tensor");
+    AT_ASSERTM(!sampling_loc.is_cuda(), "sampling_loc must be a CPU tensor");
+    AT_ASSERTM(!attn_weight.is_cuda(), "attn_weight must be a CPU tensor");
+    AT_ASSERTM(!grad_output.is_cuda(), "grad_output must be a CPU tensor");
 
+    const int batch = value.size(0);
+    const int spatial_size = value.size(1);
+    const int num_heads = value.size(2);
+    const int channels = value.size(3);
+
+    const int num_levels = spatial_shapes.size(0);
+
+    const int num_query = sampling_loc.size(1);
+    const int num_point = sampling_loc.size(4);
+
+    auto grad_output_ = grad_output.contiguous();
+    auto grad_value = at::zeros_like(value);
+    auto grad_sampling_loc = at::zeros_like(sampling_loc);
+    auto grad_attn_weight = at::zeros_like(attn_weight);
+
+    AT_DISPATCH_FLOATING_TYPES(value.scalar_type(), "ms_deform_attn_backward_cpu", ([&] {
+        ms_deformable_col2im_cpu(
+            grad_output_.data_ptr<scalar_t>(),
+            value.data_ptr<scalar_t>(),
+            spatial_shapes.data_ptr<int64_t>(),
+            level_start_index.data_ptr<int64_t>(),
+            sampling_loc.data_ptr<scalar_t>(),
+            attn_weight.data_ptr<scalar_t>(),
+            batch, spatial_size, num_heads, channels, num_levels, num_query, num_point,
+            grad_value.data_ptr<scalar_t>(),
+            grad_sampling_loc.data_ptr<scalar_t>(),
+            grad_attn_weight.data_ptr<scalar_t>());
+    }));
+
+    return {
+        grad_value, grad_sampling_loc, grad_attn_weight
+    };
+}
@@ -20,52 +20,56 @@ from functions.ms_deform_attn_func import MSDeformAttnFunction, ms_deform_attn_c
 
 N, M, D = 1, 2, 2
 Lq, L, P = 2, 2, 2
-shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long).cuda()
+shapes = torch.as_tensor([(6, 4), (3, 2)], dtype=torch.long)
 level_start_index = torch.cat((shapes.new_zeros((1, )), shapes.prod(1).cumsum(0)[:-1]))
 S = sum([(H*W).item() for H, W in shapes])
+devices = (['cuda'] if torch.cuda.is_available() else []) + ['cpu']
 
 
 torch.manual_seed(3)
 
 
 @torch.no_grad()
-def check_forward_equal_with_pytorch_double():
-    value = torch.rand(N, S, M, D).cuda() * 0.01
-    sampling_locations = torch.rand(N, Lq, M, L, P, 2).cuda()
-    attention_weights = torch.rand(N, Lq, M, L, P).cuda() + 1e-5
+def check_forward_equal_with_pytorch_double(device='cuda'):
+    value = torch.rand(N, S, M, D).to(device) * 0.01
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2).to(device)
+    attention_weights = torch.rand(N, Lq, M, L, P).to(device) + 1e-5
     attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    shapes_, level_start_index_ = shapes.to(device), level_start_index.to(device)
     im2col_step = 2
-    output_pytorch = ms_deform_attn_core_pytorch(value.double(), shapes, sampling_locations.double(), attention_weights.double()).detach().cpu()
-    output_cuda = MSDeformAttnFunction.apply(value.double(), shapes, level_start_index, sampling_locations.double(), attention_weights.double(), im2col_step).detach().cpu()
-    fwdok = torch.allclose(output_cuda, output_pytorch)
-    max_abs_err = (output_cuda - output_pytorch).abs().max()
-    max_rel_err = ((output_cuda - output_pytorch).abs() / output_pytorch.abs()).max()
+    output_pytorch = ms_deform_attn_core_pytorch(value.double(), shapes_, sampling_locations.double(), attention_weights.double()).detach().cpu()
+    output_msda = MSDeformAttnFunction.apply(value.double(), shapes_, level_start_index_, sampling_locations.double(), attention_weights.double(), im2col_step).detach().cpu()
+    fwdok = torch.allclose(output_msda, output_pytorch)
+    max_abs_err = (output_msda - output_pytorch).abs().max()
+    max_rel_err = ((output_msda - output_pytorch).abs() / output_pytorch.abs()).max()
 
-    print(f'* {fwdok} check_forward_equal_with_pytorch_double: max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
+    print(f'* {fwdok} check_forward_equal_with_pytorch_double({device}): max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
 
 
 @torch.no_grad()
-def check_forward_equal_with_pytorch_float():
-    value = torch.rand(N, S, M, D).cuda() * 0.01
-    sampling_locations = torch.rand(N, Lq, M, L, P, 2).cuda()
-    attention_weights = torch.rand(N, Lq, M, L, P).cuda() + 1e-5
+def check_forward_equal_with_pytorch_float(device='cuda'):
+    value = torch.rand(N, S, M, D).to(device) * 0.01
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2).to(device)
+    attention_weights = torch.rand(N, Lq, M, L, P).to(device) + 1e-5
     attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    shapes_, level_start_index_ = shapes.to(device), level_start_index.to(device)
     im2col_step = 2
-    output_pytorch = ms_deform_attn_core_pytorch(value, shapes, sampling_locations, attention_weights).detach().cpu()
-    output_cuda = MSDeformAttnFunction.apply(value, shapes, level_start_index, sampling_locations, attention_weights, im2col_step).detach().cpu()
-    fwdok = torch.allclose(output_cuda, output_pytorch, rtol=1e-2, atol=1e-3)
-    max_abs_err = (output_cuda - output_pytorch).abs().max()
-    max_rel_err = ((output_cuda - output_pytorch).abs() / output_pytorch.abs()).max()
+    output_pytorch = ms_deform_attn_core_pytorch(value, shapes_, sampling_locations, attention_weights).detach().cpu()
+    output_msda = MSDeformAttnFunction.apply(value, shapes_, level_start_index_, sampling_locations, attention_weights, im2col_step).detach().cpu()
+    fwdok = torch.allclose(output_msda, output_pytorch, rtol=1e-2, atol=1e-3)
+    max_abs_err = (output_msda - output_pytorch).abs().max()
+    max_rel_err = ((output_msda - output_pytorch).abs() / output_pytorch.abs()).max()
 
-    print(f'* {fwdok} check_forward_equal_with_pytorch_float: max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
+    print(f'* {fwdok} check_forward_equal_with_pytorch_float({device}): max_abs_err {max_abs_err:.2e} max_rel_err {max_rel_err:.2e}')
 
 
-def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True, grad_attn_weight=True):
+def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True, grad_attn_weight=True, device='cuda'):
 
-    value = torch.rand(N, S, M, channels).cuda() * 0.01
-    sampling_locations = torch.rand(N, Lq, M, L, P, 2).cuda()
-    attention_weights = torch.rand(N, Lq, M, L, P).cuda() + 1e-5
+    value = torch.rand(N, S, M, channels).to(device) * 0.01
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2).to(device)
+    attention_weights = torch.rand(N, Lq, M, L, P).to(device) + 1e-5
     attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    shapes_, level_start_index_ = shapes.to(device), level_start_index.to(device)
     im2col_step = 2
     func = MSDeformAttnFunction.apply
 
@@ -73,17 +77,41 @@ def check_gradient_numerical(channels=4, grad_value=True, grad_sampling_loc=True
     sampling_locations.requires_grad = grad_sampling_loc
     attention_weights.requires_grad = grad_attn_weight
 
-    gradok = gradcheck(func, (value.double(), shapes, level_start_index, sampling_locations.double(), attention_weights.double(), im2col_step))
+    gradok = gradcheck(func, (value.double(), shapes_, level_start_index_, sampling_locations.double(), attention_weights.double(), im2col_step))
 
-    print(f'* {gradok} check_gradient_numerical(D={channels})')
+    print(f'* {gradok} check_gradient_numerical(D={channels}, {device})')
 
 
-if __name__ == '__main__':
-    check_forward_equal_with_pytorch_double()
-    check_forward_equal_with_pytorch_float()
+def check_gradient_equal_with_pytorch(channels=4, device='cuda'):
+    value = torch.rand(N, S, M, channels).to(device).double() * 0.01
+    sampling_locations = torch.rand(N, Lq, M, L, P, 2).to(device).double()
+    attention_weights = torch.rand(N, Lq, M, L, P).to(device).double() + 1e-5
+    attention_weights /= attention_weights.sum(-1, keepdim=True).sum(-2, keepdim=True)
+    shapes_, level_start_index_ = shapes.to(device), level_start_index.to(device)
+    im2col_step = 2
+    grad_output = torch.rand(N, Lq, M * channels).to(device).double()
 
-    for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
-        check_gradient_numerical(channels, True, True, True)
+    grads = []
+    for use_msda in (True, False):
+        inputs = [t.clone().requires_grad_() for t in (value, sampling_locations, attention_weights)]
+        if use_msda:
+            output = MSDeformAttnFunction.apply(inputs[0], shapes_, level_start_index_, inputs[1], inputs[2], im2col_step)
+        else:
+            output = ms_deform_attn_core_pytorch(inputs[0], shapes_, inputs[1], inputs[2])
+        output.backward(grad_output)
+        grads.append([t.grad.detach().cpu() for t in inputs])
 
+    gradok = all(torch.allclose(g_msda, g_pytorch) for g_msda, g_pytorch in zip(*grads))
+    max_abs_err = max((g_msda - g_pytorch).abs().max() for g_msda, g_pytorch in zip(*grads))
 
+    print(f'* {gradok} check_gradient_equal_with_pytorch(D={channels}, {device}): max_abs_err {max_abs_err:.2e}')
+
+
+if __name__ == '__main__':
+    for device in devices:
+        check_forward_equal_with_pytorch_double(device)
+        check_forward_equal_with_pytorch_float(device)
 
+        for channels in [30, 32, 64, 71, 1025, 2048, 3096]:
+            check_gradient_numerical(channels, True, True, True, device)
+            check_gradient_equal_with_pytorch(channels, device)
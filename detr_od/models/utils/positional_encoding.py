@@ -1,11 +1,19 @@
 # Copyright (c) OpenMMLab. All rights reserved.
 import math
+from collections import OrderedDict
 
 import torch
 import torch.nn as nn
 from mmcv.cnn.bricks.transformer import POSITIONAL_ENCODING
 from mmcv.runner import BaseModule
 
+from .static_shape import is_compiling
+
+# shared by every SinePositionalEncodingHW instance (e.g. teacher and student),
+# entries are keyed on the encoding hyper-parameters as well
+_POS_ENCODING_CACHE = OrderedDict()
+
+
 @POSITIONAL_ENCODING.register_module()
 class SinePositionalEncodingHW(BaseModule):
     """Position encoding with sine and cosine functions.
@@ -28,6 +36,10 @@ class SinePositionalEncodingHW(BaseModule):
             numerical stability. Defaults to 1e-6.
         offset (float): offset add to embed when do the normalization.
             Defaults to 0.
+        cache_size (int): Max number of per-image encodings kept in the
+            cache, keyed on mask shape plus the valid extents of the image.
+            The cache assumes the usual top-left valid region of a padded
+            batch. 0 disables the cache. Defaults to 0.
         init_cfg (dict or list[dict], optional): Initialization config dict.
             Default: None
     """
@@ -40,6 +52,7 @@ class SinePositionalEncodingHW(BaseModule):
                  scale=2 * math.pi,
                  eps=1e-6,
                  offset=0.,
+                 cache_size=0,
                  init_cfg=None):
         super(SinePositionalEncodingHW, self).__init__(init_cfg)
         if normalize:
@@ -53,10 +66,56 @@ class SinePositionalEncodingHW(BaseModule):
         self.scale = scale
         self.eps = eps
         self.offset = offset
+        self.cache_size = cache_size
 
     def forward(self, mask):
         """Forward function for `SinePositionalEncoding`.
 
+        Args:
+            mask (Tensor): ByteTensor mask. Non-zero values representing
+                ignored positions, while zero values means valid positions
+                for this image. Shape [bs, h, w].
+
+        Returns:
+            pos (Tensor): Returned position embedding with shape
+                [bs, num_feats*2, h, w].
+        """
+        # the cache lookup reads the valid extents on the host, skip it
+        # when exporting or compiling
+        if self.cache_size > 0 and not torch.onnx.is_in_onnx_export() \
+                and not is_compiling():
+            return self.forward_cached(mask)
+        return self.compute_encoding(mask)
+
+    def forward_cached(self, mask):
+        """Look up the encoding of every image in the cache and only compute
+        the missing ones."""
+        B, H, W = mask.size()
+        not_mask = ~mask.bool()
+        valid_extents = torch.stack(
+            [not_mask[:, :, 0].sum(1), not_mask[:, 0, :].sum(1)], 1).tolist()
+        prefix = (self.num_feats, self.temperatureH, self.temperatureW,
+                  self.normalize, self.scale, self.eps, self.offset,
+                  str(mask.device), H, W)
+        keys = [prefix + tuple(extent) for extent in valid_extents]
+
+        missing = [i for i, key in enumerate(keys)
+                   if key not in _POS_ENCODING_CACHE]
+        if missing:
+            pos_missing = self.compute_encoding(mask[missing])
+            for i, pos in zip(missing, pos_missing):
+                _POS_ENCODING_CACHE[keys[i]] = pos
+
+        pos = torch.stack([_POS_ENCODING_CACHE[key] for key in keys], 0)
+        for key in keys:
+            _POS_ENCODING_CACHE.move_to_end(key)
+        while len(_POS_ENCODING_CACHE) > self.cache_size:
+            _POS_ENCODING_CACHE.popitem(last=False)
+        return pos
+
+    def compute_encoding(self, mask):
+        """Compute the position embedding from the mask, bypassing the cache.
+
         Args:
             mask (Tensor): ByteTensor mask. Non-zero values representing
                 ignored positions, while zero values means valid positions
@@ -106,7 +165,8 @@ class SinePositionalEncodingHW(BaseModule):
         repr_str += f'temperatureW={self.temperatureW}, '
         repr_str += f'normalize={self.normalize}, '
         repr_str += f'scale={self.scale}, '
-        repr_str += f'eps={self.eps})'
+        repr_str += f'eps={self.eps}, '
+        repr_str += f'cache_size={self.cache_size})'
         return repr_str
 
 
@@ -0,0 +1,79 @@
+import torch
+import torch.nn.functional as F
+
+
+def is_compiling():
+    """Whether the code is being traced by torch.compile (dynamo)."""
+    compiler = getattr(torch, 'compiler', None)
+    if compiler is not None and hasattr(compiler, 'is_compiling'):
+        return compiler.is_compiling()
+    dynamo = getattr(torch, '_dynamo', None)
+    if dynamo is not None and hasattr(dynamo, 'is_compiling'):
+        return dynamo.is_compiling()
+    return False
+
+
+def round_up_to_bucket(size, buckets):
+    """Round `size` up to the smallest bucket that fits it.
+
+    Args:
+        size (int): the size to round.
+        buckets (int | Sequence[int]): a granularity, or the sorted sizes
+            allowed. Sizes larger than the last bucket are rounded up to a
+            multiple of it.
+    """
+    if isinstance(buckets, int):
+        return -(-size // buckets) * buckets
+    for bucket in buckets:
+        if size <= bucket:
+            return bucket
+    return -(-size // buckets[-1]) * buckets[-1]
+
+
+def pad_to_bucket(img, img_metas, size_buckets=None, size_divisor=128):
+    """Pad a batch of images to a fixed set of shapes.
+
+    Args:
+        img (Tensor): [bs, c, h, w], the collated images.
+        img_metas (list[dict]): meta information of each image, the
+            `batch_input_shape` is updated to the padded shape.
+        size_buckets (Sequence[tuple[int]], optional): the (h, w) allowed,
+            the first bucket that fits the batch is used.
+        size_divisor (int): used to round h and w separately when no bucket
+            fits the batch. Default: 128.
+
+    Returns:
+        tuple[Tensor, list[dict]]: the padded images and their metas.
+    """
+    h, w = img.shape[-2:]
+    pad_h = pad_w = None
+    for bucket_h, bucket_w in (size_buckets or []):
+        if h <= bucket_h and w <= bucket_w:
+            pad_h, pad_w = bucket_h, bucket_w
+            break
+    if pad_h is None:
+        pad_h = round_up_to_bucket(h, size_divisor)
+        pad_w = round_up_to_bucket(w, size_divisor)
+    if (pad_h, pad_w) != (h, w):
+        img = F.pad(img, (0, pad_w - w, 0, pad_h - h), value=0)
+    for img_meta in img_metas:
+        img_meta['batch_input_shape'] = (pad_h, pad_w)
+    return img, img_metas
+
+
+def get_img_masks(img_metas, like):
+    """Build the padding masks [bs, h, w] of a batch, 1 for padding and 0
+    for the valid area of each image.
+
+    Args:
+        img_metas (list[dict]): meta information of each image.
+        like (Tensor): any tensor on the target device and of the target
+            dtype, usually the first feature map.
+    """
+    batch_size = len(img_metas)
+    input_img_h, input_img_w = img_metas[0]['batch_input_shape']
+    img_masks = like.new_ones((batch_size, input_img_h, input_img_w))
+    for img_id in range(batch_size):
+        img_h, img_w, _ = img_metas[img_id]['img_shape']
+        img_masks[img_id, :img_h, :img_w] = 0
+    return img_masks
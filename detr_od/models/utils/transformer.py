@@ -10,11 +10,13 @@ import matplotlib.pyplot as plt
 from typing import Sequence
 from typing import Optional
 import copy
+import functools
 import torch
 import torch.nn as nn
 from torch import Tensor
 from torch.nn import init
 import torch.nn.functional as F
+import torch.utils.checkpoint as cp
 from torch.nn.modules.utils import _pair
 from mmcv.runner import auto_fp16, force_fp32
 from mmcv.runner.base_module import BaseModule, ModuleList, Sequential
@@ -53,6 +55,7 @@ except ImportError:
     from mmcv.cnn.bricks.transformer import MultiScaleDeformableAttention 
 # import the MSDeformAttn of the original DCN repo
 from .ops.modules import MSDeformAttn
+from .static_shape import is_compiling
 DEBUG = 'DEBUG' in os.environ
 
 def nlc_to_nchw(x, hw_shape):
@@ -498,6 +501,17 @@ def gen_sineembed_for_position(pos_tensor):
 #####################################################
 # DINO Transformer Part
 
+def _set_layers_with_cp(layers, with_cp):
+    """Set activation checkpointing for all the layers (bool) or per layer
+    (list of bool)."""
+    if isinstance(with_cp, bool):
+        with_cp = [with_cp] * len(layers)
+    assert len(with_cp) == len(layers), \
+        f'with_cp has {len(with_cp)} entries for {len(layers)} layers'
+    for layer, layer_with_cp in zip(layers, with_cp):
+        layer.with_cp = layer_with_cp
+
+
 def _get_clones(module, N, layer_share=False):
     if layer_share:
         return nn.ModuleList([module for i in range(N)])
@@ -521,6 +535,108 @@ def _get_activation_fn(activation, d_model=256, batch_dim=0):
     raise RuntimeError(F"activation should be relu/gelu, not {activation}.")
 
 
+def _spatial_shapes_key(spatial_shapes):
+    """Turn spatial_shapes ([num_level, 2] tensor or sequence) into a hashable tuple."""
+    if isinstance(spatial_shapes, Tensor):
+        spatial_shapes = spatial_shapes.tolist()
+    return tuple((int(H_), int(W_)) for H_, W_ in spatial_shapes)
+
+
+class PackedShapes(object):
+    """Spatial shapes of a packed batch, in which the valid tokens of every
+    image are concatenated (image by image, level by level) without padding.
+
+    Args:
+        shapes_hw (list[list[tuple[int]]]): the valid (h, w) of every level
+            of every image.
+        device (torch.device): device of the per-image `spatial_shapes` and
+            `level_start_index`.
+    """
+
+    def __init__(self, shapes_hw, device):
+        self.shapes_hw = [tuple((int(H_), int(W_)) for H_, W_ in shapes) for shapes in shapes_hw]
+        self.seqlens = [sum(H_ * W_ for H_, W_ in shapes) for shapes in self.shapes_hw]
+        self.spatial_shapes = []
+        self.level_start_index = []
+        for shapes in self.shapes_hw:
+            spatial_shapes = torch.as_tensor(shapes, dtype=torch.long, device=device)
+            self.spatial_shapes.append(spatial_shapes)
+            self.level_start_index.append(
+                torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1])))
+
+    def split(self, x):
+        """[1, \sum{seqlens}, ...] -> list of [1, seqlen_i, ...]"""
+        return x.split(self.seqlens, dim=1)
+
+
+def _packed_deform_attn(attn, query, reference_points, value, packed):
+    """Deformable attention over a packed batch, every image only samples
+    its own valid tokens."""
+    output = [attn(query_, reference_points_, value_, spatial_shapes, level_start_index)
+              for query_, reference_points_, value_, spatial_shapes, level_start_index in zip(
+                  packed.split(query), packed.split(reference_points), packed.split(value),
+                  packed.spatial_shapes, packed.level_start_index)]
+    return torch.cat(output, 1)
+
+
+def _cached_call(fn, *args):
+    """Call a lru_cache'd grid builder, the cache lookup can not be traced
+    so the grid is rebuilt inside the graph while compiling."""
+    if is_compiling():
+        return fn.__wrapped__(*args)
+    return fn(*args)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_reference_grid(spatial_shapes, device, dtype):
+    """Build the per-token reference grid for a spatial-shape signature.
+
+    The result only depends on ``(spatial_shapes, device, dtype)``, so it is
+    memoised: batches that share a padded shape skip the meshgrid construction.
+
+    Returns:
+        - grid: [\sum{hw}, 2], (x, y) token centers normalised by (W, H) of its level
+        - level_index: [\sum{hw}], level id of each token
+    """
+    grid_list = []
+    level_list = []
+    for lvl, (H_, W_) in enumerate(spatial_shapes):
+        ref_y, ref_x = torch.meshgrid(torch.linspace(0.5, H_ - 0.5, H_, dtype=dtype, device=device),
+                                      torch.linspace(0.5, W_ - 0.5, W_, dtype=dtype, device=device))
+        grid_list.append(torch.stack((ref_x.reshape(-1) / W_, ref_y.reshape(-1) / H_), -1))
+        level_list.append(torch.full((H_ * W_, ), lvl, dtype=torch.long, device=device))
+    return torch.cat(grid_list, 0), torch.cat(level_list, 0)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_proposal_grid(spatial_shapes, device, dtype):
+    """Static part of the two-stage proposals for a spatial-shape signature.
+
+    Returns:
+        - centers: [\sum{hw}, 2], (x, y) token centers in pixels of its level
+        - level_index: [\sum{hw}], level id of each token
+        - level_scale: [\sum{hw}, 2], 2 ** level, the wh multiplier of each token
+    """
+    centers = []
+    level_index = []
+    for lvl, (H_, W_) in enumerate(spatial_shapes):
+        grid_y, grid_x = torch.meshgrid(torch.linspace(0, H_ - 1, H_, dtype=dtype, device=device),
+                                        torch.linspace(0, W_ - 1, W_, dtype=dtype, device=device))
+        centers.append(torch.stack([grid_x, grid_y], -1).view(-1, 2) + 0.5)
+        level_index.append(torch.full((H_ * W_, ), lvl, dtype=torch.long, device=device))
+    level_index = torch.cat(level_index, 0)
+    level_scale = (2.0 ** level_index.to(dtype))[:, None].repeat(1, 2)
+    return torch.cat(centers, 0), level_index, level_scale
+
+
+@functools.lru_cache(maxsize=32)
+def _get_proposal_wh_prior(spatial_shapes, device, dtype):
+    """Unsigmoided fixed wh prior (0.05 * 2 ** level) and its validity, [\sum{hw}, 2] / [\sum{hw}, 1]."""
+    _, _, level_scale = _cached_call(_get_proposal_grid, spatial_shapes, device, dtype)
+    wh = 0.05 * level_scale
+    wh_valid = ((wh > 0.01) & (wh < 0.99)).all(-1, keepdim=True)
+    return torch.log(wh / (1 - wh)), wh_valid
+
 
 def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spatial_shapes:Tensor, learnedwh=None):
     """
@@ -534,37 +650,32 @@ def gen_encoder_output_proposals(memory:Tensor, memory_padding_mask:Tensor, spat
         - output_proposals: bs, \sum{hw}, 4
     """
     N_, S_, C_ = memory.shape
-    base_scale = 4.0
-    proposals = []
-    _cur = 0
-    for lvl, (H_, W_) in enumerate(spatial_shapes):
-        mask_flatten_ = memory_padding_mask[:, _cur:(_cur + H_ * W_)].view(N_, H_, W_, 1)
-        valid_H = torch.sum(~mask_flatten_[:, :, 0, 0], 1)
-        valid_W = torch.sum(~mask_flatten_[:, 0, :, 0], 1)
-
-        # import ipdb; ipdb.set_trace()
-
-        grid_y, grid_x = torch.meshgrid(torch.linspace(0, H_ - 1, H_, dtype=torch.float32, device=memory.device),
-                                        torch.linspace(0, W_ - 1, W_, dtype=torch.float32, device=memory.device))
-        grid = torch.cat([grid_x.unsqueeze(-1), grid_y.unsqueeze(-1)], -1) # H_, W_, 2
+    spatial_shapes = _spatial_shapes_key(spatial_shapes)
+    centers, level_index, level_scale = _cached_call(_get_proposal_grid, spatial_shapes, memory.device, torch.float32)
 
-        scale = torch.cat([valid_W.unsqueeze(-1), valid_H.unsqueeze(-1)], 1).view(N_, 1, 1, 2)
-        grid = (grid.unsqueeze(0).expand(N_, -1, -1, -1) + 0.5) / scale
-
-        if learnedwh is not None:
-            # import ipdb; ipdb.set_trace()
-            wh = torch.ones_like(grid) * learnedwh.sigmoid() * (2.0 ** lvl)
-        else:
-            wh = torch.ones_like(grid) * 0.05 * (2.0 ** lvl)
-
-     
-        proposal = torch.cat((grid, wh), -1).view(N_, -1, 4)
-        proposals.append(proposal)
+    # only the normalisation by the valid extent of every image depends on the padding
+    valid_wh = []
+    _cur = 0
+    for H_, W_ in spatial_shapes:
+        mask_flatten_ = memory_padding_mask[:, _cur:(_cur + H_ * W_)].view(N_, H_, W_)
+        valid_H = torch.sum(~mask_flatten_[:, :, 0], 1)
+        valid_W = torch.sum(~mask_flatten_[:, 0, :], 1)
+        valid_wh.append(torch.stack([valid_W, valid_H], -1))
         _cur += (H_ * W_)
-    # import ipdb; ipdb.set_trace()
-    output_proposals = torch.cat(proposals, 1)
-    output_proposals_valid = ((output_proposals > 0.01) & (output_proposals < 0.99)).all(-1, keepdim=True)
-    output_proposals = torch.log(output_proposals / (1 - output_proposals)) # unsigmoid
+    valid_wh = torch.stack(valid_wh, 1)                     # N_, nlevel, 2
+    grid = centers[None] / valid_wh[:, level_index]         # N_, \sum{hw}, 2
+    grid_valid = ((grid > 0.01) & (grid < 0.99)).all(-1, keepdim=True)
+    grid = torch.log(grid / (1 - grid)) # unsigmoid
+
+    if learnedwh is not None:
+        wh = learnedwh.sigmoid() * level_scale
+        wh_valid = ((wh > 0.01) & (wh < 0.99)).all(-1, keepdim=True)
+        wh = torch.log(wh / (1 - wh))
+    else:
+        wh, wh_valid = _cached_call(_get_proposal_wh_prior, spatial_shapes, memory.device, torch.float32)
+
+    output_proposals = torch.cat((grid, wh[None].expand(N_, -1, -1)), -1)
+    output_proposals_valid = grid_valid & wh_valid[None]
     output_proposals = output_proposals.masked_fill(memory_padding_mask.unsqueeze(-1), float('inf'))
     output_proposals = output_proposals.masked_fill(~output_proposals_valid, float('inf'))
 
@@ -596,13 +707,17 @@ class DINOTransformerEncoderLayer(nn.Module):
             Default: `LN`.
         ffn_num_fcs (int): The number of fully-connected layers in FFNs.
             Default：2.
+        with_cp (bool): Use checkpoint or not. Using checkpoint will save some
+            memory while slowing down the training speed. Default: False.
     """
 
     def __init__(self, d_model=256, d_ffn=1024,
                        dropout=0.1, activation='relu',
                        n_levels=4, n_heads=8, n_points=4,
+                       with_cp=False,
                        **kwargs):
         super(DINOTransformerEncoderLayer, self).__init__()
+        self.with_cp = with_cp
         
         # self-attention, in DINO, the encoder's self-attention is
         # implemented with deformable attention
@@ -629,10 +744,24 @@ class DINOTransformerEncoderLayer(nn.Module):
         src = self.norm2(src)
         return src
 
-    def forward(self, src, pos, reference_points, spatial_shapes, level_start_index, key_padding_mask=None):
-        # breakpoint()
+    def forward(self, src, pos, reference_points, spatial_shapes, level_start_index, key_padding_mask=None, value=None):
+        # value: the full memory when only a subset of tokens is updated (sparse encoder)
+        if value is None:
+            value = src
+        if self.with_cp and self.training and src.requires_grad:
+            # non-reentrant, so that the parameters are marked ready for DDP
+            # once per forward, the student runs several forwards per step
+            return cp.checkpoint(self._forward, src, pos, reference_points, spatial_shapes,
+                                 level_start_index, key_padding_mask, value, use_reentrant=False)
+        return self._forward(src, pos, reference_points, spatial_shapes, level_start_index, key_padding_mask, value)
+
+    def _forward(self, src, pos, reference_points, spatial_shapes, level_start_index, key_padding_mask, value):
         # self attention
-        src2 = self.self_attn(self.with_pos_embed(src, pos), reference_points, src, spatial_shapes, level_start_index, key_padding_mask)
+        if isinstance(spatial_shapes, PackedShapes):
+            # packed encoder: src / pos / value [1, \sum{valid hw}, c]
+            src2 = _packed_deform_attn(self.self_attn, self.with_pos_embed(src, pos), reference_points, value, spatial_shapes)
+        else:
+            src2 = self.self_attn(self.with_pos_embed(src, pos), reference_points, value, spatial_shapes, level_start_index, key_padding_mask)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
 
@@ -647,7 +776,14 @@ class DINOTransformerEncoder(nn.Module):
                        norm=None, d_model=256, two_stage_type='standard',
                        num_queries=900, deformable_encoder=True, 
                        enc_layer_share=False, enc_layer_dropout_prob=None,
+                       sparse_keep_ratio=None,
                        **kwargs):
+        """
+        sparse_keep_ratio: if not None, the tokens are scored by a learned
+            saliency head after the first layer and only the top
+            `sparse_keep_ratio` fraction of the non-padding tokens is updated
+            by the later layers.
+        """
         super().__init__()
         # prepare layer
         if num_layers > 0:
@@ -671,22 +807,24 @@ class DINOTransformerEncoder(nn.Module):
             for i in enc_layer_dropout_prob:
                 assert 0.0 <= i <= 1.0
 
+        self.sparse_keep_ratio = sparse_keep_ratio
+        if sparse_keep_ratio is not None:
+            assert 0.0 < sparse_keep_ratio <= 1.0
+            self.saliency_head = MLP(d_model, d_model, 1, 2)
+
 
     @staticmethod
     def get_reference_points(spatial_shapes, valid_ratios, device):
         """Get the reference points in the first stage to generate the 
         initial object query.
+
+        The unnormalised grid is cached per spatial-shape signature, the
+        valid-ratio scaling is applied to the whole batch at once.
         """
-        reference_points_list = []
-        for lvl, (H_, W_) in enumerate(spatial_shapes):
-
-            ref_y, ref_x = torch.meshgrid(torch.linspace(0.5, H_ - 0.5, H_, dtype=torch.float32, device=device),
-                                          torch.linspace(0.5, W_ - 0.5, W_, dtype=torch.float32, device=device))
-            ref_y = ref_y.reshape(-1)[None] / (valid_ratios[:, None, lvl, 1] * H_)
-            ref_x = ref_x.reshape(-1)[None] / (valid_ratios[:, None, lvl, 0] * W_)
-            ref = torch.stack((ref_x, ref_y), -1)
-            reference_points_list.append(ref)
-        reference_points = torch.cat(reference_points_list, 1)
+        grid, level_index = _cached_call(
+            _get_reference_grid, _spatial_shapes_key(spatial_shapes), torch.device(device), torch.float32)
+        # bs, \sum{hw}, 2
+        reference_points = grid[None] / valid_ratios[:, level_index]
         reference_points = reference_points[:, :, None] * valid_ratios[:, None]
         return reference_points
     
@@ -713,6 +851,8 @@ class DINOTransformerEncoder(nn.Module):
             - reference_points: [bs, sum(hi*wi), num_level, 2]
         Outpus: 
             - output: [bs, sum(hi*wi), 256]
+            - saliency: with `sparse_keep_ratio`, the saliency logits
+              [bs, sum(hi*wi)] for the saliency loss, else None
         """
         # breakpoint()
         assert self.two_stage_type == 'standard'
@@ -730,18 +870,85 @@ class DINOTransformerEncoder(nn.Module):
 
         # intermediate_coord = []
         # main process
+        saliency = sparse_inds = sparse_valid = None
         for layer_id, layer in enumerate(self.layers):
-            # main process output: [bs, HW, 256]
-            output = layer(src=output, pos=pos, \
-                           reference_points=reference_points, spatial_shapes=spatial_shapes, \
-                           level_start_index=level_start_index, key_padding_mask=key_padding_mask)  
+            if sparse_inds is None:
+                # main process output: [bs, HW, 256]
+                output = layer(src=output, pos=pos, \
+                               reference_points=reference_points, spatial_shapes=spatial_shapes, \
+                               level_start_index=level_start_index, key_padding_mask=key_padding_mask)  
+            else:
+                # only the salient tokens are updated, they still attend to the full memory
+                sparse_src = self.gather_tokens(output, sparse_inds)
+                sparse_output = layer(src=sparse_src, pos=self.gather_tokens(pos, sparse_inds), \
+                                      reference_points=self.gather_tokens(reference_points, sparse_inds), spatial_shapes=spatial_shapes, \
+                                      level_start_index=level_start_index, key_padding_mask=key_padding_mask, value=output)
+                if sparse_valid is not None:
+                    # the padding tokens selected by the smaller images keep their value
+                    sparse_output = torch.where(sparse_valid[..., None], sparse_output, sparse_src)
+                output = output.scatter(1, sparse_inds[..., None].expand_as(sparse_output), sparse_output)
+
+            if layer_id == 0 and self.sparse_keep_ratio is not None:
+                sparse_inds, sparse_valid, saliency = self.select_salient_tokens(output, key_padding_mask)
            
         if self.norm is not None:
             output = self.norm(output)
 
         intermediate_output = intermediate_ref = None
 
-        return output, intermediate_output, intermediate_ref
+        return output, intermediate_output, intermediate_ref, saliency
+
+    def forward_packed(self, src: Tensor, pos: Tensor, packed: PackedShapes):
+        """Encoder forward on a packed batch.
+
+        Input:
+            - src: [1, \sum{valid hw}, 256], the valid tokens of all the images
+            - pos: pos embed for src. [1, \sum{valid hw}, 256]
+            - packed: the valid spatial shapes of every image
+        Outpus:
+            - output: [1, \sum{valid hw}, 256]
+        """
+        assert self.sparse_keep_ratio is None, 'the sparse encoder does not support packed inputs'
+        # the grid of every image is its valid area, hence valid ratios of 1
+        reference_points = torch.cat([
+            self.get_reference_points(shapes, src.new_ones(1, len(shapes), 2), device=src.device)
+            for shapes in packed.shapes_hw], 1)
+
+        output = src
+        for layer in self.layers:
+            output = layer(src=output, pos=pos, reference_points=reference_points,
+                           spatial_shapes=packed, level_start_index=None)
+        if self.norm is not None:
+            output = self.norm(output)
+        return output
+
+    @staticmethod
+    def gather_tokens(x, inds):
+        """x: [bs, sum(hi*wi), ...], inds: [bs, k] -> [bs, k, ...]"""
+        inds = inds.view(inds.shape + (1, ) * (x.dim() - 2)).expand((-1, -1) + x.shape[2:])
+        return torch.gather(x, 1, inds)
+
+    def select_salient_tokens(self, output, key_padding_mask):
+        """Score the tokens and return the indices [bs, k] of the top
+        `sparse_keep_ratio` fraction of the non-padding tokens, and the mask
+        [bs, k] of the selected tokens that are not padding (None without
+        padding). k is taken on the image with the most non-padding tokens,
+        the smaller images fill it with padding tokens after their own.
+        The saliency logits [bs, sum(hi*wi)] are returned for the loss."""
+        saliency = self.saliency_head(output).squeeze(-1)
+        if key_padding_mask is None:
+            num_valid = output.shape[1]
+        else:
+            num_valid = int((~key_padding_mask).sum(1).max())
+        num_keep = max(int(num_valid * self.sparse_keep_ratio), 1)
+        if num_keep >= output.shape[1]:
+            return None, None, saliency
+        scores = saliency.detach()
+        if key_padding_mask is not None:
+            scores = scores.masked_fill(key_padding_mask, float('-inf'))
+        inds = torch.topk(scores, num_keep, dim=1)[1]
+        valid = None if key_padding_mask is None else ~key_padding_mask.gather(1, inds)
+        return inds, valid, saliency
 
 @TRANSFORMER_LAYER.register_module()
 class DINOTransformerDecoderLayer(nn.Module):
@@ -750,9 +957,15 @@ class DINOTransformerDecoderLayer(nn.Module):
                        n_levels=4, n_heads=8, n_points=4,
                        decoder_sa_type='ca',
                        module_seq=['sa', 'ca', 'ffn'],
+                       with_cp=False,
                        **kwargs):
+        """
+        with_cp: recompute the activations of this layer in the backward pass
+            (torch.utils.checkpoint) to save memory. Default: False.
+        """
         super().__init__()
 
+        self.with_cp = with_cp
         self.module_seq = module_seq
         assert sorted(module_seq) == ['ca', 'ffn', 'sa']
 
@@ -853,7 +1066,18 @@ class DINOTransformerDecoderLayer(nn.Module):
                       self_attn_mask: Optional[Tensor] = None, # mask used for self-attention
                       cross_attn_mask: Optional[Tensor] = None, # mask used for cross-attention
             ):
-        # breakpoint()
+        args = (tgt, tgt_query_pos, tgt_query_sine_embed, tgt_key_padding_mask, tgt_reference_points,
+                memory, memory_key_padding_mask, memory_level_start_index, memory_spatial_shapes,
+                memory_pos, self_attn_mask, cross_attn_mask)
+        if self.with_cp and self.training and (tgt.requires_grad or tgt_query_pos.requires_grad):
+            # the DN attention mask is a bool tensor, it is passed through as
+            # is, non-reentrant as the encoder layer
+            return cp.checkpoint(self._forward, *args, use_reentrant=False)
+        return self._forward(*args)
+
+    def _forward(self, tgt, tgt_query_pos, tgt_query_sine_embed, tgt_key_padding_mask, tgt_reference_points,
+                       memory, memory_key_padding_mask, memory_level_start_index, memory_spatial_shapes,
+                       memory_pos, self_attn_mask, cross_attn_mask):
         for funcname in self.module_seq:
             if funcname == 'ffn':
                 tgt = self.forward_ffn(tgt)
@@ -943,6 +1167,28 @@ class DINOTransformerDecoder(nn.Module):
                 assert 0.0 <= i <= 1.0
 
         self.rm_detach = None
+        # number of images that exited after each layer with early-exit decoding
+        self.exit_layer_hist = [0] * num_layers
+
+    def reset_exit_layer_hist(self):
+        self.exit_layer_hist = [0] * self.num_layers
+
+    @staticmethod
+    def should_exit(prev_scores, scores, prev_boxes, boxes, early_exit):
+        """Whether the top-k scores and boxes of every image changed less than
+        the thresholds between two consecutive layers.
+
+        Input:
+            - prev_scores/scores: nq, bs
+            - prev_boxes/boxes: nq, bs, 4
+            - early_exit: dict(score_thr, box_thr, topk)
+        """
+        topk = min(early_exit.get('topk', 100), scores.shape[0])
+        topk_inds = torch.topk(scores, topk, dim=0)[1]          # topk, bs
+        score_delta = (torch.gather(scores, 0, topk_inds) - torch.gather(prev_scores, 0, topk_inds)).abs()
+        box_inds = topk_inds[..., None].expand(-1, -1, 4)
+        box_delta = (torch.gather(boxes, 0, box_inds) - torch.gather(prev_boxes, 0, box_inds)).abs()
+        return bool((score_delta.max() < early_exit['score_thr']) & (box_delta.max() < early_exit['box_thr']))
 
     def forward(self, tgt, memory,
                       tgt_mask: Optional[Tensor] = None,
@@ -956,7 +1202,8 @@ class DINOTransformerDecoder(nn.Module):
                       spatial_shapes: Optional[Tensor] = None, # bs, num_levels, 2
                       valid_ratios: Optional[Tensor] = None,
                       fc_reg = None,
-                      fc_cls = None):
+                      fc_cls = None,
+                      early_exit = None):
         """
         Input:
             - tgt: nq, bs, d_model
@@ -964,6 +1211,9 @@ class DINOTransformerDecoder(nn.Module):
             - pos: hw, bs, d_model
             - refpoints_unsigmoid: nq, bs, 2/4
             - valid_ratios/spatial_shapes: bs, nlevel, 2
+            - early_exit: dict(score_thr, box_thr, topk), test only. Stop
+              decoding once the top-k scores and boxes change less than the
+              thresholds between two consecutive layers.
         """
         # breakpoint()
         output = tgt
@@ -971,6 +1221,9 @@ class DINOTransformerDecoder(nn.Module):
         intermediate = []
         reference_points = refpoints_unsigmoid.sigmoid()
         ref_points = [reference_points]  
+        use_early_exit = early_exit is not None and not self.training \
+            and fc_reg is not None and fc_cls is not None
+        prev_scores = None
         # breakpoint()
         for layer_id, layer in enumerate(self.layers):
             # preprocess ref points
@@ -1037,6 +1290,14 @@ class DINOTransformerDecoder(nn.Module):
 
 
             intermediate.append(self.norm(output))
+
+            if use_early_exit:
+                scores = fc_cls[layer_id](intermediate[-1]).sigmoid().max(-1)[0]
+                if layer_id == self.num_layers - 1 or (prev_scores is not None and self.should_exit(
+                        prev_scores, scores, ref_points[-2], ref_points[-1], early_exit)):
+                    self.exit_layer_hist[layer_id] += output.shape[1]
+                    break
+                prev_scores = scores
           
 
         return [
@@ -1088,6 +1349,20 @@ class DINOTransformer(nn.Module):
                        # for dn
                        embed_init_tgt=True,
                        use_detached_boxes_dec_out=False,
+                       # for sparse encoder
+                       enc_sparse_keep_ratio=None,
+                       saliency_loss_weight=1.0,
+                       # activation checkpointing
+                       enc_with_cp=False,
+                       dec_with_cp=False,
+                       # keep the spatial shapes as python ints so that the
+                       # forward can be captured as a graph
+                       static_shape=False,
+                       # class-agnostic prefilter of the two-stage proposals
+                       enc_objectness_prefilter=None,
+                       objectness_loss_weight=1.0,
+                       # run the encoder on the valid tokens only
+                       packed_encoder=False,
             ):
         super().__init__()
         # breakpoint()
@@ -1100,6 +1375,9 @@ class DINOTransformer(nn.Module):
         self.num_queries = num_queries
         self.random_refpoints_xy = random_refpoints_xy
         self.use_detached_boxes_dec_out = use_detached_boxes_dec_out
+        self.static_shape = static_shape
+        self.packed_encoder = packed_encoder
+        assert not (packed_encoder and static_shape), 'the packed encoder is not static-shaped'
         assert query_dim == 4
 
         if num_feature_levels > 1:
@@ -1135,8 +1413,10 @@ class DINOTransformer(nn.Module):
             num_queries=num_queries,
             deformable_encoder=deformable_encoder, 
             enc_layer_share=enc_layer_share, 
-            two_stage_type=two_stage_type
+            two_stage_type=two_stage_type,
+            sparse_keep_ratio=enc_sparse_keep_ratio
         )
+        self.saliency_loss_weight = saliency_loss_weight
 
         # choose decoder layer type
         if deformable_decoder:
@@ -1163,6 +1443,10 @@ class DINOTransformer(nn.Module):
                                         use_detached_boxes_dec_out=use_detached_boxes_dec_out
                                         )
 
+        # bool for all layers or a list with one bool per layer
+        _set_layers_with_cp(self.encoder.layers, enc_with_cp)
+        _set_layers_with_cp(self.decoder.layers, dec_with_cp)
+
         self.d_model = d_model
         self.embed_dims = d_model
         self.nhead = nhead
@@ -1211,6 +1495,14 @@ class DINOTransformer(nn.Module):
                 self.two_stage_wh_embedding = nn.Embedding(1, 2)
             else:
                 self.two_stage_wh_embedding = None
+
+            # keep `enc_objectness_prefilter` x num_queries candidates by a
+            # class-agnostic objectness, fc_enc_cls and fc_enc_reg only run on them
+            self.enc_objectness_prefilter = enc_objectness_prefilter
+            self.objectness_loss_weight = objectness_loss_weight
+            if enc_objectness_prefilter is not None:
+                assert enc_objectness_prefilter >= 1
+                self.enc_objectness = nn.Linear(d_model, 1)
       
 
         self._reset_parameters()
@@ -1243,6 +1535,114 @@ class DINOTransformer(nn.Module):
         valid_ratio = torch.stack([valid_ratio_w, valid_ratio_h], -1)
         return valid_ratio
 
+    def get_valid_ratios(self, masks):
+        """Batched get_valid_ratio over all levels, returns [bs, num_level, 2]."""
+        valid_ratios = []
+        for dim in (2, 1):
+            # the first column (dim=2) / row (dim=1) of every level, concatenated
+            edges = torch.cat([~m.select(dim, 0) for m in masks], 1).float()
+            lengths = edges.new_tensor([m.shape[3 - dim] for m in masks])
+            ends = torch.cumsum(lengths, 0).long() - 1
+            cum_valid = torch.cumsum(edges, 1)[:, ends]
+            valid = torch.cat([cum_valid[:, :1], cum_valid[:, 1:] - cum_valid[:, :-1]], 1)
+            valid_ratios.append(valid / lengths)
+        # stacked as (w, h)
+        return torch.stack(valid_ratios[::-1], -1)
+
+    def encode_packed(self, src_flatten, pos_flatten, masks, mask_flatten):
+        """Run the encoder on the valid tokens of every image only.
+
+        The valid tokens are gathered image by image, level by level in
+        row-major order, which is the order of `~mask_flatten`. Each image
+        samples its own valid grid, the padded tokens are neither computed
+        nor stored.
+
+        Returns:
+            - memory: [bs, \sum{hw}, c], zeros on the padded tokens
+        """
+        bs, S, C = src_flatten.shape
+        valid_hw = torch.stack([torch.stack([(~m[:, :, 0]).sum(1), (~m[:, 0, :]).sum(1)], -1) for m in masks], 1)
+        packed = PackedShapes(valid_hw.tolist(), src_flatten.device)
+        packed_index = (~mask_flatten).flatten().nonzero().squeeze(1)
+        assert packed_index.numel() == sum(packed.seqlens), 'the valid area of a level is not a rectangle'
+
+        output = self.encoder.forward_packed(src_flatten.flatten(0, 1)[packed_index][None],
+                                             pos_flatten.flatten(0, 1)[packed_index][None], packed)
+        memory = src_flatten.new_zeros(bs * S, C).index_copy(0, packed_index, output[0].to(src_flatten.dtype))
+        return memory.view(bs, S, C)
+
+    def get_saliency_loss(self, saliency, topk_proposals, mask_flatten):
+        """Supervise the sparse-encoder saliency with the two-stage selection:
+        a token is salient if it ends up among the top-k encoder proposals."""
+        if saliency is None or not torch.is_grad_enabled():
+            return None
+        target = torch.zeros_like(saliency).scatter(1, topk_proposals, 1.0)
+        # mean over the valid tokens, without a data-dependent indexing
+        valid = (~mask_flatten).to(saliency.dtype)
+        loss = F.binary_cross_entropy_with_logits(saliency, target, reduction='none')
+        loss = (loss * valid).sum() / valid.sum().clamp(min=1)
+        return loss * self.saliency_loss_weight
+
+    def prefilter_proposals(self, output_memory, output_proposals, num_queries):
+        """Keep the `enc_objectness_prefilter * num_queries` tokens of highest
+        objectness, padding and invalid proposals are taken last.
+
+        With grad enabled, as many of the rejected valid tokens are sampled at
+        random for the objectness loss, so that the tokens ranked below the
+        cut are supervised too.
+
+        Returns:
+            - output_memory: bs, num_candidates, d_model
+            - output_proposals: bs, num_candidates, 4
+            - candidate_inds: bs, num_candidates, index of the kept tokens
+            - objectness: (logits, valid) of the candidates, for the loss
+            - rejected: (logits, detached memory, valid) of the sampled
+              rejected tokens for the loss, or None
+        """
+        objectness = self.enc_objectness(output_memory).squeeze(-1)     # bs, \sum{hw}
+        num_candidates = min(self.enc_objectness_prefilter * num_queries, objectness.shape[1])
+        invalid = torch.isinf(output_proposals[..., 0])
+        candidate_inds = torch.topk(objectness.detach().masked_fill(invalid, float('-inf')),
+                                    num_candidates, dim=1)[1]
+        candidates = (torch.gather(objectness, 1, candidate_inds),
+                      ~torch.gather(invalid, 1, candidate_inds))
+
+        rejected = None
+        num_rejected = min(num_candidates, objectness.shape[1] - num_candidates)
+        if torch.is_grad_enabled() and num_rejected > 0:
+            # random priorities, the invalid tokens last and the candidates never
+            priority = torch.rand_like(objectness.detach()).masked_fill(invalid, -1.0)
+            priority = priority.scatter(1, candidate_inds, -2.0)
+            rejected_inds = torch.topk(priority, num_rejected, dim=1)[1]
+            rejected = (
+                torch.gather(objectness, 1, rejected_inds),
+                torch.gather(output_memory.detach(), 1, rejected_inds[..., None].expand(-1, -1, output_memory.shape[-1])),
+                torch.gather(priority, 1, rejected_inds) >= 0)
+
+        output_memory = torch.gather(output_memory, 1, candidate_inds[..., None].expand(-1, -1, output_memory.shape[-1]))
+        output_proposals = torch.gather(output_proposals, 1, candidate_inds[..., None].expand(-1, -1, 4))
+        return output_memory, output_proposals, candidate_inds, candidates, rejected
+
+    def get_objectness_loss(self, objectness, rejected, enc_outputs_class, fc_enc_cls):
+        """Distill the class-agnostic objectness of the valid candidates and of
+        the sampled rejected tokens, both as returned by `prefilter_proposals`,
+        from the max class probability of fc_enc_cls, detached."""
+        if objectness is None or not torch.is_grad_enabled():
+            return None
+        objectness, valid = objectness
+        target = enc_outputs_class.detach().max(-1)[0].sigmoid()
+        if rejected is not None:
+            rejected_objectness, rejected_memory, rejected_valid = rejected
+            with torch.no_grad():
+                rejected_target = fc_enc_cls(rejected_memory).max(-1)[0].sigmoid()
+            objectness = torch.cat([objectness, rejected_objectness], 1)
+            target = torch.cat([target, rejected_target], 1)
+            valid = torch.cat([valid, rejected_valid], 1)
+        loss = F.binary_cross_entropy_with_logits(objectness, target, reduction='none')
+        valid = valid.type_as(loss)
+        loss = (loss * valid).sum() / valid.sum().clamp(min=1)
+        return loss * self.objectness_loss_weight
+
     def init_ref_points(self, use_num_queries):
         self.refpoint_embed = nn.Embedding(use_num_queries, 4)
         
@@ -1252,7 +1652,7 @@ class DINOTransformer(nn.Module):
             self.refpoint_embed.weight.data[:, :2] = inverse_sigmoid(self.refpoint_embed.weight.data[:, :2])
             self.refpoint_embed.weight.data[:, :2].requires_grad = False
     
-    def forward(self, srcs, masks, refpoint_embed, pos_embeds, tgt, attn_mask=None, fc_reg=None, fc_cls=None, fc_enc_reg=None, fc_enc_cls=None, vis_metas=None):                                                                 
+    def forward(self, srcs, masks, refpoint_embed, pos_embeds, tgt, attn_mask=None, fc_reg=None, fc_cls=None, fc_enc_reg=None, fc_enc_cls=None, vis_metas=None, early_exit=None, num_queries=None):                                                                 
         """decoder forward in DINO, "refpoint_embed" and "tgt" is the dn component, attn_mask is also provided accorddingly.
         Input:
             - srcs: List of multi features [bs, ci, hi, wi]
@@ -1260,7 +1660,11 @@ class DINOTransformer(nn.Module):
             - refpoint_embed: [bs, num_dn, 4]. None in infer
             - pos_embeds: List of multi pos embeds [bs, ci, hi, wi]
             - tgt: [bs, num_dn, d_model]. None in infer
-            
+            - early_exit: early-exit policy of the decoder, see DINOTransformerDecoder
+            - num_queries: query budget of this call (test only), at most self.num_queries
+        Output, besides the decoder outputs:
+            - aux_losses: dict of the saliency and objectness losses of this
+              forward, empty without grad or without these heads
         """
         # breakpoint()
         # prepare input for encoder
@@ -1287,9 +1691,13 @@ class DINOTransformer(nn.Module):
         src_flatten = torch.cat(src_flatten, 1)    # bs, \sum{hxw}, c 
         mask_flatten = torch.cat(mask_flatten, 1)   # bs, \sum{hxw}
         lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1) # bs, \sum{hxw}, c 
+        spatial_shapes_hw = tuple(spatial_shapes)
         spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=src_flatten.device)
         level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        valid_ratios = self.get_valid_ratios(masks)
+        if self.static_shape:
+            # MSDeformAttn falls back to the pure PyTorch sampling with python shapes
+            spatial_shapes = spatial_shapes_hw
 
         # two stage
         enc_topk_proposals = enc_refpoint_embed = None
@@ -1300,29 +1708,52 @@ class DINOTransformer(nn.Module):
         # memory: [bs, hw, c]
         # enc_intermediate_output: [n_enc, bs, nq, c]
         # enc_intermediate_refpoints: [n_enc, bs, nq, c]
-        memory, enc_intermediate_output, enc_intermediate_refpoints = self.encoder(
-                src_flatten, 
-                pos=lvl_pos_embed_flatten, 
-                level_start_index=level_start_index, 
-                spatial_shapes=spatial_shapes,
-                valid_ratios=valid_ratios,
-                key_padding_mask=mask_flatten,
-                ref_token_index=enc_topk_proposals, # bs, nq 
-                ref_token_coord=enc_refpoint_embed, # bs, nq, 4
-                )
+        saliency = None
+        if self.packed_encoder:
+            memory = self.encode_packed(src_flatten, lvl_pos_embed_flatten, masks, mask_flatten)
+        else:
+            memory, enc_intermediate_output, enc_intermediate_refpoints, saliency = self.encoder(
+                    src_flatten, 
+                    pos=lvl_pos_embed_flatten, 
+                    level_start_index=level_start_index, 
+                    spatial_shapes=spatial_shapes,
+                    valid_ratios=valid_ratios,
+                    key_padding_mask=mask_flatten,
+                    ref_token_index=enc_topk_proposals, # bs, nq 
+                    ref_token_coord=enc_refpoint_embed, # bs, nq, 4
+                    )
+        aux_losses = dict()
     
 
+        if num_queries is None:
+            num_queries = self.num_queries
+        num_queries = min(num_queries, self.num_queries)
+
         if self.two_stage_type =='standard':
             """DINO take the standard two-stage manner to generate the initial object queries"""
             input_hw = None
-            output_memory, output_proposals = gen_encoder_output_proposals(memory, mask_flatten, spatial_shapes, input_hw)
+            output_memory, output_proposals = gen_encoder_output_proposals(memory, mask_flatten, spatial_shapes_hw, input_hw)
             output_memory = self.enc_output_norm(self.enc_output(output_memory))
-            
+
+            candidate_inds = objectness = rejected_objectness = None
+            if self.enc_objectness_prefilter is not None:
+                # output_memory / output_proposals: [bs, num_candidates, ...] from here on
+                output_memory, output_proposals, candidate_inds, objectness, rejected_objectness = \
+                    self.prefilter_proposals(output_memory, output_proposals, num_queries)
            
             enc_outputs_class_unselected = fc_enc_cls(output_memory)
             enc_outputs_coord_unselected = fc_enc_reg(output_memory) + output_proposals # [bs, \sum{hw}, 4] unsigmoid, output_proposlas maybe have inf value
-            topk = self.num_queries
+            topk = num_queries
             topk_proposals = torch.topk(enc_outputs_class_unselected.max(-1)[0], topk, dim=1)[1] # [bs, topk] is the index value
+            loss_objectness = self.get_objectness_loss(
+                objectness, rejected_objectness, enc_outputs_class_unselected, fc_enc_cls)
+            if loss_objectness is not None:
+                aux_losses['loss_objectness'] = loss_objectness
+            loss_saliency = self.get_saliency_loss(
+                saliency, topk_proposals if candidate_inds is None else torch.gather(candidate_inds, 1, topk_proposals),
+                mask_flatten)
+            if loss_saliency is not None:
+                aux_losses['loss_saliency'] = loss_saliency
             
 
             # gather boxes
@@ -1333,7 +1764,7 @@ class DINOTransformer(nn.Module):
             # gather tgt
             tgt_undetach = torch.gather(output_memory, 1, topk_proposals.unsqueeze(-1).repeat(1, 1, self.d_model))
             if self.embed_init_tgt:
-                tgt_ = self.tgt_embed.weight[:self.num_queries, None, :].repeat(1, bs, 1).transpose(0, 1) # [bs, topk, d_model]
+                tgt_ = self.tgt_embed.weight[:num_queries, None, :].repeat(1, bs, 1).transpose(0, 1) # [bs, topk, d_model]
             else:
                 NotImplementedError
                 
@@ -1346,8 +1777,8 @@ class DINOTransformer(nn.Module):
                 refpoint_embed, tgt = refpoint_embed_, tgt_
 
         elif self.two_stage_type == 'no':
-            tgt_ = self.tgt_embed.weight[:self.num_queries, None, :].repeat(1, bs, 1).transpose(0, 1)                 # nq, bs, d_model
-            refpoint_embed_ = self.refpoint_embed.weight[:self.num_queries, None, :].repeat(1, bs, 1).transpose(0, 1) # nq, bs, 4
+            tgt_ = self.tgt_embed.weight[:num_queries, None, :].repeat(1, bs, 1).transpose(0, 1)                 # nq, bs, d_model
+            refpoint_embed_ = self.refpoint_embed.weight[:num_queries, None, :].repeat(1, bs, 1).transpose(0, 1) # nq, bs, 4
 
             if refpoint_embed is not None:
                 refpoint_embed = torch.cat([refpoint_embed,refpoint_embed_],dim=1)
@@ -1360,7 +1791,7 @@ class DINOTransformer(nn.Module):
             if self.num_patterns > 0:
                 tgt_embed = tgt.repeat(1, self.num_patterns, 1)
                 refpoint_embed = refpoint_embed.repeat(1, self.num_patterns, 1)
-                tgt_pat = self.patterns.weight[None, :, :].repeat_interleave(self.num_queries, 1) # 1, n_q*n_pat, d_model
+                tgt_pat = self.patterns.weight[None, :, :].repeat_interleave(num_queries, 1) # 1, n_q*n_pat, d_model
                 tgt = tgt_embed + tgt_pat
 
             init_box_proposal = refpoint_embed_.sigmoid()
@@ -1384,7 +1815,8 @@ class DINOTransformer(nn.Module):
                                 spatial_shapes=spatial_shapes,
                                 valid_ratios=valid_ratios,tgt_mask=attn_mask,
                                 fc_reg=fc_reg,
-                                fc_cls=fc_cls)
+                                fc_cls=fc_cls,
+                                early_exit=early_exit)
       
 
 
@@ -1403,7 +1835,7 @@ class DINOTransformer(nn.Module):
         # references: sigmoid coordinates. (n_dec+1, bs, bq, 4)
         # hs_enc: (n_enc+1, bs, nq, d_model) or (1, bs, nq, d_model) or None
         # ref_enc: sigmoid coordinates. (n_enc+1, bs, nq, query_dim) or (1, bs, nq, query_dim) or None
-        return hs, references, hs_enc, ref_enc, init_box_proposal   # init_box_proposal: [2, 900, 4]
+        return hs, references, hs_enc, ref_enc, init_box_proposal, aux_losses   # init_box_proposal: [2, 900, 4]
 
 
     def forward_with_query(self, srcs, masks, refpoint_embed_, pos_embeds, tgt_, attn_mask=None, fc_reg=None, fc_cls=None, fc_enc_reg=None, fc_enc_cls=None):                                                                
@@ -1440,9 +1872,13 @@ class DINOTransformer(nn.Module):
         src_flatten = torch.cat(src_flatten, 1)    # bs, \sum{hxw}, c 
         mask_flatten = torch.cat(mask_flatten, 1)   # bs, \sum{hxw}
         lvl_pos_embed_flatten = torch.cat(lvl_pos_embed_flatten, 1) # bs, \sum{hxw}, c 
+        spatial_shapes_hw = tuple(spatial_shapes)
         spatial_shapes = torch.as_tensor(spatial_shapes, dtype=torch.long, device=src_flatten.device)
         level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
-        valid_ratios = torch.stack([self.get_valid_ratio(m) for m in masks], 1)
+        valid_ratios = self.get_valid_ratios(masks)
+        if self.static_shape:
+            # MSDeformAttn falls back to the pure PyTorch sampling with python shapes
+            spatial_shapes = spatial_shapes_hw
 
         # two stage
         enc_topk_proposals = enc_refpoint_embed = None
@@ -1451,15 +1887,18 @@ class DINOTransformer(nn.Module):
         # memory: [bs, hw, c]
         # enc_intermediate_output: [n_enc, bs, nq, c]
         # enc_intermediate_refpoints: [n_enc, bs, nq, c]
-        memory, enc_intermediate_output, enc_intermediate_refpoints = self.encoder(
-                src_flatten, 
-                pos=lvl_pos_embed_flatten, 
-                level_start_index=level_start_index, 
-                spatial_shapes=spatial_shapes,
-                valid_ratios=valid_ratios,
-                key_padding_mask=mask_flatten,
-                ref_token_index=enc_topk_proposals, # bs, nq 
-                ref_token_coord=enc_refpoint_embed,)
+        if self.packed_encoder:
+            memory = self.encode_packed(src_flatten, lvl_pos_embed_flatten, masks, mask_flatten)
+        else:
+            memory, enc_intermediate_output, enc_intermediate_refpoints, _ = self.encoder(
+                    src_flatten, 
+                    pos=lvl_pos_embed_flatten, 
+                    level_start_index=level_start_index, 
+                    spatial_shapes=spatial_shapes,
+                    valid_ratios=valid_ratios,
+                    key_padding_mask=mask_flatten,
+                    ref_token_index=enc_topk_proposals, # bs, nq 
+                    ref_token_coord=enc_refpoint_embed,)
     
 
         tgt = tgt_[:, None, :].repeat(1, bs, 1).transpose(0, 1)                         # (num_consistency_query, bs, d_model)
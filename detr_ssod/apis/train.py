@@ -20,7 +20,11 @@ from mmdet.datasets import build_dataset, replace_ImageToTensor
 
 from detr_ssod.datasets import build_dataloader
 from detr_ssod.utils import find_latest_checkpoint, get_root_logger, patch_runner
-from detr_ssod.utils.hooks import DistEvalHook
+from detr_ssod.utils.hooks import (
+    DistEvalHook,
+    GradientAccumulationFp16OptimizerHook,
+    GradientAccumulationOptimizerHook,
+)
 
 
 def set_random_seed(seed, deterministic=False):
@@ -42,6 +46,46 @@ def set_random_seed(seed, deterministic=False):
         torch.backends.cudnn.benchmark = False
 
 
+class CPUDistributedDataParallel(MMDistributedDataParallel):
+    """`MMDistributedDataParallel` of a model on cpu, over gloo.
+
+    Without `device_ids` the inputs are given to the module as they are,
+    so the `DataContainer` of the batch are unwrapped here as
+    `MMDataParallel` does on cpu.
+    """
+
+    def train_step(self, *inputs, **kwargs):
+        inputs, kwargs = self.scatter(inputs, kwargs, [-1])
+        return super().train_step(*inputs[0], **kwargs[0])
+
+    def val_step(self, *inputs, **kwargs):
+        inputs, kwargs = self.scatter(inputs, kwargs, [-1])
+        return super().val_step(*inputs[0], **kwargs[0])
+
+
+class StaticGraphDistributedDataParallel(MMDistributedDataParallel):
+    """`MMDistributedDataParallel` with a static graph, on gpu or cpu.
+
+    The model must give gradients to the same parameters every step, there
+    is no `find_unused_parameters`. The train step of
+    `MMDistributedDataParallel` prepares the reducer itself and misses the
+    first iteration of a static graph, in which the reducer records the
+    graph, so the batch is scattered here and the losses computed through
+    `DistributedDataParallel.forward`, as `BaseDetector.train_step` does.
+    """
+
+    def __init__(self, module, **kwargs):
+        super().__init__(module, **kwargs)
+        self._set_static_graph()
+
+    def train_step(self, data, optimizer=None, **kwargs):
+        inputs, _ = self.scatter((data, ), {}, self.device_ids or [-1])
+        data = inputs[0][0]
+        losses = self(**data)
+        loss, log_vars = self.module._parse_losses(losses)
+        return dict(loss=loss, log_vars=log_vars, num_samples=len(data["img_metas"]))
+
+
 def train_detector(
     model, dataset, cfg, distributed=False, validate=False, timestamp=None, meta=None
 ):
@@ -80,17 +124,32 @@ def train_detector(
         for ds in dataset
     ]
 
-    # put model on gpus
+    # put model on gpus, or on cpu where there is none
+    device = cfg.get("device", "cuda" if torch.cuda.is_available() else "cpu")
     if distributed:
         find_unused_parameters = cfg.get("find_unused_parameters", False)
         # Sets the `find_unused_parameters` parameter in
         # torch.nn.parallel.DistributedDataParallel
-        model = MMDistributedDataParallel(
-            model.cuda(),
-            device_ids=[torch.cuda.current_device()],
+        if cfg.get("static_graph", False):
+            assert not find_unused_parameters, \
+                "static_graph needs the same gradients every step, without find_unused_parameters"
+            ddp_wrapper = StaticGraphDistributedDataParallel
+        elif device == "cpu":
+            ddp_wrapper = CPUDistributedDataParallel
+        else:
+            ddp_wrapper = MMDistributedDataParallel
+        if device == "cpu":
+            ddp_args = dict()
+        else:
+            model, ddp_args = model.cuda(), dict(device_ids=[torch.cuda.current_device()])
+        model = ddp_wrapper(
+            model,
             broadcast_buffers=False,
             find_unused_parameters=find_unused_parameters,
+            **ddp_args,
         )
+    elif device == "cpu":
+        model = MMDataParallel(model)
     else:
         model = MMDataParallel(model.cuda(cfg.gpu_ids[0]), device_ids=cfg.gpu_ids)
 
@@ -124,7 +183,15 @@ def train_detector(
 
     # fp16 setting
     fp16_cfg = cfg.get("fp16", None)
-    if fp16_cfg is not None:
+    if "accumulation_steps" in cfg.optimizer_config and "type" not in cfg.optimizer_config:
+        # an optimizer step every `accumulation_steps` iterations
+        if fp16_cfg is not None:
+            optimizer_config = GradientAccumulationFp16OptimizerHook(
+                **cfg.optimizer_config, **fp16_cfg, distributed=distributed
+            )
+        else:
+            optimizer_config = GradientAccumulationOptimizerHook(**cfg.optimizer_config)
+    elif fp16_cfg is not None:
         optimizer_config = Fp16OptimizerHook(
             **cfg.optimizer_config, **fp16_cfg, distributed=distributed
         )
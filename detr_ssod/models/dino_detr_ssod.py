@@ -17,12 +17,7 @@ from detr_ssod.models.multi_stream_detector import MultiSteamDetector
 from detr_ssod.models.utils import Transform2D, filter_invalid_class_wise, concat_all_gather
 from detr_ssod.utils import log_every_n, log_image_with_boxes
 from detr_ssod.utils.structure_utils import dict_split, weighted_loss
-
-
-try:
-    from scipy.optimize import linear_sum_assignment
-except ImportError:
-    linear_sum_assignment = None
+from detr_od.core.bbox.assigners.assign_pool import AssignmentPool
 
 try:
     import sklearn.mixture as skm
@@ -107,6 +102,11 @@ class DinoDetrSSOD(MultiSteamDetector):
         feat_dims = self.student.bbox_head.embed_dims
         self.projector = Projector()
 
+        # the modules only used by some data groups, {module: data group}.
+        # A step without the group still gives them (zero) gradients, so the
+        # set of gradients is the same every step
+        self.conditional_modules = dict(projector="unsup_student")
+
         self.eval_count = 0
 
     def forward_train(self, img, img_metas, **kwargs):
@@ -148,6 +148,17 @@ class DinoDetrSSOD(MultiSteamDetector):
             )
             unsup_loss = {"unsup_" + k: v for k, v in unsup_loss.items()}
             loss.update(**unsup_loss)
+
+        unused = [getattr(self, name) for name, group in self.conditional_modules.items()
+                  if group not in data_groups]
+        if unused:
+            # like `label_enc` in the head, in the graph with a zero weight
+            zero = sum(param.sum() for module in unused for param in module.parameters()) * 0.0
+            key = next((k for k in loss if "loss" in k), None)
+            if key is None:
+                loss["loss_unused"] = zero
+            else:
+                loss[key] = loss[key] + zero
        
         return loss
 
@@ -245,6 +256,10 @@ class DinoDetrSSOD(MultiSteamDetector):
         cost_ = []
         # import ipdb; ipdb.set_trace()
         match_gt_cost_list, match_gt_inds_list = [], []
+        # the hungarian matches are solved in the thread pool of the assigner
+        # if it has one, overlapped with the cost of the next images
+        pool = getattr(self.student.bbox_head.assigner2, 'pool', None) or AssignmentPool()
+        match_futures = [None for _ in range(num_imgs)]
         with torch.no_grad():
             for img_id, (cls_scores, bbox_preds, gt_labels, gt_bboxes) in enumerate(zip(cls_scores_list_, bbox_preds_list_, gt_labels_list_, gt_bboxes_list_)):
 
@@ -252,38 +267,47 @@ class DinoDetrSSOD(MultiSteamDetector):
                 num_bboxes = bbox_preds.size(0)
                 num_gts = gt_bboxes.size(0)
                 if num_bboxes == 0 or num_gts == 0:
-                    # put the padding data to avoid the bug
-                    match_gt_cost_list.append(cls_scores.new_zeros(0).detach().cpu())
-                    match_gt_inds_list.append(cls_scores.new_zeros(0).long().detach().cpu())
                     continue
                 # calculate the cost matrix
                 img_meta_ = img_metas[img_id]
                 img_h, img_w, _ = img_meta_['img_shape']
                 factor = gt_bboxes.new_tensor([img_w, img_h, img_w, img_h]).unsqueeze(0)
 
-                # cls cost
-                cls_cost = self.student.bbox_head.assigner2.cls_cost(cls_scores, gt_labels)
-                # regression L1 cost
-                normalize_gt_bboxes = gt_bboxes / factor
-                reg_cost = self.student.bbox_head.assigner2.reg_cost(bbox_preds, normalize_gt_bboxes)
-                # regression iou cost, defaultly giou is used in official DETR.
-                bboxes = bbox_cxcywh_to_xyxy(bbox_preds) * factor
-                iou_cost = self.student.bbox_head.assigner2.iou_cost(bboxes, gt_bboxes)
-                # weighted sum of above three costs
-                # import ipdb;ipdb.set_trace()
-                cost = cls_cost + reg_cost + iou_cost
+                assigner = self.student.bbox_head.assigner2
+                if hasattr(assigner, 'match_cost'):
+                    # the three costs below in one fused pass
+                    cost = assigner.match_cost(bbox_preds, cls_scores, gt_bboxes, gt_labels, factor.squeeze(0))
+                else:
+                    # cls cost
+                    cls_cost = assigner.cls_cost(cls_scores, gt_labels)
+                    # regression L1 cost
+                    normalize_gt_bboxes = gt_bboxes / factor
+                    reg_cost = assigner.reg_cost(bbox_preds, normalize_gt_bboxes)
+                    # regression iou cost, defaultly giou is used in official DETR.
+                    bboxes = bbox_cxcywh_to_xyxy(bbox_preds) * factor
+                    iou_cost = assigner.iou_cost(bboxes, gt_bboxes)
+                    # weighted sum of above three costs
+                    # import ipdb;ipdb.set_trace()
+                    cost = cls_cost + reg_cost + iou_cost
 
                 # hungarian match
-                cost = cost.detach().cpu()
+                cost, event = pool.to_host(cost)
+                match_futures[img_id] = (cost, pool.submit(cost, event))
+
+            for img_id, match_future in enumerate(match_futures):
+                if match_future is None:
+                    # put the padding data to avoid the bug
+                    match_gt_cost_list.append(cls_scores_.new_zeros(0).detach().cpu())
+                    match_gt_inds_list.append(cls_scores_.new_zeros(0).long().detach().cpu())
+                    continue
+                cost, future = match_future
                 # matched_row_inds is the positive samples, matched_col_inds is the corresponding matched gt index
-                matched_row_inds, matched_col_inds = linear_sum_assignment(cost)
-                matched_row_inds = torch.from_numpy(matched_row_inds).to(
-                    bbox_preds.device)
-                matched_col_inds = torch.from_numpy(matched_col_inds).to(
-                    bbox_preds.device)
+                matched_row_inds, matched_col_inds = future.result()
+                matched_row_inds = torch.from_numpy(matched_row_inds)
+                matched_col_inds = torch.from_numpy(matched_col_inds)
 
                 # get the positive samples' cost
-                pos_inds_gmm = matched_col_inds                         # pos_inds means the matcheding inital gt bbox index
+                pos_inds_gmm = matched_col_inds.to(bbox_preds_.device)  # pos_inds means the matcheding inital gt bbox index
                 pos_cost_gmm = cost[matched_row_inds, matched_col_inds] 
 
                 # save some useful info
@@ -299,7 +323,9 @@ class DinoDetrSSOD(MultiSteamDetector):
             cost_ = bbox_preds_.new_zeros(0)
         rank, world_size = get_dist_info()
       
-        # all_gather to get all the prediction
+        # all_gather to get all the prediction, the number of unsup images and
+        # so the bound on the matches may differ across ranks, the sizes are
+        # gathered first and the rows padded to the largest of them
         cost_ = concat_all_gather(cost_).detach().cpu()
      
        
@@ -503,6 +529,7 @@ class DinoDetrSSOD(MultiSteamDetector):
 
         imgs_tgt = student_info['img']
         imgs_src = teacher_info['img']
+        device = imgs_tgt.device
 
         norm_pseudo_bboxes_list = []
         
@@ -545,14 +572,14 @@ class DinoDetrSSOD(MultiSteamDetector):
         consistency_bbox_embed = inverse_sigmoid(known_bboxes)
 
 
-        padding_label = torch.zeros(pad_size_1, hidden_dim).cuda()
-        padding_bbox = torch.zeros(pad_size_1, 4).cuda()
+        padding_label = torch.zeros(pad_size_1, hidden_dim, device=device)
+        padding_bbox = torch.zeros(pad_size_1, 4, device=device)
 
         input_query_label_1 = padding_label.repeat(batch_size, 1, 1)
         input_query_bbox_1 = padding_bbox.repeat(batch_size, 1, 1)
         
         # bbox embed
-        map_known_indice_1 = torch.tensor([]).to('cuda')
+        map_known_indice_1 = torch.tensor([], device=device)
         if len(known_num):
             map_known_indice_1 = torch.cat([torch.tensor(range(num)) for num in known_num])
             map_known_indice_1 = torch.cat([map_known_indice_1 + single_pad_1 * i for i in range(dn_number_1)]).long()
@@ -630,8 +657,8 @@ class DinoDetrSSOD(MultiSteamDetector):
                 # if there is no gt bbox in this image, we randomly generate a 
                 # gt bbox and gt label for this image
                 # bbox is the normalized cx, cy, w, h format
-                tmp_bboxes = torch.tensor([[0.5, 0.5, 0.5, 0.5]]).cuda()
-                tmp_labels = torch.randint(0, 80, (1,)).long().cuda()
+                tmp_bboxes = torch.tensor([[0.5, 0.5, 0.5, 0.5]], device=device)
+                tmp_labels = torch.randint(0, 80, (1,)).long().to(device)
 
                 gt_bboxes.append(tmp_bboxes)
                 gt_labels.append(tmp_labels)
@@ -642,7 +669,7 @@ class DinoDetrSSOD(MultiSteamDetector):
 
         # positive and negative dn queries
         dn_number_2 = dn_number_2 * 2
-        known = [(torch.ones_like(t)).cuda() for t in gt_labels]
+        known = [torch.ones_like(t, device=device) for t in gt_labels]
         batch_size = len(known)
         known_num = [sum(k) for k in known]
         if int(max(known_num)) == 0:
@@ -677,8 +704,8 @@ class DinoDetrSSOD(MultiSteamDetector):
         single_pad_2 = int(max(known_num))
 
         pad_size_2 = int(single_pad_2 * 2 * dn_number_2)  #
-        positive_idx = torch.tensor(range(len(boxes))).long().cuda().unsqueeze(0).repeat(dn_number_2, 1)
-        positive_idx += (torch.tensor(range(dn_number_2)) * len(boxes) * 2).long().cuda().unsqueeze(1)
+        positive_idx = torch.arange(len(boxes), device=device).unsqueeze(0).repeat(dn_number_2, 1)
+        positive_idx += (torch.arange(dn_number_2, device=device) * len(boxes) * 2).unsqueeze(1)
         positive_idx = positive_idx.flatten()
         negative_idx = positive_idx + len(boxes)
         if box_noise_scale > 0:
@@ -695,22 +722,22 @@ class DinoDetrSSOD(MultiSteamDetector):
             rand_part[negative_idx] += 1.0
             rand_part *= rand_sign
             known_bbox_ = known_bbox_ + torch.mul(rand_part,
-                                                  diff).cuda() * box_noise_scale
+                                                  diff) * box_noise_scale
             known_bbox_ = known_bbox_.clamp(min=0.0, max=1.0)
             known_bbox_expand[:, :2] = (known_bbox_[:, :2] + known_bbox_[:, 2:]) / 2
             known_bbox_expand[:, 2:] = known_bbox_[:, 2:] - known_bbox_[:, :2]
 
-        m = known_labels_expaned.long().to('cuda')
+        m = known_labels_expaned.long().to(device)
         input_label_embed = self.student.bbox_head.label_enc(m)
         input_bbox_embed = inverse_sigmoid(known_bbox_expand)
 
-        padding_label = torch.zeros(pad_size_2, hidden_dim).cuda()
-        padding_bbox = torch.zeros(pad_size_2, 4).cuda()
+        padding_label = torch.zeros(pad_size_2, hidden_dim, device=device)
+        padding_bbox = torch.zeros(pad_size_2, 4, device=device)
 
         input_query_label_2 = padding_label.repeat(batch_size, 1, 1)
         input_query_bbox_2 = padding_bbox.repeat(batch_size, 1, 1)
 
-        map_known_indice_2 = torch.tensor([]).to('cuda')
+        map_known_indice_2 = torch.tensor([], device=device)
         if len(known_num):
             map_known_indice_2 = torch.cat([torch.tensor(range(num)) for num in known_num])  # [1,2, 1,2,3]
             map_known_indice_2 = torch.cat([map_known_indice_2 + single_pad_2 * i for i in range(2 * dn_number_2)]).long()
@@ -721,7 +748,7 @@ class DinoDetrSSOD(MultiSteamDetector):
         # import ipdb;ipdb.set_trace()
         # construct the attention mask
         tgt_size = pad_size_1 + pad_size_2 + num_queries
-        attn_mask = torch.ones(tgt_size, tgt_size).to('cuda') < 0
+        attn_mask = torch.ones(tgt_size, tgt_size, device=device) < 0
         # match query cannot see the any part of the reconstruct
         attn_mask[pad_size_1 + pad_size_2:, :pad_size_1 + pad_size_2] = True   
         # two part attn_mask respectively
@@ -1,4 +1,8 @@
+from collections import OrderedDict
 from typing import Dict
+
+import torch
+import torch.distributed as dist
 from mmdet.models import BaseDetector, TwoStageDetector
 
 
@@ -31,6 +35,12 @@ class MultiSteamDetector(BaseDetector):
         model.eval()
         for param in model.parameters():
             param.requires_grad = False
+        # a frozen submodule is not trained, DistributedDataParallel leaves
+        # its parameters and buffers out of the reducer and the broadcasts
+        ignored = getattr(self, "_ddp_params_and_buffers_to_ignore", [])
+        ignored += [f"{model_ref}.{name}" for name, _ in model.named_parameters()]
+        ignored += [f"{model_ref}.{name}" for name, _ in model.named_buffers()]
+        self._ddp_params_and_buffers_to_ignore = ignored
 
     def forward_test(self, imgs, img_metas, **kwargs):
 
@@ -57,3 +67,35 @@ class MultiSteamDetector(BaseDetector):
     def show_result(self, *args, **kwargs):
         self.model().CLASSES = self.CLASSES
         return self.model().show_result(*args, **kwargs)
+
+    def _parse_losses(self, losses):
+        """Parse the raw outputs (losses) of the network, as
+        `BaseDetector._parse_losses` does, with a single all_reduce and a
+        single host transfer for all the log vars.
+
+        Args:
+            losses (dict): Raw output of the network, which usually contain
+                losses and other necessary information.
+
+        Returns:
+            tuple[Tensor, dict]: (loss, log_vars), loss is the loss tensor \
+                which may be a weighted sum of all losses, log_vars contains \
+                all the variables to be sent to the logger.
+        """
+        log_vars = OrderedDict()
+        for loss_name, loss_value in losses.items():
+            if isinstance(loss_value, torch.Tensor):
+                log_vars[loss_name] = loss_value.mean()
+            elif isinstance(loss_value, list):
+                log_vars[loss_name] = sum(_loss.mean() for _loss in loss_value)
+            else:
+                raise TypeError(f"{loss_name} is not a tensor or list of tensors")
+
+        loss = sum(_value for _key, _value in log_vars.items() if "loss" in _key)
+        log_vars["loss"] = loss
+
+        # all the scalars packed in one tensor, in the order of the keys
+        values = torch.stack([value.detach().float().reshape(()) for value in log_vars.values()])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(values.div_(dist.get_world_size()))
+        return loss, OrderedDict(zip(log_vars.keys(), values.tolist()))
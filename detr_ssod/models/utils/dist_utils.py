@@ -1,33 +1,70 @@
 import torch 
 import torch.distributed as dist
 
+
+def _comm_device(tensor):
+    """The device the collectives of `tensor` run on, NCCL only takes cuda
+    tensors while gloo takes cpu ones."""
+    if dist.get_backend() == dist.Backend.NCCL:
+        return torch.device('cuda', torch.cuda.current_device())
+    return tensor.device
+
+
 @torch.no_grad()
-def concat_all_gather(tensor):
-    
-    # gather all tensor shape 
-    shape_tensor = torch.tensor(tensor.shape, device='cuda')
-    shape_list = [shape_tensor.clone() for _ in range(dist.get_world_size())]
-    dist.all_gather(shape_list, shape_tensor)
-    
-    # padding tensor to the max length
-    if shape_list[0].numel() > 1:
-        max_shape = torch.tensor([_[0] for _ in shape_list]).max()
-        padding_tensor = torch.zeros((max_shape, shape_tensor[1]), device='cuda').type_as(tensor)
+def concat_all_gather(tensor, max_size=None):
+    """Concatenate tensors of different lengths from all ranks.
+
+    Works on any device and backend, the result is on the device of
+    `tensor`. With `max_size`, the length of each rank is sent with its data
+    in a single all_gather, otherwise the lengths are gathered first. The
+    gathered rows are packed with a mask instead of sliced rank by rank.
+
+    *** Warning ***: torch.distributed.all_gather has no gradient.
+
+    Args:
+        tensor (Tensor): [n, ...], n may differ across ranks, the other dims
+            may not.
+        max_size (int, optional): a bound of n on all ranks, the same on
+            every rank. Default None.
+
+    Returns:
+        Tensor: [sum of n, ...], the tensors of all ranks in rank order.
+    """
+    if not (dist.is_available() and dist.is_initialized()):
+        return tensor
+    world_size = dist.get_world_size()
+    device = _comm_device(tensor)
+    num_rows = tensor.size(0)
+    rows = tensor.reshape(num_rows, tensor.shape[1:].numel()).to(device)
+
+    # the length rides in an extra first row if the dtype holds it exactly
+    if tensor.dtype.is_floating_point:
+        exact = max_size is not None and max_size <= 2 / torch.finfo(tensor.dtype).eps
+    else:
+        exact = tensor.dtype != torch.bool
+    if max_size is not None and exact:
+        assert num_rows <= max_size, f'{num_rows} rows, more than max_size {max_size}'
+        padded = rows.new_zeros((max_size + 1, rows.size(1)))
+        padded[0] = num_rows
+        padded[1:num_rows + 1] = rows
+        gathered = [torch.empty_like(padded) for _ in range(world_size)]
+        dist.all_gather(gathered, padded)
+        gathered = torch.stack(gathered)
+        sizes, gathered = gathered[:, 0, 0].long(), gathered[:, 1:]
     else:
-        max_shape = torch.tensor(shape_list).max()
-        padding_tensor = torch.zeros(max_shape, device='cuda').type_as(tensor)
-       
-    padding_tensor[:shape_tensor[0]] = tensor
-    
-    tensor_list = [torch.zeros_like(padding_tensor) for _ in range(dist.get_world_size())]
-    dist.all_gather(tensor_list, padding_tensor)
-
-    sub_tensor_list = []
-    for sub_tensor, sub_shape in zip(tensor_list, shape_list):
-        sub_tensor_list.append(sub_tensor[:sub_shape[0]])
-    output = torch.cat(sub_tensor_list, dim=0)
+        size = torch.tensor([num_rows], device=device)
+        sizes = [torch.empty_like(size) for _ in range(world_size)]
+        dist.all_gather(sizes, size)
+        sizes = torch.cat(sizes)
+        padded = rows.new_zeros((max(int(sizes.max()), 1), rows.size(1)))
+        padded[:num_rows] = rows
+        gathered = [torch.empty_like(padded) for _ in range(world_size)]
+        dist.all_gather(gathered, padded)
+        gathered = torch.stack(gathered)
 
-    return output
+    valid = torch.arange(gathered.size(1), device=device)[None] < sizes[:, None]
+    output = gathered[valid]
+    return output.view(-1, *tensor.shape[1:]).to(tensor.device)
 
 
 @torch.no_grad()
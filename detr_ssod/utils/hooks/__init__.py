@@ -4,6 +4,14 @@ from .weights_summary import WeightSummary
 from .evaluation import DistEvalHook
 from .submodules_evaluation import SubModulesDistEvalHook  # ，SubModulesEvalHook
 from .step_record import StepRecord
+from .sync_counter import SyncCounter
+from .grad_accumulation import (
+    GradientAccumulationFp16OptimizerHook,
+    GradientAccumulationOptimizerHook,
+    accumulation_steps,
+    optimizer_iter,
+    starts_optimizer_step,
+)
 
 
 __all__ = [
@@ -13,4 +21,10 @@ __all__ = [
     "SubModulesDistEvalHook",
     "WeightSummary",
     "StepRecord",
+    "SyncCounter",
+    "GradientAccumulationOptimizerHook",
+    "GradientAccumulationFp16OptimizerHook",
+    "accumulation_steps",
+    "optimizer_iter",
+    "starts_optimizer_step",
 ]
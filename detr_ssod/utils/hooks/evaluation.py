@@ -1,11 +1,37 @@
 import os.path as osp
+import time
 
+import torch
 import torch.distributed as dist
 from mmcv.runner.hooks import LoggerHook, WandbLoggerHook
 from mmdet.core import DistEvalHook as BaseDistEvalHook
 from torch.nn.modules.batchnorm import _BatchNorm
 
 
+def timed_multi_gpu_test(model, data_loader, **kwargs):
+    """Run multi_gpu_test and return the results with the throughput
+    (images per second over all ranks)."""
+    from mmdet.apis import multi_gpu_test
+
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    results = multi_gpu_test(model, data_loader, **kwargs)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    elapsed = time.perf_counter() - start
+    return results, len(data_loader.dataset) / max(elapsed, 1e-6)
+
+
+def encoder_keep_ratio(model):
+    """Token keep ratio of the sparse encoder in `model`, None if dense."""
+    for module in model.modules():
+        keep_ratio = getattr(module, "sparse_keep_ratio", None)
+        if keep_ratio is not None:
+            return keep_ratio
+    return None
+
+
 class DistEvalHook(BaseDistEvalHook):
     def after_train_iter(self, runner):
         """Called after every training iter to evaluate the results."""
@@ -43,14 +69,16 @@ class DistEvalHook(BaseDistEvalHook):
         if tmpdir is None:
             tmpdir = osp.join(runner.work_dir, ".eval_hook")
 
-        from mmdet.apis import multi_gpu_test
-
-        results = multi_gpu_test(
+        results, fps = timed_multi_gpu_test(
             runner.model, self.dataloader, tmpdir=tmpdir, gpu_collect=self.gpu_collect
         )
         if runner.rank == 0:
             print("\n")
             # runner.log_buffer.output['eval_iter_num'] = len(self.dataloader)
+            runner.log_buffer.output["fps"] = fps
+            keep_ratio = encoder_keep_ratio(runner.model)
+            if keep_ratio is not None:
+                runner.log_buffer.output["enc_keep_ratio"] = keep_ratio
             key_score = self.evaluate(runner, results)
 
             if self.save_best:
@@ -0,0 +1,108 @@
+from mmcv.runner.hooks import HOOKS, Fp16OptimizerHook, OptimizerHook
+from torch.nn.parallel import DistributedDataParallel
+
+
+def accumulation_steps(runner):
+    """The number of iterations of an optimizer step, 1 without a
+    `GradientAccumulationOptimizerHook`."""
+    for hook in runner.hooks:
+        if isinstance(hook, GradientAccumulationOptimizerHook):
+            return hook.accumulation_steps
+    return 1
+
+
+def optimizer_iter(runner):
+    """The number of optimizer steps done before the current iteration."""
+    return runner.iter // accumulation_steps(runner)
+
+
+def starts_optimizer_step(runner):
+    """Whether the current iteration is the first one of an optimizer step.
+    The hooks that follow the optimizer steps, as the EMA of the teacher,
+    only act on these iterations."""
+    return runner.iter % accumulation_steps(runner) == 0
+
+
+@HOOKS.register_module()
+class GradientAccumulationOptimizerHook(OptimizerHook):
+    """`OptimizerHook` that accumulates the gradients of `accumulation_steps`
+    iterations before each optimizer step.
+
+    The loss of each iteration is divided by `accumulation_steps`, and the
+    iterations before the last one of a step run under the `no_sync` of
+    `DistributedDataParallel`, so the gradients are all-reduced once per
+    optimizer step. The runner still counts iterations: `max_iters`, the
+    lr schedule and the checkpoint and evaluation intervals are in
+    iterations, while `MeanTeacher`, `StepRecord` and `Weighter` count
+    optimizer steps, with `optimizer_iter`.
+
+    Args:
+        accumulation_steps (int): iterations per optimizer step. Default 1.
+    """
+
+    def __init__(self, accumulation_steps=1, **kwargs):
+        super(GradientAccumulationOptimizerHook, self).__init__(**kwargs)
+        assert isinstance(accumulation_steps, int) and accumulation_steps > 0
+        self.accumulation_steps = accumulation_steps
+        self._no_sync = None
+
+    def before_run(self, runner):
+        super(GradientAccumulationOptimizerHook, self).before_run(runner)
+        if runner.max_iters % self.accumulation_steps != 0:
+            runner.logger.warning(
+                f"max_iters {runner.max_iters} is not a multiple of accumulation_steps "
+                f"{self.accumulation_steps}, the last iterations are not stepped")
+        runner.model.zero_grad()
+        runner.optimizer.zero_grad()
+
+    def before_train_iter(self, runner):
+        if not self.every_n_iters(runner, self.accumulation_steps) and isinstance(
+                runner.model, DistributedDataParallel):
+            # the reducer is prepared in the forward, enter before it
+            self._no_sync = runner.model.no_sync()
+            self._no_sync.__enter__()
+
+    def after_train_iter(self, runner):
+        self.backward(runner, runner.outputs["loss"] / self.accumulation_steps)
+        if self._no_sync is not None:
+            self._no_sync.__exit__(None, None, None)
+            self._no_sync = None
+        if not self.every_n_iters(runner, self.accumulation_steps):
+            return
+        self.step(runner)
+        runner.model.zero_grad()
+        runner.optimizer.zero_grad()
+
+    def backward(self, runner, loss):
+        loss.backward()
+
+    def step(self, runner):
+        self.clip_and_log_grads(runner)
+        runner.optimizer.step()
+
+    def clip_and_log_grads(self, runner):
+        if self.grad_clip is not None:
+            grad_norm = self.clip_grads(runner.model.parameters())
+            if grad_norm is not None:
+                # Add grad norm to the logger
+                runner.log_buffer.update({"grad_norm": float(grad_norm)},
+                                         runner.outputs["num_samples"])
+
+
+@HOOKS.register_module()
+class GradientAccumulationFp16OptimizerHook(GradientAccumulationOptimizerHook,
+                                            Fp16OptimizerHook):
+    """`GradientAccumulationOptimizerHook` with the loss scaling of
+    `Fp16OptimizerHook`, the scaled gradients are unscaled once per
+    optimizer step."""
+
+    def backward(self, runner, loss):
+        self.loss_scaler.scale(loss).backward()
+
+    def step(self, runner):
+        self.loss_scaler.unscale_(runner.optimizer)
+        self.clip_and_log_grads(runner)
+        self.loss_scaler.step(runner.optimizer)
+        self.loss_scaler.update(self._scale_update_param)
+        # save state_dict of loss_scaler
+        runner.meta.setdefault("fp16", {})["loss_scaler"] = self.loss_scaler.state_dict()
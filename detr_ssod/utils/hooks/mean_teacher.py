@@ -2,6 +2,7 @@ from mmcv.parallel import is_module_wrapper
 from mmcv.runner.hooks import HOOKS, Hook
 from bisect import bisect_right
 from ..logger import log_every_n
+from .grad_accumulation import optimizer_iter, starts_optimizer_step
 
 
 @HOOKS.register_module()
@@ -35,8 +36,10 @@ class MeanTeacher(Hook):
             self.momentum_update(model, 0)
 
     def before_train_iter(self, runner):
-        """Update ema parameter every self.interval iterations."""
-        curr_step = runner.iter
+        """Update ema parameter every self.interval optimizer steps."""
+        if not starts_optimizer_step(runner):
+            return
+        curr_step = optimizer_iter(runner)
         if curr_step % self.interval != 0:
             return
         model = runner.model
@@ -50,9 +53,9 @@ class MeanTeacher(Hook):
         self.momentum_update(model, momentum)
 
     def after_train_iter(self, runner):
-        curr_step = runner.iter
-        if self.decay_intervals is None:
+        if self.decay_intervals is None or not starts_optimizer_step(runner):
             return
+        curr_step = optimizer_iter(runner)
         self.momentum = 1 - (1 - self.momentum) / self.decay_factor ** bisect_right(
             self.decay_intervals, curr_step
         )
@@ -3,6 +3,8 @@ from bisect import bisect_right
 from mmcv.parallel import is_module_wrapper
 from mmcv.runner.hooks import HOOKS, Hook
 
+from .grad_accumulation import optimizer_iter, starts_optimizer_step
+
 
 @HOOKS.register_module()
 class StepRecord(Hook):
@@ -14,9 +16,11 @@ class StepRecord(Hook):
         self.normalize = normalize
         self.name = name
     def before_train_iter(self, runner):
+        if not starts_optimizer_step(runner):
+            return
         iter_based = True
         try:
-            curr_step = runner.iter
+            curr_step = optimizer_iter(runner)
         except:
             curr_step = runner.epoch
             iter_based = False
@@ -6,6 +6,8 @@ from mmcv.runner.hooks import HOOKS, LoggerHook, WandbLoggerHook
 from mmdet.core import DistEvalHook
 from torch.nn.modules.batchnorm import _BatchNorm
 
+from .evaluation import encoder_keep_ratio, timed_multi_gpu_test
+
 
 @HOOKS.register_module()
 class SubModulesDistEvalHook(DistEvalHook):
@@ -67,18 +69,22 @@ class SubModulesDistEvalHook(DistEvalHook):
         else:
             submodules = self.evaluated_modules
         key_scores = []
-        from mmdet.apis import multi_gpu_test
 
         for submodule in submodules:
             # change inference on
             model_ref.inference_on = submodule
-            results = multi_gpu_test(
+            results, fps = timed_multi_gpu_test(
                 runner.model,
                 self.dataloader,
                 tmpdir=tmpdir,
                 gpu_collect=self.gpu_collect,
             )
             if runner.rank == 0:
+                # throughput next to the accuracy, e.g. to trade off the sparse encoder keep ratio
+                runner.log_buffer.output[(".").join([submodule, "fps"])] = fps
+                keep_ratio = encoder_keep_ratio(getattr(model_ref, submodule))
+                if keep_ratio is not None:
+                    runner.log_buffer.output[(".").join([submodule, "enc_keep_ratio"])] = keep_ratio
                 key_score = self.evaluate(runner, results, prefix=submodule)
                 if key_score is not None:
                     key_scores.append(key_score)
@@ -0,0 +1,65 @@
+import warnings
+from collections import Counter
+
+import torch
+from mmcv.runner.hooks import HOOKS, Hook
+
+
+@HOOKS.register_module()
+class SyncCounter(Hook):
+    """Count the device to host synchronisations of each training step.
+
+    Debug only, with `custom_hooks=[dict(type="SyncCounter")]`. Every
+    synchronising CUDA call of a step, the forward as well as the backward
+    and optimizer step, warns under `torch.cuda.set_sync_debug_mode`; the
+    warnings are caught and their number logged as `num_syncs`, averaged
+    over the logging interval like the losses. With `verbose`, the call
+    sites of the most frequent ones are logged every `interval` steps.
+
+    Args:
+        interval (int): how often to log the call sites. Default 50.
+        verbose (bool): log the call sites. Default False.
+        topk (int): the number of call sites logged. Default 10.
+    """
+
+    SYNC_MESSAGE = "called a synchronizing CUDA operation"
+
+    def __init__(self, interval=50, verbose=False, topk=10):
+        self.interval = interval
+        self.verbose = verbose
+        self.topk = topk
+        self._catcher = None
+        self._records = None
+
+    def before_run(self, runner):
+        self.enabled = torch.cuda.is_available() and hasattr(torch.cuda, "set_sync_debug_mode")
+        if not self.enabled:
+            runner.logger.warning(
+                "SyncCounter needs CUDA and torch.cuda.set_sync_debug_mode, no syncs are counted")
+
+    def before_train_iter(self, runner):
+        if not self.enabled:
+            return
+        self._catcher = warnings.catch_warnings(record=True)
+        self._records = self._catcher.__enter__()
+        warnings.simplefilter("always")
+        torch.cuda.set_sync_debug_mode("warn")
+
+    def after_train_iter(self, runner):
+        if self._catcher is None:
+            return
+        torch.cuda.set_sync_debug_mode("default")
+        self._catcher.__exit__(None, None, None)
+        records, self._catcher, self._records = self._records, None, None
+
+        syncs = []
+        for record in records:
+            if self.SYNC_MESSAGE in str(record.message):
+                syncs.append(f"{record.filename}:{record.lineno}")
+            else:
+                # the other warnings of the step go through as usual
+                warnings.warn_explicit(record.message, record.category, record.filename, record.lineno)
+        runner.log_buffer.update({"num_syncs": len(syncs)})
+        if self.verbose and self.every_n_iters(runner, self.interval):
+            sites = ", ".join(f"{site} x{count}" for site, count in Counter(syncs).most_common(self.topk))
+            runner.logger.info(f"{len(syncs)} syncs in iter {runner.iter + 1}: {sites}")
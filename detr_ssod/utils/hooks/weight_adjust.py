@@ -2,6 +2,8 @@ from mmcv.parallel import is_module_wrapper
 from mmcv.runner.hooks import HOOKS, Hook
 from bisect import bisect_right
 
+from .grad_accumulation import accumulation_steps, optimizer_iter, starts_optimizer_step
+
 
 @HOOKS.register_module()
 class Weighter(Hook):
@@ -20,14 +22,15 @@ class Weighter(Hook):
             assert len(self.vals) == len(self.steps) + 1
 
     def before_train_iter(self, runner):
-        curr_step = runner.iter
-        if self.name is None:
+        if self.name is None or not starts_optimizer_step(runner):
             return
+        curr_step = optimizer_iter(runner)
+        max_steps = runner.max_iters // accumulation_steps(runner)
         model = runner.model
         if is_module_wrapper(model):
             model = model.module
         assert hasattr(model, self.name)
-        self.steps = [s if s > 0 else runner.max_iters - s for s in self.steps]
+        self.steps = [s if s > 0 else max_steps - s for s in self.steps]
         runner.log_buffer.output[self.name] = self.vals[
             bisect_right(self.steps, curr_step)
         ]
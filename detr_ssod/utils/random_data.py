@@ -0,0 +1,64 @@
+import random
+
+import numpy as np
+import torch
+from mmcv import Config
+from mmcv.parallel import DataContainer, collate
+from mmdet.models import build_detector
+
+from .patch import patch_config
+
+
+def load_config(filename, cfg_options=None):
+    """Load a train config for the tools/check_* scripts: the `--cfg-options`
+    merged, the references of the semi-supervised configs resolved and no
+    pretrained backbone."""
+    cfg = Config.fromfile(filename)
+    if cfg_options is not None:
+        cfg.merge_from_dict(cfg_options)
+    cfg = patch_config(cfg)
+    # the student of a semi-supervised config
+    cfg.model.get("model", cfg.model).backbone.init_cfg = None
+    return cfg
+
+
+def build_ssod_detector(cfg):
+    """Build the semi-supervised detector of `cfg`, the teacher initialized
+    from the student as `MeanTeacher` does before the first step."""
+    model = build_detector(cfg.model, train_cfg=cfg.get("train_cfg"), test_cfg=cfg.get("test_cfg"))
+    model.teacher.load_state_dict(model.student.state_dict())
+    return model
+
+
+def random_gts(img_shape, max_gts, num_classes, device=None):
+    """1 to `max_gts` random boxes (x1, y1, x2, y2) inside an image of
+    `img_shape` (h, w, ...) and their labels."""
+    h, w = img_shape[:2]
+    num_gts = random.randint(1, max_gts)
+    xy = torch.rand(num_gts, 2, device=device) * 0.5
+    wh = torch.rand(num_gts, 2, device=device) * 0.5 + 0.01
+    factor = torch.tensor([w, h, w, h], device=device, dtype=torch.float)
+    gt_bboxes = torch.cat([xy, xy + wh], -1) * factor
+    gt_labels = torch.randint(0, num_classes, (num_gts, ), device=device)
+    return gt_bboxes, gt_labels
+
+
+def random_ssod_batch(groups, batch_size, img_size, max_gts, num_classes):
+    """A batch of `batch_size` random images of each data group in `groups`,
+    collated as the dataloader gives it. The unsup teacher and student views
+    of an image share its filename and an identity transform."""
+    h, w = img_size
+    samples = []
+    for tag in groups:
+        for i in range(batch_size):
+            gt_bboxes, gt_labels = random_gts((h, w), max_gts, num_classes)
+            img_meta = dict(
+                filename=f"{i}.jpg", tag=tag, img_shape=(h, w, 3), ori_shape=(h, w, 3),
+                pad_shape=(h, w, 3), scale_factor=np.ones(4, dtype=np.float32), flip=False,
+                transform_matrix=np.eye(3, dtype=np.float32))
+            samples.append(dict(
+                img=DataContainer(torch.randn(3, h, w), stack=True),
+                img_metas=DataContainer(img_meta, cpu_only=True),
+                gt_bboxes=DataContainer(gt_bboxes),
+                gt_labels=DataContainer(gt_labels)))
+    return collate(samples, samples_per_gpu=len(samples))
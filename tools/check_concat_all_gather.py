@@ -0,0 +1,63 @@
+import argparse
+import os
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from detr_ssod.models.utils import concat_all_gather
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check concat_all_gather with variable lengths under gloo "
+        "on CPU, in several processes"
+    )
+    parser.add_argument("--world-size", type=int, default=3, help="number of processes")
+    parser.add_argument("--iters", type=int, default=20, help="number of random inputs")
+    parser.add_argument("--max-size", type=int, default=16, help="bound of the rows per rank")
+    parser.add_argument("--port", type=int, default=29533, help="master port")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_args()
+
+
+def rank_inputs(args, it, rank, shape, dtype):
+    """The input of a rank, every rank can rebuild the inputs of the others.
+    The first iterations give empty tensors to some ranks."""
+    generator = torch.Generator().manual_seed(args.seed * 1000 + it * 100 + rank)
+    if it < args.world_size and rank <= it:
+        num_rows = 0
+    else:
+        num_rows = int(torch.randint(0, args.max_size + 1, (1, ), generator=generator))
+    data = torch.randn(num_rows, *shape, generator=generator) * 100
+    return data.to(dtype)
+
+
+def run(rank, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port)
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    cases = [((), torch.float32), ((4, ), torch.float32), ((2, 3), torch.float64),
+             ((), torch.int64), ((4, ), torch.float16)]
+    for it in range(args.iters):
+        for shape, dtype in cases:
+            expected = torch.cat([
+                rank_inputs(args, it, other, shape, dtype) for other in range(args.world_size)])
+            tensor = rank_inputs(args, it, rank, shape, dtype)
+            for max_size in (None, args.max_size):
+                output = concat_all_gather(tensor, max_size=max_size)
+                assert output.dtype == dtype and output.device == tensor.device
+                assert torch.equal(output, expected), \
+                    f"rank {rank} iter {it} {shape} {dtype} max_size={max_size}: outputs differ"
+    dist.barrier()
+    dist.destroy_process_group()
+
+
+def main():
+    args = parse_args()
+    mp.spawn(run, args=(args, ), nprocs=args.world_size, join=True)
+    print(f"{args.world_size} processes x {args.iters} random inputs: concat_all_gather matches torch.cat")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+import argparse
+import os
+import random
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from mmcv import DictAction
+from mmcv.runner import build_optimizer
+
+from detr_ssod.apis.train import CPUDistributedDataParallel
+from detr_ssod.utils.random_data import build_ssod_detector, load_config, random_ssod_batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Run a few semi-supervised train steps under "
+        "CPUDistributedDataParallel in several gloo processes and report the "
+        "throughput"
+    )
+    parser.add_argument("config", help="train config file path, preferably a small model")
+    parser.add_argument("--world-size", type=int, default=2, help="number of processes")
+    parser.add_argument("--iters", type=int, default=3, help="timed train steps")
+    parser.add_argument("--warmup-iters", type=int, default=1, help="untimed train steps first")
+    parser.add_argument("--batch-size", type=int, default=1, help="images per data group and process")
+    parser.add_argument("--img-size", type=int, nargs=2, default=[256, 320], help="(h, w) of the images")
+    parser.add_argument("--max-gts", type=int, default=5, help="max gts per image")
+    parser.add_argument("--threads", type=int, default=1, help="torch threads per process")
+    parser.add_argument("--port", type=int, default=29534, help="master port")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--cfg-options",
+        nargs="+",
+        action=DictAction,
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file.",
+    )
+    return parser.parse_args()
+
+
+def run(rank, args):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(args.port)
+    dist.init_process_group("gloo", rank=rank, world_size=args.world_size)
+    torch.set_num_threads(args.threads)
+    random.seed(args.seed + rank)
+    torch.manual_seed(args.seed)
+
+    cfg = load_config(args.config, args.cfg_options)
+    model = build_ssod_detector(cfg)
+    num_classes = model.student.bbox_head.num_classes
+    model = CPUDistributedDataParallel(
+        model, broadcast_buffers=False, find_unused_parameters=cfg.get("find_unused_parameters", False))
+    model.train()
+    model.module.teacher.eval()
+    optimizer = build_optimizer(model, cfg.optimizer)
+
+    num_images = 0
+    for i in range(args.warmup_iters + args.iters):
+        if i == args.warmup_iters:
+            dist.barrier()
+            start = time.perf_counter()
+        data = random_ssod_batch(("sup", "unsup_teacher", "unsup_student"), args.batch_size,
+                                 args.img_size, args.max_gts, num_classes)
+        outputs = model.train_step(data, optimizer)
+        optimizer.zero_grad()
+        outputs["loss"].backward()
+        optimizer.step()
+        if i >= args.warmup_iters:
+            num_images += outputs["num_samples"]
+    dist.barrier()
+    elapsed = time.perf_counter() - start
+
+    # the replicas stay identical if the gradients were all-reduced
+    checksum = torch.stack([param.detach().double().sum() for param in model.module.student.parameters()]).sum()
+    checksums = [torch.zeros_like(checksum) for _ in range(args.world_size)]
+    dist.all_gather(checksums, checksum)
+    assert all(torch.equal(c, checksums[0]) for c in checksums), \
+        f"rank {rank}: the student parameters differ across ranks"
+    num_images = torch.tensor(num_images, dtype=torch.float64)
+    dist.all_reduce(num_images)
+    if rank == 0:
+        print(f"{args.world_size} processes x {args.iters} steps: {num_images.item() / elapsed:.2f} images/s "
+              f"({elapsed / args.iters:.2f} s per step)")
+    dist.destroy_process_group()
+
+
+def main():
+    args = parse_args()
+    mp.spawn(run, args=(args, ), nprocs=args.world_size, join=True)
+
+
+if __name__ == "__main__":
+    main()
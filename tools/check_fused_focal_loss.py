@@ -0,0 +1,85 @@
+import argparse
+
+import torch
+from mmdet.models.losses import FocalLoss
+
+from detr_od.models.losses import FusedFocalLoss, TaskAlignedFocalLoss
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check the fused focal losses against the dense ones and "
+        "report the memory saved for backward"
+    )
+    parser.add_argument("--iters", type=int, default=10, help="number of random inputs")
+    parser.add_argument("--num-query", type=int, default=900 * 7, help="number of predictions")
+    parser.add_argument("--num-classes", type=int, default=80, help="number of classes")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_args()
+
+
+def run(loss_fn, pred, *args, **kwargs):
+    """The loss, the gradient of its sum and the bytes of the tensors saved
+    for backward."""
+    pred = pred.clone().requires_grad_()
+    saved = {}
+
+    def pack(tensor):
+        saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    hooks = getattr(torch.autograd.graph, "saved_tensors_hooks", None)
+    if hooks is not None:
+        with hooks(pack, lambda tensor: tensor):
+            loss = loss_fn(pred, *args, **kwargs)
+    else:
+        loss = loss_fn(pred, *args, **kwargs)
+    grad, = torch.autograd.grad(loss.sum(), pred)
+    # the input itself is alive anyway
+    saved.pop(pred.data_ptr(), None)
+    return loss.detach(), grad, sum(saved.values()) if hooks is not None else None
+
+
+def check(name, dense, fused, rtol, atol):
+    for dense_value, fused_value, what in zip(dense[:2], fused[:2], ("loss", "grad")):
+        if not torch.allclose(dense_value, fused_value, rtol=rtol, atol=atol):
+            diff = (dense_value - fused_value).abs().max().item()
+            raise SystemExit(f"{name}: {what} differs, max abs diff {diff:.3e}")
+    if dense[2] is not None:
+        print(f"{name}: saved for backward {dense[2] / 2 ** 20:.1f} MiB dense, "
+              f"{fused[2] / 2 ** 20:.1f} MiB fused")
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    dense_focal, fused_focal = FocalLoss(loss_weight=2.0), FusedFocalLoss(loss_weight=2.0)
+    dense_quality = TaskAlignedFocalLoss(loss_weight=2.0)
+    fused_quality = TaskAlignedFocalLoss(loss_weight=2.0, fused=True)
+
+    devices = ["cpu"] + (["cuda"] if torch.cuda.is_available() else [])
+    for i in range(args.iters):
+        for device in devices:
+            # float64 on CPU checks the formulas, float32 the drift in training
+            for dtype, rtol, atol in ((torch.float64, 1e-10, 1e-12), (torch.float32, 1e-4, 1e-6)):
+                logits = torch.randn(args.num_query, args.num_classes, dtype=dtype, device=device) * 3
+                labels = torch.randint(0, args.num_classes + 1, (args.num_query, ), device=device)
+                weight = torch.rand(args.num_query, dtype=dtype, device=device)
+                metrics = torch.rand(args.num_query, dtype=dtype, device=device) * (labels < args.num_classes)
+                avg_factor = (labels < args.num_classes).sum().item() + 1.0
+                verbose = i == 0 and dtype == torch.float32
+
+                dense = run(dense_focal, logits, labels, weight, avg_factor=avg_factor)
+                fused = run(fused_focal, logits, labels, weight, avg_factor=avg_factor)
+                check(f"focal {device} {dtype}", dense, fused if verbose else fused[:2] + (None, ), rtol, atol)
+
+                probs = logits.sigmoid()
+                dense = run(dense_quality, probs, labels, metrics, avg_factor=avg_factor)
+                fused = run(fused_quality, probs, labels, metrics, avg_factor=avg_factor)
+                check(f"task aligned {device} {dtype}", dense, fused if verbose else fused[:2] + (None, ), rtol, atol)
+
+    print(f"{args.iters} random inputs: fused and dense focal losses match")
+
+
+if __name__ == "__main__":
+    main()
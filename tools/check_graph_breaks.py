@@ -0,0 +1,145 @@
+import argparse
+import random
+
+import torch
+from mmcv import DictAction
+from mmdet.models import build_detector
+
+from detr_ssod.utils.random_data import load_config, random_gts
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compile the static-shape part of the student, the backbone, "
+        "neck and head forward with the transformer, train it on random "
+        "batches with the dn queries, assignment and losses run eagerly, and "
+        "count the graph breaks and compiled graphs"
+    )
+    parser.add_argument("config", help="train config file path")
+    parser.add_argument("--iters", type=int, default=20, help="number of random batches")
+    parser.add_argument("--batch-size", type=int, default=2, help="images per batch")
+    parser.add_argument(
+        "--scales",
+        type=int,
+        nargs="+",
+        default=[480, 512, 544, 576, 608, 640, 672, 704, 736, 768, 800],
+        help="short sides of the random multi-scale resize",
+    )
+    parser.add_argument("--max-size", type=int, default=1333, help="max long side")
+    parser.add_argument("--max-gts", type=int, default=30, help="max gts per image")
+    parser.add_argument(
+        "--size-buckets",
+        type=int,
+        nargs="+",
+        default=[800, 1344, 1344, 800, 1344, 1344],
+        help="flattened (h, w) padding buckets, used if the config has no static_shape",
+    )
+    parser.add_argument(
+        "--dn-pad-sizes",
+        type=int,
+        nargs="+",
+        default=[10, 20, 30, 50, 100],
+        help="dn pad sizes, used if the config has no dn_pad_sizes",
+    )
+    parser.add_argument("--backend", default="eager", help="torch.compile backend")
+    parser.add_argument(
+        "--max-graph-breaks",
+        type=int,
+        default=0,
+        help="fail above this number of graph breaks",
+    )
+    parser.add_argument(
+        "--cfg-options",
+        nargs="+",
+        action=DictAction,
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file.",
+    )
+    return parser.parse_args()
+
+
+def random_batch(args, num_classes, device):
+    """A collated batch of randomly resized images (size divisor 32, as the
+    train pipeline) with random gts."""
+    img_shapes = []
+    for _ in range(args.batch_size):
+        scale, ratio = random.choice(args.scales), random.uniform(0.5, 2.0)
+        h, w = (scale, int(scale * ratio)) if ratio >= 1 else (int(scale / ratio), scale)
+        factor = min(1.0, args.max_size / max(h, w))
+        img_shapes.append((int(h * factor), int(w * factor), 3))
+    pad_h = -(-max(s[0] for s in img_shapes) // 32) * 32
+    pad_w = -(-max(s[1] for s in img_shapes) // 32) * 32
+    img = torch.randn(args.batch_size, 3, pad_h, pad_w, device=device)
+    img_metas, gt_bboxes, gt_labels = [], [], []
+    for img_shape in img_shapes:
+        img_metas.append(dict(img_shape=img_shape, batch_input_shape=(pad_h, pad_w)))
+        bboxes, labels = random_gts(img_shape, args.max_gts, num_classes, device)
+        gt_bboxes.append(bboxes)
+        gt_labels.append(labels)
+    return img, img_metas, gt_bboxes, gt_labels
+
+
+def main():
+    args = parse_args()
+    if not hasattr(torch, "compile"):
+        raise RuntimeError("torch.compile requires PyTorch >= 2.0")
+    from torch._dynamo.utils import counters
+
+    cfg = load_config(args.config, args.cfg_options)
+    # the student of a semi-supervised config
+    model_cfg = cfg.model.get("model", cfg.model)
+    if model_cfg.get("static_shape") is None:
+        model_cfg.static_shape = dict(
+            size_buckets=list(zip(args.size_buckets[::2], args.size_buckets[1::2]))
+        )
+    if model_cfg.bbox_head.get("dn_pad_sizes") is None:
+        model_cfg.bbox_head.dn_pad_sizes = args.dn_pad_sizes
+    model_cfg.bbox_head.transformer.static_shape = True
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model = build_detector(model_cfg).to(device)
+    model.train()
+    head = model.bbox_head
+    # a graph per padding bucket and dn pad size at most
+    size_buckets = model_cfg.static_shape.get("size_buckets")
+    assert size_buckets, "the graphs are only bounded with static_shape.size_buckets"
+    max_graphs = len(size_buckets) * len(model_cfg.bbox_head.dn_pad_sizes)
+
+    # only the part of fixed shapes is compiled: the image is padded to a
+    # bucket and the dn queries to a pad size before it, the gt-dependent
+    # assignment and losses run eagerly after it
+    extract_feat, head_forward = model.extract_feat, head.forward
+
+    def static_forward(img, img_metas, *args, **kwargs):
+        return head_forward(extract_feat(img), img_metas, *args, **kwargs)
+
+    torch._dynamo.reset()
+    counters.clear()
+    compiled_forward = torch.compile(static_forward, backend=args.backend)
+    # forward_train passes the padded image on to the head forward
+    model.extract_feat = lambda img: img
+    head.forward = compiled_forward
+    for i in range(args.iters):
+        img, img_metas, gt_bboxes, gt_labels = random_batch(args, head.num_classes, device)
+        losses = model.forward_train(img, img_metas, gt_bboxes, gt_labels, curr_step=head.warm_up_step)
+        loss, _ = model._parse_losses(losses)
+        loss.backward()
+        print(f"iter {i}: input {tuple(img_metas[0]['batch_input_shape'])}, {loss.item():.4f} loss")
+
+    graph_breaks = sum(counters["graph_break"].values())
+    num_graphs = counters["stats"]["unique_graphs"]
+    num_recompiles = sum(counters["recompiles"].values())
+    print(f"\ngraph breaks: {graph_breaks}, compiled graphs: {num_graphs}, "
+          f"recompilations: {num_recompiles}, at most {max_graphs} graphs expected")
+    for reason, count in counters["graph_break"].items():
+        print(f"  {count} x {reason}")
+    for reason, count in counters["recompiles"].items():
+        print(f"  recompiled {count} x: {reason}")
+    if graph_breaks > args.max_graph_breaks:
+        raise SystemExit("the static-shape forward breaks the graph")
+    if num_graphs > max_graphs or num_recompiles > max_graphs:
+        raise SystemExit("the static-shape forward compiles more graphs than padding buckets x dn pad sizes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import argparse
+
+import torch
+from mmdet.core import bbox_cxcywh_to_xyxy, bbox_xyxy_to_cxcywh
+from mmdet.core.bbox.iou_calculators import bbox_overlaps
+
+from detr_od.core.bbox.assigners import O2MAssigner
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check that the vectorised O2MAssigner and alignment "
+        "normalisation give the same results as the per-gt loops"
+    )
+    parser.add_argument("--iters", type=int, default=100, help="number of random inputs")
+    parser.add_argument("--num-query", type=int, default=900, help="number of predictions")
+    parser.add_argument("--max-gts", type=int, default=30, help="max gts per image")
+    parser.add_argument("--num-classes", type=int, default=80, help="number of classes")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_args()
+
+
+def loop_assign(assigner, bbox_pred, cls_pred, gt_bboxes, gt_labels, img_meta,
+                alpha=1, beta=6, teacher_assign=False, multiple_pos=False):
+    """The per-gt loop implementation of O2MAssigner.assign, returns the
+    assigned gt indices, max overlaps and assign metrics."""
+    INF = 100000000
+    num_gts, num_bboxes = gt_bboxes.size(0), bbox_pred.size(0)
+    gt_labels = gt_labels.long()
+    assigned_gt_inds = bbox_pred.new_full((num_bboxes, ), -1, dtype=torch.long)
+    assign_metrics = bbox_pred.new_zeros((num_bboxes, ))
+    img_h, img_w, _ = img_meta['img_shape']
+    factor = gt_bboxes.new_tensor([img_w, img_h, img_w, img_h]).unsqueeze(0)
+
+    pred_bboxes = bbox_cxcywh_to_xyxy(bbox_pred) * factor
+    overlaps = bbox_overlaps(pred_bboxes, gt_bboxes).detach()
+    bbox_scores = cls_pred[:, gt_labels].detach()
+    alignment_metrics = bbox_scores ** alpha * overlaps ** beta
+
+    if teacher_assign and not multiple_pos:
+        _, candidate_idxs = alignment_metrics.topk(1, dim=0, largest=True)
+    else:
+        _, candidate_idxs = alignment_metrics.topk(assigner.candidate_topk, dim=0, largest=True)
+    candidate_metrics = alignment_metrics[candidate_idxs, torch.arange(num_gts)]
+
+    if teacher_assign and multiple_pos:
+        is_pos = torch.zeros_like(candidate_metrics)
+        topk_ious, _ = torch.topk(overlaps, assigner.candidate_topk, dim=0)
+        dynamic_ks = torch.clamp(topk_ious.sum(0).int(), min=1)
+        for gt_idx in range(num_gts):
+            _, pos_idx = torch.topk(candidate_metrics[:, gt_idx], k=dynamic_ks[gt_idx].item(), largest=True)
+            is_pos[:, gt_idx][pos_idx] = 1
+        is_pos = is_pos.bool()
+    else:
+        is_pos = candidate_metrics > 0
+
+    for gt_idx in range(num_gts):
+        candidate_idxs[:, gt_idx] += gt_idx * num_bboxes
+    candidate_idxs = candidate_idxs.view(-1)
+
+    overlaps_inf = torch.full_like(overlaps, -INF).t().contiguous().view(-1)
+    index = candidate_idxs.view(-1)[is_pos.view(-1)]
+    overlaps_inf[index] = overlaps.t().contiguous().view(-1)[index]
+    overlaps_inf = overlaps_inf.view(num_gts, -1).t()
+
+    max_overlaps, argmax_overlaps = overlaps_inf.max(dim=1)
+    assigned_gt_inds[:] = 0
+    assigned_gt_inds[max_overlaps != -INF] = argmax_overlaps[max_overlaps != -INF] + 1
+    assign_metrics[max_overlaps != -INF] = alignment_metrics[
+        max_overlaps != -INF, argmax_overlaps[max_overlaps != -INF]]
+    return assigned_gt_inds, max_overlaps, assign_metrics
+
+
+def loop_normalize(assign_metrics, assign_ious, pos_inds, pos_assigned_gt_inds):
+    """The per-gt loop of the alignment normalisation in the head."""
+    norm_alignment_metrics = assign_metrics.new_zeros(assign_metrics.size(0))
+    for gt_inds in torch.unique(pos_assigned_gt_inds):
+        gt_class_inds = pos_inds[pos_assigned_gt_inds == gt_inds]
+        pos_alignment_metrics = assign_metrics[gt_class_inds]
+        pos_ious = assign_ious[gt_class_inds]
+        norm_alignment_metrics[gt_class_inds] = \
+            pos_alignment_metrics / (pos_alignment_metrics.max() + 10e-8) * pos_ious.max()
+    return norm_alignment_metrics
+
+
+def random_inputs(args, device):
+    """Predictions scattered around random gts, so that most candidates
+    overlap a gt."""
+    img_h, img_w = torch.randint(400, 1333, (2, )).tolist()
+    img_meta = dict(img_shape=(img_h, img_w, 3))
+    factor = torch.tensor([img_w, img_h, img_w, img_h], device=device, dtype=torch.float)
+    num_gts = torch.randint(1, args.max_gts + 1, ()).item()
+    xy = torch.rand(num_gts, 2, device=device) * 0.7
+    wh = torch.rand(num_gts, 2, device=device) * 0.3 + 0.02
+    gt_bboxes = torch.cat([xy, xy + wh], -1) * factor
+    gt_labels = torch.randint(0, args.num_classes, (num_gts, ), device=device)
+
+    gt_cxcywh = bbox_xyxy_to_cxcywh(gt_bboxes / factor)
+    bbox_pred = gt_cxcywh[torch.randint(0, num_gts, (args.num_query, ), device=device)]
+    bbox_pred = (bbox_pred * (1 + 0.3 * torch.randn_like(bbox_pred))).clamp(0.01, 0.99)
+    cls_pred = torch.rand(args.num_query, args.num_classes, device=device)
+    return bbox_pred, cls_pred, gt_bboxes, gt_labels, img_meta
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    assigner = O2MAssigner()
+    modes = [dict(), dict(teacher_assign=True), dict(teacher_assign=True, multiple_pos=True)]
+
+    for i in range(args.iters):
+        bbox_pred, cls_pred, gt_bboxes, gt_labels, img_meta = random_inputs(args, device)
+        for mode in modes:
+            result = assigner.assign(bbox_pred, cls_pred, gt_bboxes, gt_labels, img_meta, **mode)
+            assigned_gt_inds, max_overlaps, assign_metrics = loop_assign(
+                assigner, bbox_pred, cls_pred, gt_bboxes, gt_labels, img_meta, **mode)
+            assert torch.equal(result.gt_inds, assigned_gt_inds), f"iter {i} {mode}: gt_inds differ"
+            assert torch.equal(result.max_overlaps, max_overlaps), f"iter {i} {mode}: max_overlaps differ"
+            assert torch.equal(result.assign_metrics, assign_metrics), f"iter {i} {mode}: metrics differ"
+
+            assign_ious = max_overlaps.clone()
+            assign_ious[assign_ious == -100000000] = 0
+            pos_inds = torch.nonzero(assigned_gt_inds > 0, as_tuple=False).squeeze(-1)
+            pos_assigned_gt_inds = assigned_gt_inds[pos_inds] - 1
+            norm_alignment_metrics = O2MAssigner.normalize_alignment_metrics(
+                assign_metrics, assign_ious, pos_inds, pos_assigned_gt_inds, gt_bboxes.size(0))
+            assert torch.equal(norm_alignment_metrics, loop_normalize(
+                assign_metrics, assign_ious, pos_inds, pos_assigned_gt_inds)), \
+                f"iter {i} {mode}: normalized metrics differ"
+
+    print(f"{args.iters} random inputs x {len(modes)} modes: identical assignments")
+
+
+if __name__ == "__main__":
+    main()
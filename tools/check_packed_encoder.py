@@ -0,0 +1,81 @@
+import argparse
+
+import torch
+import torch.nn.functional as F
+
+from detr_od.models.utils import DINOTransformer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check that the packed encoder matches the padded one on the valid tokens"
+    )
+    parser.add_argument("--iters", type=int, default=10, help="number of random batches")
+    parser.add_argument("--batch-size", type=int, default=3, help="images per batch")
+    parser.add_argument("--max-size", type=int, default=256, help="max side of the padded input")
+    parser.add_argument("--atol", type=float, default=1e-4, help="absolute tolerance")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_args()
+
+
+def random_inputs(transformer, batch_size, max_size, device):
+    """Multi-level features and padding masks of images with random valid
+    areas, as built by the head."""
+    d_model = transformer.d_model
+    input_h, input_w = torch.randint(max_size // 2, max_size + 1, (2, )).tolist()
+    img_masks = torch.ones(batch_size, input_h, input_w, device=device)
+    for img_id in range(batch_size):
+        img_h = torch.randint(input_h // 2, input_h + 1, ()).item()
+        img_w = torch.randint(input_w // 2, input_w + 1, ()).item()
+        img_masks[img_id, :img_h, :img_w] = 0
+    srcs, masks, pos_embeds = [], [], []
+    for lvl in range(transformer.num_feature_levels):
+        stride = 8 * 2 ** lvl
+        h, w = -(-input_h // stride), -(-input_w // stride)
+        srcs.append(torch.randn(batch_size, d_model, h, w, device=device))
+        masks.append(F.interpolate(img_masks[None], size=(h, w)).to(torch.bool).squeeze(0))
+        pos_embeds.append(torch.randn(batch_size, d_model, h, w, device=device))
+    return srcs, masks, pos_embeds
+
+
+def flatten_inputs(transformer, srcs, masks, pos_embeds):
+    """The input preparation of DINOTransformer.forward."""
+    src_flatten = torch.cat([src.flatten(2).transpose(1, 2) for src in srcs], 1)
+    mask_flatten = torch.cat([mask.flatten(1) for mask in masks], 1)
+    lvl_pos_embed_flatten = torch.cat([
+        pos_embed.flatten(2).transpose(1, 2) + transformer.level_embed[lvl].view(1, 1, -1)
+        for lvl, pos_embed in enumerate(pos_embeds)], 1)
+    spatial_shapes = torch.as_tensor([src.shape[-2:] for src in srcs], dtype=torch.long, device=src_flatten.device)
+    level_start_index = torch.cat((spatial_shapes.new_zeros((1, )), spatial_shapes.prod(1).cumsum(0)[:-1]))
+    return src_flatten, mask_flatten, lvl_pos_embed_flatten, spatial_shapes, level_start_index
+
+
+@torch.no_grad()
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    transformer = DINOTransformer(
+        d_model=64, nhead=4, num_encoder_layers=2, num_decoder_layers=1,
+        dim_feedforward=128, num_feature_levels=4).to(device).eval()
+
+    max_diff = 0.0
+    for _ in range(args.iters):
+        srcs, masks, pos_embeds = random_inputs(transformer, args.batch_size, args.max_size, device)
+        src_flatten, mask_flatten, pos_flatten, spatial_shapes, level_start_index = flatten_inputs(
+            transformer, srcs, masks, pos_embeds)
+        padded = transformer.encoder(
+            src_flatten, pos=pos_flatten, spatial_shapes=spatial_shapes, level_start_index=level_start_index,
+            valid_ratios=transformer.get_valid_ratios(masks), key_padding_mask=mask_flatten)[0]
+        packed = transformer.encode_packed(src_flatten, pos_flatten, masks, mask_flatten)
+        valid = ~mask_flatten
+        max_diff = max(max_diff, (padded[valid] - packed[valid]).abs().max().item())
+        assert (packed[mask_flatten] == 0).all()
+
+    print(f"max abs diff on the valid tokens: {max_diff:.2e}")
+    if max_diff > args.atol:
+        raise SystemExit("the packed encoder does not match the padded encoder")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import argparse
+
+import torch
+from mmdet.models.losses import FocalLoss
+
+from detr_od.models.losses import (SparseFocalLoss, SparseTaskAlignedFocalLoss,
+                                   TaskAlignedFocalLoss)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check that the sparse-target focal losses match the dense "
+        "ones in value and gradient"
+    )
+    parser.add_argument("--iters", type=int, default=20, help="number of random inputs")
+    parser.add_argument("--num-query", type=int, default=900, help="number of predictions")
+    parser.add_argument("--num-classes", type=int, default=365, help="number of classes")
+    parser.add_argument("--pos-ratio", type=float, default=0.05, help="ratio of positive queries")
+    parser.add_argument("--rtol", type=float, default=1e-10, help="relative tolerance (float64)")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    return parser.parse_args()
+
+
+def value_and_grad(loss_fn, pred, *args, **kwargs):
+    pred = pred.clone().requires_grad_()
+    loss = loss_fn(pred, *args, **kwargs)
+    grad, = torch.autograd.grad(loss.sum(), pred)
+    return loss.detach(), grad
+
+
+def check(name, dense, sparse, rtol):
+    for dense_value, sparse_value, what in zip(dense, sparse, ("loss", "grad")):
+        if not torch.allclose(dense_value, sparse_value, rtol=rtol, atol=1e-12):
+            diff = (dense_value - sparse_value).abs().max().item()
+            raise SystemExit(f"{name}: {what} differs, max abs diff {diff:.3e}")
+
+
+def main():
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    dense_focal, sparse_focal = FocalLoss(loss_weight=2.0), SparseFocalLoss(loss_weight=2.0)
+    dense_quality, sparse_quality = TaskAlignedFocalLoss(loss_weight=2.0), SparseTaskAlignedFocalLoss(loss_weight=2.0)
+
+    for _ in range(args.iters):
+        # the dense reference runs the python focal loss on CPU
+        logits = torch.randn(args.num_query, args.num_classes, dtype=torch.float64) * 3
+        labels = torch.randint(0, args.num_classes, (args.num_query, ))
+        labels[torch.rand(args.num_query) > args.pos_ratio] = args.num_classes
+        weight = torch.rand(args.num_query, dtype=torch.float64)
+        metrics = torch.rand(args.num_query, dtype=torch.float64) * (labels < args.num_classes)
+        avg_factor = (labels < args.num_classes).sum().item() + 1.0
+
+        for reduction in ("mean", "sum", "none"):
+            kwargs = dict(reduction_override=reduction)
+            if reduction == "mean":
+                kwargs["avg_factor"] = avg_factor
+            check(f"focal {reduction}",
+                  value_and_grad(dense_focal, logits, labels, weight, **kwargs),
+                  value_and_grad(sparse_focal, logits, labels, weight, **kwargs), args.rtol)
+
+            probs = logits.sigmoid()
+            check(f"task aligned {reduction}",
+                  value_and_grad(dense_quality, probs, labels, metrics, **kwargs),
+                  value_and_grad(sparse_quality, probs, labels, metrics, **kwargs), args.rtol)
+
+        # the explicit triples of the positives only
+        pos_inds = (labels < args.num_classes).nonzero().squeeze(1)
+        triples = (pos_inds, labels[pos_inds], torch.ones_like(pos_inds, dtype=torch.float64))
+        check("focal triples",
+              value_and_grad(dense_focal, logits, labels, avg_factor=avg_factor),
+              value_and_grad(sparse_focal, logits, triples, avg_factor=avg_factor), args.rtol)
+
+    print(f"{args.iters} random inputs: sparse and dense focal losses match")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+import argparse
+import random
+
+import torch
+from mmcv import DictAction
+from mmcv.parallel import MMDataParallel
+
+from detr_ssod.utils.random_data import build_ssod_detector, load_config, random_ssod_batch
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Check that the semi-supervised detector gives gradients to "
+        "the same parameters every step, before and after the warm-up, as a "
+        "static DDP graph needs"
+    )
+    parser.add_argument("config", help="train config file path")
+    parser.add_argument("--iters", type=int, default=2, help="steps of each phase")
+    parser.add_argument("--batch-size", type=int, default=1, help="images per data group")
+    parser.add_argument("--img-size", type=int, nargs=2, default=[512, 640], help="(h, w) of the images")
+    parser.add_argument("--max-gts", type=int, default=10, help="max gts per image")
+    parser.add_argument("--seed", type=int, default=0, help="random seed")
+    parser.add_argument(
+        "--cfg-options",
+        nargs="+",
+        action=DictAction,
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file.",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    random.seed(args.seed)
+    torch.manual_seed(args.seed)
+
+    cfg = load_config(args.config, args.cfg_options)
+    model = build_ssod_detector(cfg)
+    if torch.cuda.is_available():
+        wrapped = MMDataParallel(model.cuda(), device_ids=[0])
+    else:
+        wrapped = MMDataParallel(model)
+    model.train()
+    model.teacher.eval()
+    head = model.student.bbox_head
+
+    # the parameters the reducer of DistributedDataParallel holds
+    ignored = set(getattr(model, "_ddp_params_and_buffers_to_ignore", []))
+    expected = {name for name, param in model.named_parameters()
+                if param.requires_grad and name not in ignored}
+    assert all(f"teacher.{name}" in ignored for name, _ in model.teacher.named_parameters()), \
+        "the teacher is not ignored by DDP"
+
+    phases = [
+        ("warm-up", 0, ("sup", "unsup_teacher", "unsup_student")),
+        ("post-warm-up", head.warm_up_step, ("sup", "unsup_teacher", "unsup_student")),
+        ("post-warm-up, sup only", head.warm_up_step, ("sup", )),
+    ]
+    failed = False
+    for phase, curr_step, groups in phases:
+        model.curr_step = curr_step
+        for i in range(args.iters):
+            model.zero_grad(set_to_none=True)
+            data = random_ssod_batch(groups, args.batch_size, args.img_size, args.max_gts, head.num_classes)
+            wrapped.train_step(data, None)["loss"].backward()
+            grads = {name for name, param in model.named_parameters() if param.grad is not None}
+            missing, extra = expected - grads, grads - expected
+            print(f"{phase}, iter {i}: {len(grads)} gradients, "
+                  f"{len(missing)} missing, {len(extra)} unexpected")
+            for name in sorted(missing):
+                print(f"  missing {name}")
+            for name in sorted(extra):
+                print(f"  unexpected {name}")
+            failed = failed or bool(missing or extra)
+
+    if failed:
+        raise SystemExit("the set of gradients changes across steps, static_graph cannot be used")
+    print(f"the {len(expected)} parameters of the DDP reducer get gradients every step")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import time
+
+import mmcv
+import torch
+from mmcv import Config, DictAction
+from mmcv.parallel import MMDataParallel
+from mmcv.runner import load_checkpoint, wrap_fp16_model
+from mmdet.datasets import build_dataloader, build_dataset, replace_ImageToTensor
+from mmdet.models import build_detector
+
+from detr_ssod.utils import patch_config
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Sweep the inference query budget and report mAP vs. latency"
+    )
+    parser.add_argument("config", help="test config file path")
+    parser.add_argument("checkpoint", help="checkpoint file")
+    parser.add_argument(
+        "--budgets",
+        type=int,
+        nargs="+",
+        default=[900, 600, 300, 100, 50],
+        help="query budgets (num_queries per call) to evaluate",
+    )
+    parser.add_argument(
+        "--eval",
+        type=str,
+        nargs="+",
+        default=["bbox"],
+        help='evaluation metrics, e.g., "bbox" for COCO, "mAP" for PASCAL VOC',
+    )
+    parser.add_argument(
+        "--warmup", type=int, default=5, help="number of untimed warm-up iterations"
+    )
+    parser.add_argument("--out", help="dump the sweep results to a json file")
+    parser.add_argument(
+        "--cfg-options",
+        nargs="+",
+        action=DictAction,
+        help="override some settings in the used config, the key-value pair "
+        "in xxx=yyy format will be merged into config file.",
+    )
+    return parser.parse_args()
+
+
+def timed_single_gpu_test(model, data_loader, num_queries, device="cuda", warmup=5, **kwargs):
+    """Inference with a query budget on `device`, returns the results and the
+    mean latency (ms per image) after `warmup` iterations."""
+    # the kernels are asynchronous on gpu, they are waited for in the timing
+    synchronize = torch.cuda.synchronize if device == "cuda" else (lambda: None)
+    model.eval()
+    results = []
+    elapsed, num_timed = 0.0, 0
+    prog_bar = mmcv.ProgressBar(len(data_loader.dataset))
+    for i, data in enumerate(data_loader):
+        synchronize()
+        start = time.perf_counter()
+        with torch.no_grad():
+            result = model(
+                return_loss=False, rescale=True, num_queries=num_queries, **data, **kwargs
+            )
+        synchronize()
+        batch_size = len(result)
+        if i >= warmup:
+            elapsed += time.perf_counter() - start
+            num_timed += batch_size
+        results.extend(result)
+        for _ in range(batch_size):
+            prog_bar.update()
+    return results, 1000 * elapsed / max(num_timed, 1)
+
+
+def main():
+    args = parse_args()
+
+    cfg = Config.fromfile(args.config)
+    if args.cfg_options is not None:
+        cfg.merge_from_dict(args.cfg_options)
+    if "pretrained" in cfg.model:
+        cfg.model.pretrained = None
+
+    cfg.data.test.test_mode = True
+    samples_per_gpu = cfg.data.test.pop("samples_per_gpu", 1)
+    if samples_per_gpu > 1:
+        cfg.data.test.pipeline = replace_ImageToTensor(cfg.data.test.pipeline)
+
+    test_kwargs = dict()
+    step_info = args.checkpoint.split("/")[-1][:-4]
+    if "semi_wrapper" in cfg:
+        # same as tools/test.py: evaluate the teacher of the stage-wise training
+        cfg["semi_wrapper"]["test_cfg"]["inference_on"] = "teacher"
+        test_kwargs["curr_step"] = eval(step_info.split("_")[-1])
+
+    cfg = patch_config(cfg)
+
+    dataset = build_dataset(cfg.data.test)
+    data_loader = build_dataloader(
+        dataset,
+        samples_per_gpu=samples_per_gpu,
+        workers_per_gpu=cfg.data.workers_per_gpu,
+        dist=False,
+        shuffle=False,
+    )
+
+    model = build_detector(cfg.model, test_cfg=cfg.get("test_cfg"))
+    if cfg.get("fp16", None) is not None:
+        wrap_fp16_model(model)
+    checkpoint = load_checkpoint(model, args.checkpoint, map_location="cpu")
+    model.CLASSES = checkpoint.get("meta", {}).get("CLASSES", dataset.CLASSES)
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if device == "cuda":
+        model = MMDataParallel(model.cuda(), device_ids=[0])
+    else:
+        model = MMDataParallel(model)
+
+    eval_kwargs = cfg.get("evaluation", {}).copy()
+    for key in ["type", "interval", "tmpdir", "start", "gpu_collect", "save_best", "rule"]:
+        eval_kwargs.pop(key, None)
+    eval_kwargs.update(dict(metric=args.eval))
+
+    sweep = []
+    for num_queries in args.budgets:
+        print(f"\nevaluating with a budget of {num_queries} queries ...")
+        results, latency = timed_single_gpu_test(
+            model, data_loader, num_queries, device=device, warmup=args.warmup, **test_kwargs
+        )
+        metric = dataset.evaluate(results, **eval_kwargs)
+        sweep.append(dict(num_queries=num_queries, latency_ms=latency, metric=metric))
+
+    print("\nnum_queries | latency (ms/img) | metric")
+    for item in sweep:
+        key_metrics = {k: v for k, v in item["metric"].items() if "copypaste" not in k}
+        print(f"{item['num_queries']:>11} | {item['latency_ms']:>16.2f} | {key_metrics}")
+    if args.out:
+        mmcv.dump(dict(config=args.config, sweep=sweep), args.out, indent=4)
+
+
+if __name__ == "__main__":
+    main()
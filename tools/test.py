@@ -6,6 +6,7 @@ import warnings
 
 import mmcv
 import torch
+import torch.distributed as dist
 from mmcv import Config, DictAction
 from mmcv.cnn import fuse_conv_bn
 from mmcv.parallel import MMDataParallel, MMDistributedDataParallel
@@ -57,6 +58,14 @@ def parse_args():
         default=0.3,
         help="score threshold (default: 0.3)",
     )
+    parser.add_argument(
+        "--early-exit",
+        type=float,
+        nargs=2,
+        metavar=("SCORE_THR", "BOX_THR"),
+        help="enable early-exit decoding with the given top-k score and box "
+        "delta thresholds, the layer-exit histogram is reported with the metrics",
+    )
     parser.add_argument(
         "--gpu-collect",
         action="store_true",
@@ -115,6 +124,35 @@ def parse_args():
     return args
 
 
+def set_early_exit(model, score_thr, box_thr):
+    """Enable early-exit decoding in every DETR head of the model."""
+    for module in model.modules():
+        if hasattr(module, "transformer") and getattr(module, "test_cfg", None) is not None:
+            module.test_cfg["early_exit"] = dict(score_thr=score_thr, box_thr=box_thr)
+
+
+def reset_exit_layer_hist(model):
+    """Zero the layer-exit histograms of all decoders."""
+    for module in model.modules():
+        if hasattr(module, "reset_exit_layer_hist"):
+            module.reset_exit_layer_hist()
+
+
+def collect_exit_layer_hist(model):
+    """Sum the layer-exit histograms of all decoders over all ranks."""
+    hist = None
+    for module in model.modules():
+        if hasattr(module, "exit_layer_hist"):
+            module_hist = torch.tensor(module.exit_layer_hist, dtype=torch.long)
+            hist = module_hist if hist is None else hist + module_hist
+    if hist is not None and dist.is_available() and dist.is_initialized():
+        # NCCL only takes cuda tensors, gloo cpu ones
+        if dist.get_backend() == dist.Backend.NCCL:
+            hist = hist.cuda()
+        dist.all_reduce(hist)
+    return None if hist is None else hist.cpu().tolist()
+
+
 def main():
     args = parse_args()
 
@@ -223,6 +261,9 @@ def main():
     checkpoint = load_checkpoint(model, args.checkpoint, map_location="cpu")
     if args.fuse_conv_bn:
         model = fuse_conv_bn(model)
+    if args.early_exit is not None:
+        set_early_exit(model, *args.early_exit)
+        reset_exit_layer_hist(model)
     # old versions did not save class info in checkpoints, this walkaround is
     # for backward compatibility
     if "CLASSES" in checkpoint.get("meta", {}):
@@ -266,8 +307,14 @@ def main():
         with open(args.load_results, "rb") as f:
             outputs = mmcv.load(f, file_format="pickle")
 
+    exit_layer_hist = None
+    if args.early_exit is not None and not args.load_results:
+        exit_layer_hist = collect_exit_layer_hist(model)
+
     rank, _ = get_dist_info()
     if rank == 0:
+        if exit_layer_hist is not None:
+            print(f"\nlayer-exit histogram (images per decoder layer): {exit_layer_hist}")
         if args.out:
             print(f"\nwriting results to {args.out}")
             mmcv.dump(outputs, args.out)
@@ -291,6 +338,12 @@ def main():
             metric = dataset.evaluate(outputs, classwise=True,  **eval_kwargs)
             print(metric)
             metric_dict = dict(config=args.config, metric=metric)
+            if exit_layer_hist is not None:
+                metric_dict["early_exit"] = dict(
+                    score_thr=args.early_exit[0],
+                    box_thr=args.early_exit[1],
+                    exit_layer_hist=exit_layer_hist,
+                )
             if args.work_dir is not None and rank == 0:
                 mmcv.dump(metric_dict, json_file, indent=4)
 
@@ -132,7 +132,13 @@ def main():
         distributed = False
     else:
         distributed = True
-        init_dist(args.launcher, **cfg.dist_params)
+        if torch.cuda.is_available():
+            init_dist(args.launcher, **cfg.dist_params)
+        else:
+            # cpu only workers, `init_dist` binds each rank to a gpu
+            assert args.launcher == "pytorch", \
+                "training without gpus only supports the pytorch launcher"
+            torch.distributed.init_process_group(backend="gloo")
         # re-set gpu_ids with distributed training mode
         _, world_size = get_dist_info()
         cfg.gpu_ids = range(world_size)